@@ -0,0 +1,419 @@
+"""Serve many camera streams from one asyncio event loop over a shared `Network`."""
+
+import asyncio
+import functools
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from capture import should_drop_oldest
+from inference import Network
+from journal import journal_path
+from loguru import logger
+from metrics import PipelineMetrics
+from pipeline import StreamPipeline
+from preprocess import Preprocessor
+from profiles import performance_settings
+
+
+class AsyncInfer:
+    """
+    The infer requests of a `Network` as awaitables, for one event loop.
+
+    `infer` waits for a free request, preprocesses the frame into it on the
+    executor, starts it and returns its output once the device called back.
+    Requests are handed out in the order they are asked for, whichever
+    stream asks. Backends that cannot call back are waited for on the
+    executor instead.
+    """
+
+    def __init__(self, network: Network, executor: ThreadPoolExecutor):
+        """
+        Params
+        ======
+        network: Network
+            A network loaded with a batch of one frame, only used through
+            this object from now on.
+        executor: ThreadPoolExecutor
+            Threads to preprocess on, and to wait on without callbacks.
+        """
+        input_shape = network.get_input_shape()
+        if input_shape[0] != 1:
+            raise ValueError("AsyncInfer runs one frame per request, not batches.")
+        self.network = network
+        self.executor = executor
+        self._loop = asyncio.get_running_loop()
+        self._free = asyncio.Queue()
+        for request_id in range(network.num_requests):
+            self._free.put_nowait(request_id)
+        self._futures = [None] * network.num_requests
+        # One per request: the executor preprocesses several frames at once.
+        self._preprocessors = [
+            None if network.device_preprocess else Preprocessor(input_shape)
+            for _ in range(network.num_requests)
+        ]
+        self.callbacks = network.set_callback(self._completed)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests in use."""
+        return self.network.num_requests - self._free.qsize()
+
+    def _completed(self, request_id: int, status: int):
+        # On a thread of the device.
+        self._loop.call_soon_threadsafe(self._resolve, request_id, status)
+
+    def _resolve(self, request_id: int, status: int):
+        future = self._futures[request_id]
+        self._futures[request_id] = None
+        if future is not None and not future.done():
+            if status != 0:
+                future.set_exception(
+                    RuntimeError(
+                        f"Inference request {request_id} failed with status {status}."
+                    )
+                )
+            else:
+                # The output blob is reused by the next start of the request.
+                output = np.array(self.network.get_output(request_id), copy=True)
+                future.set_result(output)
+        self._free.put_nowait(request_id)
+
+    def _prepare(self, request_id: int, frame: np.ndarray, metrics=None):
+        """The image to start the request with, None once in its input blob."""
+        start_preprocess = time.perf_counter()
+        if self.network.device_preprocess:
+            # The frame itself is the input, it stays untouched until done.
+            image = frame[np.newaxis]
+        else:
+            buffer = self.network.input_buffer(request_id)
+            if buffer is None:
+                image = self._preprocessors[request_id](frame)
+            else:
+                self._preprocessors[request_id](frame, out=buffer)
+                image = None
+        if metrics:
+            metrics.preprocess.observe(time.perf_counter() - start_preprocess)
+        return image
+
+    async def infer(self, frame: np.ndarray, metrics=None) -> np.ndarray:
+        """The raw output of the network on `frame`.
+
+        :param metrics: `StreamMetrics` to observe the preprocess time with
+        """
+        request_id = await self._free.get()
+        try:
+            image = await self._loop.run_in_executor(
+                self.executor, self._prepare, request_id, frame, metrics
+            )
+            future = self._futures[request_id] = self._loop.create_future()
+            self.network.exec_net(image, request_id=request_id)
+        except BaseException:
+            self._futures[request_id] = None
+            self._free.put_nowait(request_id)
+            raise
+        if not self.callbacks:
+            # The request is only free again once it completed, also when
+            # this task is cancelled while waiting for it.
+            waiting = self._loop.run_in_executor(
+                self.executor, self.network.wait, request_id
+            )
+            waiting.add_done_callback(functools.partial(self._waited, request_id))
+        return await future
+
+    def _waited(self, request_id: int, waiting: asyncio.Future):
+        failed = waiting.cancelled() or waiting.exception() is not None
+        self._resolve(request_id, -1 if failed else waiting.result())
+
+
+def open_capture(source: str) -> cv2.VideoCapture:
+    """Open a video file, or a camera by index or URL."""
+    # Camera indices are passed to OpenCV as integers.
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise RuntimeError(f"Cannot open video source {source!r}.")
+    return capture
+
+
+class AsyncStream:
+    """
+    One input stream as three tasks of the event loop, linked by bounded
+    queues:
+
+    * capture: decodes frames on the executor into `frames`; a full queue
+      makes it wait, or drops the oldest frame of a live source
+    * count: drives the `StreamPipeline` of the stream, starting inference on
+      the frames the detector runs on and counting the frames in order as
+      their results come back, with up to `num_requests` in flight
+    * output: hands every `FrameResult` to `on_result`
+
+    A slow stage holds the stages before it back, down to the capture.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        source: str,
+        capture: cv2.VideoCapture,
+        publisher: object,
+        args: object,
+        infer: AsyncInfer,
+        num_requests: int = 1,
+        on_result=None,
+    ):
+        """
+        Params
+        ======
+        name: str
+            Stream name, its counts are published under `<name>/person`.
+        source: str
+            Video file or camera, for the decode policy.
+        capture: cv2.VideoCapture
+            The opened source, see `open_capture`.
+        publisher: StatsPublisher
+            Publisher of the stats, nothing is published if None.
+        args: Namespace
+            Command line arguments parsed by `main.build_argparser()`.
+        infer: AsyncInfer
+            Requests of the network shared by the streams.
+        num_requests: int
+            Frames the stream can have in flight.
+        on_result: callable (optional)
+            Called with the stream and each `FrameResult`, in order; the
+            coroutines it returns are awaited.
+        """
+        self.name = name
+        self.source = source
+        self.capture = capture
+        self.infer = infer
+        self.num_requests = num_requests
+        self.on_result = on_result
+        self.pipeline = StreamPipeline.from_args(
+            args,
+            None,
+            int(capture.get(3)),
+            int(capture.get(4)),
+            publisher,
+            topic=f"{name}/person",
+            journal=journal_path(args.journal, name) if args.journal else None,
+            fps=capture.get(cv2.CAP_PROP_FPS) or 0.0,
+        )
+        self.counter = self.pipeline.counter
+        self.drop_oldest = should_drop_oldest(args.decode_policy, source)
+        self.frames = asyncio.Queue(args.decode_queue_size)
+        self.results = asyncio.Queue(args.decode_queue_size)
+        # Most frames waiting for the results of the detector frames before them.
+        self.max_pending = (num_requests + 1) * args.detect_every
+        self.frames_dropped = 0
+        # `metrics.StreamMetrics`, once the stream is served.
+        self.metrics = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of decoded frames waiting for the detector."""
+        return self.frames.qsize()
+
+    async def run(self):
+        """Run the stream to its end."""
+        stages = (self._capture(), self._count(), self._output())
+        tasks = [asyncio.ensure_future(stage) for stage in stages]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        self.capture.release()
+        self.pipeline.close()
+
+    def _read(self):
+        """Decode the next frame, on the executor."""
+        start_decode = time.perf_counter()
+        grabbed, frame = self.capture.read()
+        if grabbed and self.metrics:
+            self.metrics.decode.observe(time.perf_counter() - start_decode)
+        return grabbed, frame
+
+    async def _capture(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            grabbed, frame = await loop.run_in_executor(
+                self.infer.executor, self._read
+            )
+            if not grabbed:
+                break
+            if self.drop_oldest and self.frames.full():
+                # A live source does not wait for the consumer.
+                self.frames.get_nowait()
+                self.frames_dropped += 1
+            await self.frames.put(frame)
+        await self.frames.put(None)
+
+    async def _count(self):
+        # Frames admitted and not counted yet, in order:
+        # (frame, index, start time, inference future or None if skipped)
+        pending = deque()
+        in_flight = 0
+        try:
+            while True:
+                frame = await self.frames.get()
+                if frame is None:
+                    break
+                # Count what came back first, so that the pipeline decides on
+                # this frame from the freshest tracks. A detector frame needs
+                # a request of the stream: wait for the oldest if none is free.
+                while pending and (
+                    pending[0][3] is None
+                    or pending[0][3].done()
+                    or in_flight == self.num_requests
+                    or len(pending) >= self.max_pending
+                ):
+                    in_flight -= await self._count_next(pending)
+                index, detect = self.pipeline.admit(frame)
+                future = None
+                if detect:
+                    future = asyncio.ensure_future(
+                        self.infer.infer(frame, self.metrics)
+                    )
+                    in_flight += 1
+                pending.append((frame, index, time.time(), future))
+            while pending:
+                await self._count_next(pending)
+        finally:
+            for _, _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+        await self.results.put(None)
+
+    async def _count_next(self, pending: deque) -> int:
+        """Count the oldest pending frame.
+
+        :return: 1 if it was a detector frame, 0 otherwise
+        """
+        frame, index, start_infer, future = pending[0]
+        if future is None:
+            pending.popleft()
+            self.pipeline.handle_skipped(frame, index)
+        else:
+            output = await future
+            pending.popleft()
+            infer_time = time.time() - start_infer
+            self.pipeline.handle_result(output, frame, index, infer_time)
+        for result in self.pipeline.results():
+            await self.results.put(result)
+        return future is not None
+
+    async def _output(self):
+        while True:
+            result = await self.results.get()
+            if result is None:
+                break
+            start_output = time.perf_counter()
+            if self.on_result is not None:
+                outcome = self.on_result(self, result)
+                if asyncio.iscoroutine(outcome):
+                    await outcome
+            if self.metrics:
+                self.metrics.output.observe(time.perf_counter() - start_output)
+                self.metrics.frames.inc()
+
+
+async def serve_streams(
+    args, publisher, sources: list, metrics=None, on_result=None
+) -> list:
+    """
+    Load the model once and run every stream on the running event loop, with
+    the infer requests of the performance settings per stream.
+
+    Blocking OpenCV calls (opening and decoding the sources, preprocessing)
+    run on a pool of `args.io_threads` threads shared by the streams, rather
+    than on a thread per stream.
+
+    :param args: Command line arguments parsed by `build_argparser()`
+    :param publisher: `StatsPublisher`, or None not to publish
+    :param sources: (name, source) pairs, see `streams.load_sources`
+    :param metrics: `PipelineMetrics` to update, or None
+    :param on_result: see `AsyncStream`
+    :return: the `AsyncStream`s, once they ended
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(args.io_threads, thread_name_prefix="io")
+
+    infer_network = Network(
+        args.backend, replay=args.replay, cache_dir=args.model_cache
+    )
+    settings = performance_settings(args)
+    try:
+        infer_network.load_model(
+            model_xml=args.model,
+            device=args.device,
+            cpu_extension=args.cpu_extension if args.cpu_extension else None,
+            # 0 stays 0: the device picks the number of requests of all streams.
+            num_requests=settings["num_requests"] * len(sources),
+            config=settings,
+            device_preprocess=args.preprocess == "device",
+        )
+    except Exception:
+        logger.exception("Failed to load the model")
+        raise
+    infer = AsyncInfer(infer_network, executor)
+    if not infer.callbacks:
+        logger.warning(
+            f"The {infer_network.backend.name} backend cannot call back, requests "
+            "are waited for on the I/O threads."
+        )
+
+    # Open the sources together, cameras can take seconds each.
+    names = [name for name, _ in sources]
+    opening = [
+        loop.run_in_executor(executor, open_capture, source) for _, source in sources
+    ]
+    captures = await asyncio.gather(*opening, return_exceptions=True)
+    per_stream = -(-infer_network.num_requests // len(sources))
+    streams = []
+    for (name, source), capture in zip(sources, captures):
+        if isinstance(capture, Exception):
+            logger.error(f"{name}: {capture}")
+            continue
+        logger.info(f"Processing {name}: {source}...")
+        stream = AsyncStream(
+            name, source, capture, publisher, args, infer, per_stream, on_result
+        )
+        stream.metrics = metrics.add_stream(name, stream.counter, stream)
+        stream.pipeline.metrics = stream.metrics
+        streams.append(stream)
+    metrics.add_network(infer)
+    if len(streams) < len(names):
+        logger.warning(f"Serving {len(streams)} of the {len(names)} streams.")
+
+    # A stream that fails does not stop the others.
+    outcomes = await asyncio.gather(
+        *(stream.run() for stream in streams), return_exceptions=True
+    )
+    executor.shutdown(wait=False)
+    for stream, outcome in zip(streams, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"{stream.name} failed: {outcome!r}")
+        logger.info(
+            f"{stream.name}: detected {stream.counter.total_count} people with an "
+            "average inference time: "
+            f"{stream.pipeline.mean_infer_time*1000:.3f}ms."
+        )
+    return streams
+
+
+def infer_on_streams_async(args, publisher, sources: list, metrics=None) -> list:
+    """Run `serve_streams` on a new event loop, see `streams.infer_on_streams`."""
+    if args.out or args.ffmpeg or args.debug:
+        logger.warning("--out, --ffmpeg and --debug are ignored by the asyncio runner.")
+    return asyncio.run(serve_streams(args, publisher, sources, metrics))
@@ -0,0 +1,710 @@
+"""Inference backends behind `inference.Network`.
+
+A backend loads a model with a number of infer requests and runs them
+asynchronously; `Network` keeps the ring buffer of requests on top of it.
+Toolkit modules are only imported when their backend is loaded, so the rest
+of the pipeline runs on machines without OpenVINO.
+"""
+
+import importlib.util
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from loguru import logger
+
+from model_cache import ModelCache
+
+
+def ir_input_shape(model_xml: str) -> list:
+    """Shape of the first input of an IR, read from its XML.
+
+    Supports IR v10 ("Parameter" layers) and older versions ("Input" layers).
+    """
+    root = ElementTree.parse(model_xml).getroot()
+    for layer in root.iter("layer"):
+        if layer.get("type") in ("Parameter", "Input"):
+            port = layer.find("output/port")
+            return [int(dim.text) for dim in port.findall("dim")]
+    raise ValueError(f"No input layer found in {model_xml}")
+
+
+def _batched(shape: list, batch_size: int) -> list:
+    shape = list(shape)
+    if batch_size is not None:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be >= 1, got {batch_size}")
+        shape[0] = batch_size
+    return shape
+
+
+class Backend:
+    """
+    Interface of the inference backends.
+
+    `load` creates `num_requests` infer requests; a request is started with
+    `start`, and its result read with `get_output` once `wait` returned 0.
+    """
+
+    name = None
+
+    def __init__(self, cache: ModelCache = None):
+        """
+        Params
+        ======
+        cache: ModelCache (optional)
+            Where compiled models are looked up and stored, by backends that
+            can export them.
+        """
+        self.cache = cache
+        self.num_requests = None
+        self.device_preprocess = False
+
+    def load(
+        self,
+        model_xml: str,
+        model_bin: str,
+        device: str = "CPU",
+        cpu_extension: str = None,
+        num_requests: int = 1,
+        batch_size: int = None,
+        config: dict = None,
+        device_preprocess: bool = False,
+    ):
+        """Load the model, reshaped to `batch_size` images if given.
+
+        `config` holds the performance settings of `profiles.SETTINGS`, which
+        each backend maps to its plugin config. `num_requests=0` creates the
+        number of requests optimal for the device; `num_requests` is set to
+        the number created.
+
+        With `device_preprocess`, backends that can have the plugin resize
+        and transpose the input set `device_preprocess`: `start` then takes
+        BGR uint8 frames of any size, NHWC, rather than NCHW network inputs.
+        """
+        raise NotImplementedError
+
+    @property
+    def input_shape(self) -> list:
+        """Input shape of the loaded model, [batch, channel, height, width]."""
+        raise NotImplementedError
+
+    def input_buffer(self, request_id: int):
+        """Input memory of a request to write into, None if not exposed."""
+        return None
+
+    def start(self, request_id: int, image: np.ndarray = None):
+        """Start a request on `image`, or on its `input_buffer` if None.
+
+        With `device_preprocess`, `image` is a batch of frames that must not
+        be modified until the request completed: it is not copied.
+        """
+        raise NotImplementedError
+
+    def wait(self, request_id: int) -> int:
+        """Wait for a request to complete, returns its status (0 is OK)."""
+        raise NotImplementedError
+
+    def get_output(self, request_id: int) -> np.ndarray:
+        """Output of a completed request, only valid until it is restarted."""
+        raise NotImplementedError
+
+    def set_callback(self, callback) -> bool:
+        """Call `callback(request_id, status)` whenever a request completes.
+
+        The callback runs on a thread of the device, or of the backend, and
+        must not block. Returns False if the backend cannot call back, `wait`
+        must then be used.
+        """
+        return False
+
+
+class InferenceEngineBackend(Backend):
+    """The Inference Engine API of OpenVINO 2019 R3 to 2021."""
+
+    name = "ie"
+
+    def load(
+        self,
+        model_xml,
+        model_bin,
+        device="CPU",
+        cpu_extension=None,
+        num_requests=1,
+        batch_size=None,
+        config=None,
+        device_preprocess=False,
+    ):
+        from openvino import inference_engine
+        from openvino.inference_engine import IECore, IENetwork
+
+        # https://docs.openvinotoolkit.org/latest/ie_python_api/classie__api_1_1IECore.html
+        self.ie_core = IECore()
+
+        # Add a CPU extension, if applicable
+        if cpu_extension and "CPU" in device:
+            self.ie_core.add_extension(cpu_extension, device)
+
+        # Reading the IR is cheap next to compiling it, and gives the input shape.
+        try:
+            self.network = self.ie_core.read_network(model=model_xml, weights=model_bin)
+        except AttributeError:
+            self.network = IENetwork(model=model_xml, weights=model_bin)
+
+        # Get the input layer
+        self._input_blob = next(iter(self.network.inputs))
+        self._output_blob = next(iter(self.network.outputs))
+
+        if batch_size is not None and batch_size != self.input_shape[0]:
+            input_shape = _batched(self.input_shape, batch_size)
+            self.network.reshape({self._input_blob: input_shape})
+
+        if device_preprocess:
+            self.device_preprocess = self._configure_preprocess()
+
+        plugin_config = self.plugin_config(config or {}, device)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(
+                model_xml,
+                model_bin,
+                backend=self.name,
+                version=getattr(inference_engine, "__version__", None),
+                device=device,
+                cpu_extension=cpu_extension,
+                batch_size=self.input_shape[0],
+                config=plugin_config,
+                device_preprocess=self.device_preprocess,
+            )
+            cached = self.cache.get(key)
+            if cached:
+                # Compiled with the layers checked already.
+                self.exec_network = self.ie_core.import_network(
+                    model_file=cached,
+                    device_name=device,
+                    config=plugin_config,
+                    num_requests=num_requests,
+                )
+                self.num_requests = len(self.exec_network.requests)
+                return
+
+        # Check for any unsupported layers before compiling.
+        supported_layers = self.ie_core.query_network(
+            network=self.network, device_name=device
+        )
+        unsupported_layers = [
+            l for l in self.network.layers.keys() if l not in supported_layers
+        ]
+        if len(unsupported_layers) != 0:
+            msg = (
+                "Unsupported layers found: {}, Check whether extensions are available "
+                "to add to IECore.".format(unsupported_layers)
+            )
+            raise RuntimeError(msg)
+
+        # Load the IENetwork into the plugin
+        self.exec_network = self.ie_core.load_network(
+            network=self.network,
+            device_name=device,
+            config=plugin_config,
+            num_requests=num_requests,
+        )
+        self.num_requests = len(self.exec_network.requests)
+        if key is not None:
+            self.cache.store(key, self.exec_network.export)
+
+    def _configure_preprocess(self) -> bool:
+        """Have the plugin take U8 NHWC frames and resize them to the input.
+
+        :return: False if this version of the API cannot set the frames as
+            input blobs (2021.1 and later can)
+        """
+        from openvino import inference_engine
+
+        if not hasattr(inference_engine, "PreProcessInfo"):
+            logger.warning(
+                "This OpenVINO version cannot preprocess frames on the device, "
+                "preprocessing them in Python."
+            )
+            return False
+        inputs = getattr(self.network, "input_info", self.network.inputs)
+        info = inputs[self._input_blob]
+        info.precision = "U8"
+        info.layout = "NHWC"
+        bilinear = inference_engine.ResizeAlgorithm.RESIZE_BILINEAR
+        info.preprocess_info.resize_algorithm = bilinear
+        # Imported networks lose the preprocessing of the network, so it is
+        # given again with every blob.
+        self._preprocess_info = inference_engine.PreProcessInfo()
+        self._preprocess_info.resize_algorithm = bilinear
+        self._blob = inference_engine.Blob
+        self._tensor_desc = inference_engine.TensorDesc
+        # Blobs wrap the frames, keep them alive while their request runs.
+        self._blobs = {}
+        return True
+
+    @staticmethod
+    def plugin_config(settings: dict, device: str) -> dict:
+        """Inference Engine config keys of the performance settings."""
+        config = {}
+        streams = settings.get("nstreams")
+        if device == "CPU":
+            if streams is not None:
+                config["CPU_THROUGHPUT_STREAMS"] = (
+                    "CPU_THROUGHPUT_AUTO" if streams == "auto" else str(streams)
+                )
+            if settings.get("nthreads"):
+                config["CPU_THREADS_NUM"] = str(settings["nthreads"])
+            if settings.get("pin"):
+                config["CPU_BIND_THREAD"] = settings["pin"]
+            if settings.get("precision"):
+                bf16 = settings["precision"].lower() == "bf16"
+                config["ENFORCE_BF16"] = "YES" if bf16 else "NO"
+        elif device.startswith("GPU") and streams is not None:
+            config["GPU_THROUGHPUT_STREAMS"] = (
+                "GPU_THROUGHPUT_AUTO" if streams == "auto" else str(streams)
+            )
+        return config
+
+    @property
+    def input_shape(self):
+        return self.network.inputs[self._input_blob].shape
+
+    def input_buffer(self, request_id):
+        if self.device_preprocess:
+            return None
+        request = self.exec_network.requests[request_id]
+        try:
+            return request.input_blobs[self._input_blob].buffer
+        except AttributeError:
+            # 2019 R3 API
+            return getattr(request, "inputs", {}).get(self._input_blob)
+
+    def start(self, request_id, image=None):
+        if self.device_preprocess and image is not None:
+            batch, height, width, channel = image.shape
+            # Dims are always given in NCHW order, the layout tells the memory order.
+            desc = self._tensor_desc("U8", [batch, channel, height, width], "NHWC")
+            blob = self._blobs[request_id] = self._blob(desc, image)
+            self.exec_network.requests[request_id].set_blob(
+                self._input_blob, blob, self._preprocess_info
+            )
+            image = None
+        if image is None:
+            self.exec_network.start_async(request_id=request_id)
+        else:
+            self.exec_network.start_async(
+                request_id=request_id, inputs={self._input_blob: image}
+            )
+
+    def wait(self, request_id):
+        return self.exec_network.requests[request_id].wait(-1)
+
+    def get_output(self, request_id):
+        return self.exec_network.requests[request_id].outputs[self._output_blob]
+
+    def set_callback(self, callback):
+        requests = self.exec_network.requests
+        if not all(hasattr(request, "set_completion_callback") for request in requests):
+            return False
+        for request_id, request in enumerate(requests):
+            request.set_completion_callback(
+                lambda status, request_id: callback(request_id, status), request_id
+            )
+        return True
+
+
+class OpenVINOBackend(Backend):
+    """The OpenVINO runtime API, 2022.1 and later."""
+
+    name = "openvino"
+
+    def load(
+        self,
+        model_xml,
+        model_bin,
+        device="CPU",
+        cpu_extension=None,
+        num_requests=1,
+        batch_size=None,
+        config=None,
+        device_preprocess=False,
+    ):
+        from openvino.runtime import Core, Tensor, get_version
+
+        self.core = Core()
+        self._tensor = Tensor
+        self.device_preprocess = device_preprocess
+        if cpu_extension and "CPU" in device:
+            self.core.add_extension(cpu_extension)
+
+        properties = self.properties(config or {}, device)
+        key = cached = None
+        if self.cache is not None:
+            key = self.cache.key(
+                model_xml,
+                model_bin,
+                backend=self.name,
+                version=get_version(),
+                device=device,
+                cpu_extension=cpu_extension,
+                batch_size=batch_size,
+                config=properties,
+                device_preprocess=device_preprocess,
+            )
+            cached = self.cache.get(key)
+        if cached:
+            with open(cached, "rb") as f:
+                self.compiled_model = self.core.import_model(
+                    f.read(), device, properties
+                )
+        else:
+            self.model = self.core.read_model(model=model_xml, weights=model_bin)
+            shape = list(self.model.input(0).shape)
+            if batch_size is not None and batch_size != shape[0]:
+                self.model.reshape(_batched(shape, batch_size))
+            if device_preprocess:
+                self.model = self._preprocessed(self.model)
+            self.compiled_model = self.core.compile_model(
+                self.model, device, properties
+            )
+            if key is not None:
+                self.cache.store(key, self._export)
+        if not num_requests:
+            num_requests = self.compiled_model.get_property(
+                "OPTIMAL_NUMBER_OF_INFER_REQUESTS"
+            )
+        self.num_requests = num_requests
+        self.requests = [
+            self.compiled_model.create_infer_request() for _ in range(num_requests)
+        ]
+        if device_preprocess:
+            # The input of the compiled model takes frames of any size.
+            self._input_shape = _batched(ir_input_shape(model_xml), batch_size)
+        else:
+            self._input_shape = list(self.compiled_model.input(0).shape)
+        # Frames shared with the input tensors, kept alive while they run.
+        self._frames = [None] * num_requests
+
+    @staticmethod
+    def _preprocessed(model):
+        """Add the resize and layout change of U8 NHWC frames to `model`."""
+        from openvino.preprocess import PrePostProcessor, ResizeAlgorithm
+        from openvino.runtime import Layout, Type
+
+        ppp = PrePostProcessor(model)
+        ppp.input().tensor().set_element_type(Type.u8).set_layout(
+            Layout("NHWC")
+        ).set_spatial_dynamic_shape()
+        ppp.input().preprocess().resize(ResizeAlgorithm.RESIZE_LINEAR)
+        ppp.input().model().set_layout(Layout("NCHW"))
+        return ppp.build()
+
+    AFFINITY = {"YES": "CORE", "NO": "NONE", "NUMA": "NUMA"}
+
+    @classmethod
+    def properties(cls, settings: dict, device: str) -> dict:
+        """OpenVINO runtime properties of the performance settings."""
+        properties = {}
+        if settings.get("hint"):
+            properties["PERFORMANCE_HINT"] = settings["hint"]
+        if settings.get("nstreams") is not None:
+            properties["NUM_STREAMS"] = str(settings["nstreams"]).upper()
+        if device == "CPU":
+            if settings.get("nthreads"):
+                properties["INFERENCE_NUM_THREADS"] = str(settings["nthreads"])
+            if settings.get("pin"):
+                pin = settings["pin"]
+                properties["AFFINITY"] = cls.AFFINITY.get(pin, pin)
+        if settings.get("precision"):
+            properties["INFERENCE_PRECISION_HINT"] = settings["precision"]
+        return properties
+
+    def _export(self, path):
+        with open(path, "wb") as f:
+            f.write(self.compiled_model.export_model())
+
+    @property
+    def input_shape(self):
+        return self._input_shape
+
+    def input_buffer(self, request_id):
+        if self.device_preprocess:
+            return None
+        return self.requests[request_id].get_input_tensor(0).data
+
+    def start(self, request_id, image=None):
+        if self.device_preprocess and image is not None:
+            self._frames[request_id] = image
+            tensor = self._tensor(image, shared_memory=True)
+            self.requests[request_id].set_input_tensor(tensor)
+            image = None
+        if image is None:
+            self.requests[request_id].start_async()
+        else:
+            self.requests[request_id].start_async({0: image})
+
+    def wait(self, request_id):
+        # Failures are raised rather than returned as a status.
+        self.requests[request_id].wait()
+        return 0
+
+    def get_output(self, request_id):
+        return self.requests[request_id].get_output_tensor(0).data
+
+    def set_callback(self, callback):
+        for request_id, request in enumerate(self.requests):
+            request.set_callback(lambda request_id: callback(request_id, 0), request_id)
+        return True
+
+
+class OpenCVBackend(Backend):
+    """
+    OpenCV DNN on the same IR (needs OpenCV built with the Inference Engine).
+
+    `cv2.dnn` has no async API for every target, so requests run one after
+    the other on a worker thread; OpenCV releases the GIL meanwhile.
+    """
+
+    name = "opencv"
+
+    TARGETS = {
+        "CPU": "DNN_TARGET_CPU",
+        "GPU": "DNN_TARGET_OPENCL",
+        "MYRIAD": "DNN_TARGET_MYRIAD",
+    }
+
+    def load(
+        self,
+        model_xml,
+        model_bin,
+        device="CPU",
+        cpu_extension=None,
+        num_requests=1,
+        batch_size=None,
+        config=None,
+        device_preprocess=False,
+    ):
+        import cv2
+
+        # One worker runs the requests: more than one request only overlaps
+        # pre and post processing.
+        num_requests = self.num_requests = num_requests or 1
+        if device not in self.TARGETS:
+            raise ValueError(f"Device {device} is not supported by OpenCV DNN.")
+        self.net = cv2.dnn.readNet(model_xml, model_bin)
+        self.net.setPreferableTarget(getattr(cv2.dnn, self.TARGETS[device]))
+        self._input_shape = _batched(ir_input_shape(model_xml), batch_size)
+        self._inputs = [
+            np.zeros(self._input_shape, np.float32) for _ in range(num_requests)
+        ]
+        self._outputs = [None] * num_requests
+        self._futures = [None] * num_requests
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._callback = None
+
+    @property
+    def input_shape(self):
+        return self._input_shape
+
+    def input_buffer(self, request_id):
+        return self._inputs[request_id]
+
+    def _forward(self, request_id):
+        self.net.setInput(self._inputs[request_id])
+        self._outputs[request_id] = self.net.forward()
+
+    def start(self, request_id, image=None):
+        if image is not None:
+            np.copyto(self._inputs[request_id], image)
+        future = self._futures[request_id] = self._executor.submit(
+            self._forward, request_id
+        )
+        if self._callback is not None:
+            future.add_done_callback(
+                lambda future: self._callback(request_id, int(bool(future.exception())))
+            )
+
+    def wait(self, request_id):
+        self._futures[request_id].result()
+        return 0
+
+    def get_output(self, request_id):
+        return self._outputs[request_id]
+
+    def set_callback(self, callback):
+        self._callback = callback
+        return True
+
+
+def save_recording(path: str, input_shape: list, outputs: list):
+    """Save per-frame detector outputs for `ReplayBackend`.
+
+    :param input_shape: input shape of the model that produced them
+    :param outputs: one SSD output (any shape of rows of 7) per frame
+    """
+    frames = [np.asarray(output, np.float32).reshape(-1, 7) for output in outputs]
+    frames = [rows[rows[:, 0] >= 0] for rows in frames]
+    offsets = np.cumsum([0] + [len(rows) for rows in frames])
+    rows = np.concatenate(frames) if frames else np.empty((0, 7), np.float32)
+    np.savez_compressed(
+        path, input_shape=np.array(input_shape), rows=rows, offsets=offsets
+    )
+
+
+class ReplayBackend(Backend):
+    """
+    Deterministic stand-in that replays outputs saved with `save_recording`.
+
+    Frames get the recorded outputs in order, looping over the recording, so
+    the rest of the pipeline can be run, tested and benchmarked without the
+    toolkit. Without a recording, no frame has any detection.
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str = None, latency: float = 0.0, cache=None):
+        """
+        Params
+        ======
+        path: str (optional)
+            Recording made with `save_recording`.
+        latency: float
+            Seconds each request takes to complete, to mimic a real device.
+        """
+        super().__init__(cache)
+        self.path = path
+        self.latency = latency
+
+    def load(
+        self,
+        model_xml,
+        model_bin,
+        device="CPU",
+        cpu_extension=None,
+        num_requests=1,
+        batch_size=None,
+        config=None,
+        device_preprocess=False,
+    ):
+        num_requests = self.num_requests = num_requests or 1
+        # Inputs are not looked at, frames are taken as they are.
+        self.device_preprocess = device_preprocess
+        if self.path:
+            recording = np.load(self.path)
+            shape = list(recording["input_shape"])
+            self._rows = recording["rows"]
+            self._offsets = recording["offsets"]
+            if len(self._offsets) < 2:
+                raise ValueError(f"{self.path} has no recorded frame to replay.")
+        else:
+            shape = ir_input_shape(model_xml)
+            self._rows = np.empty((0, 7), np.float32)
+            self._offsets = np.zeros(2, np.int64)
+        self._input_shape = _batched(shape, batch_size)
+        self._inputs = [
+            np.zeros(self._input_shape, np.uint8) for _ in range(num_requests)
+        ]
+        self._outputs = [None] * num_requests
+        self._started = [0.0] * num_requests
+        self._next_frame = 0
+        self._callback = None
+
+    @property
+    def input_shape(self):
+        return self._input_shape
+
+    def input_buffer(self, request_id):
+        return self._inputs[request_id]
+
+    def start(self, request_id, image=None):
+        recorded = len(self._offsets) - 1
+        batch = []
+        for slot in range(self._input_shape[0]):
+            frame = self._next_frame % recorded
+            rows = self._rows[self._offsets[frame] : self._offsets[frame + 1]].copy()
+            rows[:, 0] = slot
+            batch.append(rows)
+            self._next_frame += 1
+        # An image_id of -1 ends the detections, as in the DetectionOutput layer.
+        batch.append(np.array([[-1, 0, 0, 0, 0, 0, 0]], np.float32))
+        self._outputs[request_id] = np.concatenate(batch).reshape(1, 1, -1, 7)
+        self._started[request_id] = time.perf_counter()
+        if self._callback is not None:
+            if self.latency > 0:
+                threading.Timer(self.latency, self._callback, (request_id, 0)).start()
+            else:
+                self._callback(request_id, 0)
+
+    def wait(self, request_id):
+        remaining = self._started[request_id] + self.latency - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        return 0
+
+    def get_output(self, request_id):
+        return self._outputs[request_id]
+
+    def set_callback(self, callback):
+        self._callback = callback
+        return True
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (
+        InferenceEngineBackend,
+        OpenVINOBackend,
+        OpenCVBackend,
+        ReplayBackend,
+    )
+}
+
+# Toolkit module of each backend, in the order "auto" tries them.
+_AUTO_MODULES = (
+    ("ie", "openvino.inference_engine"),
+    ("openvino", "openvino.runtime"),
+)
+
+
+def _importable(module: str) -> bool:
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ImportError:
+        return False
+
+
+def create_backend(
+    name: str = "auto",
+    replay: str = None,
+    latency: float = 0.0,
+    cache_dir: str = None,
+):
+    """Create a backend by name.
+
+    "auto" picks the replay backend if a `replay` recording is given, else the
+    first OpenVINO API installed, else OpenCV DNN.
+
+    :param replay: recording for the replay backend
+    :param latency: per-request latency of the replay backend, in seconds
+    :param cache_dir: directory of the compiled model cache, no caching if None
+    """
+    if name == "auto":
+        if replay:
+            name = "replay"
+        else:
+            name = next(
+                (name for name, module in _AUTO_MODULES if _importable(module)),
+                "opencv",
+            )
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown backend {name!r}, expected one of: auto, {', '.join(BACKENDS)}"
+        )
+    cache = ModelCache(cache_dir) if cache_dir else None
+    if name == "replay":
+        return ReplayBackend(replay, latency=latency, cache=cache)
+    return BACKENDS[name](cache=cache)
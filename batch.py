@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+"""Count the people of many videos, or of slices of a long one, on a process pool."""
+
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from batching import BatchScheduler
+from inference import Network
+from loguru import logger
+from main import build_argparser
+from model_registry import resolve_model
+from pipeline import StreamPipeline
+from profiles import performance_settings
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".m4v", ".mpg", ".mpeg", ".ts")
+MANIFEST_EXTENSIONS = (".txt", ".list")
+# Seconds a worker waits for its core set, which are all queued before the
+# pool starts.
+CORES_TIMEOUT = 10.0
+
+# Frames [start, end) of a video, counted after tracking from frame `first`
+# so that the people already in the frame at `start` are not counted again.
+# `end` is None to read to the end of the video.
+Segment = namedtuple("Segment", "video index first start end fps")
+
+# The network and options of a worker process, set by `_init_worker`.
+_worker = {}
+
+
+def build_batch_argparser():
+    """Parse command line arguments: those of main.py, and of the batch.
+
+    :return: command line arguments
+    """
+    parser = build_argparser()
+    parser.description = __doc__
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes, each with its own network. Defaults to the "
+        "available cores over --cores-per-worker.",
+    )
+    parser.add_argument(
+        "--cores-per-worker",
+        type=int,
+        default=None,
+        help="Cores each worker is pinned to and runs inference threads on. "
+        "Defaults to the available cores over --workers, or 1.",
+    )
+    parser.add_argument(
+        "--segment-seconds",
+        type=float,
+        default=None,
+        help="Split every video into segments of this length, counted in "
+        "parallel. Videos are counted whole by default.",
+    )
+    parser.add_argument(
+        "--segment-overlap",
+        type=float,
+        default=2.0,
+        help="Seconds tracked before each segment, and not counted, so that "
+        "people crossing a boundary are counted once (2 by default).",
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        help="Write the counts of every video to this JSON file.",
+    )
+    return parser
+
+
+def find_videos(paths: list) -> list:
+    """Expand `-i` into video files.
+
+    :param paths: video files, directories searched recursively for videos,
+        and manifests (.txt, .list) of one video per line, relative to the
+        manifest, with # comments
+    :return: paths of the videos, in order, each once
+    """
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, files in os.walk(path):
+                subdirectories.sort()
+                videos.extend(
+                    os.path.join(directory, filename)
+                    for filename in sorted(files)
+                    if filename.lower().endswith(VIDEO_EXTENSIONS)
+                )
+        elif path.lower().endswith(MANIFEST_EXTENSIONS):
+            root = os.path.dirname(path)
+            with open(path) as f:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        videos.append(os.path.join(root, line))
+        else:
+            videos.append(path)
+    return list(dict.fromkeys(os.path.normpath(video) for video in videos))
+
+
+def split_segments(video: str, args) -> list:
+    """The segments of `video` to count, see `Segment`.
+
+    Each segment is tracked from `--segment-overlap` seconds before it, at
+    least as many frames as a track takes to be confirmed and to end.
+    """
+    capture = cv2.VideoCapture(video)
+    if not capture.isOpened():
+        raise RuntimeError(f"Cannot open video source {video!r}.")
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    capture.release()
+    if not args.segment_seconds or frame_count <= 0:
+        return [Segment(video, 0, 0, 0, None, fps)]
+
+    length = max(int(round(args.segment_seconds * fps)), 1)
+    overlap = max(
+        int(round(args.segment_overlap * fps)),
+        args.track_max_age + args.track_min_hits + 1,
+    )
+    return [
+        Segment(
+            video,
+            index,
+            max(start - overlap, 0),
+            start,
+            min(start + length, frame_count),
+            fps,
+        )
+        for index, start in enumerate(range(0, frame_count, length))
+    ]
+
+
+def core_sets(workers: int, cores_per_worker: int, cpus: list) -> list:
+    """Split `cpus` into one set of `cores_per_worker` cores per worker.
+
+    Sets only share cores when there are not enough of them.
+    """
+    if workers * cores_per_worker > len(cpus):
+        logger.warning(
+            f"{workers} workers of {cores_per_worker} cores oversubscribe the "
+            f"{len(cpus)} available cores."
+        )
+    first_cores = range(0, workers * cores_per_worker, cores_per_worker)
+    return [
+        [cpus[(first + core) % len(cpus)] for core in range(cores_per_worker)]
+        for first in first_cores
+    ]
+
+
+def available_cpus() -> list:
+    """Cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _init_worker(args, cores_queue, cores_per_worker: int):
+    """Pin a worker to its cores and load its network."""
+    pin = args.pin != "NO"
+    try:
+        cores = cores_queue.get(timeout=CORES_TIMEOUT)
+    except queue.Empty:
+        # A worker the pool started again: the core sets are all taken.
+        logger.warning(f"Worker {os.getpid()} has no cores of its own, not pinned.")
+        cores = None
+        pin = False
+    if pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    settings = performance_settings(args)
+    # One inference thread per core of the worker, unless set explicitly.
+    if settings["nthreads"] is None:
+        settings["nthreads"] = len(cores) if cores else cores_per_worker
+    if settings["nstreams"] is None:
+        settings["nstreams"] = 1
+    if settings["pin"] is None and pin:
+        settings["pin"] = "YES"
+    network = Network(args.backend, replay=args.replay, cache_dir=args.model_cache)
+    network.load_model(
+        model_xml=args.model,
+        device=args.device,
+        cpu_extension=args.cpu_extension,
+        num_requests=settings["num_requests"],
+        batch_size=args.batch_size,
+        config=settings,
+        device_preprocess=args.preprocess == "device",
+    )
+    _worker.update(args=args, network=network, cores=cores)
+    logger.debug(f"Worker {os.getpid()} on cores {cores}")
+
+
+def count_segment(segment: Segment) -> dict:
+    """Count the people entering and leaving a segment, in a worker.
+
+    Frames are timed by their position in the video. The people already in
+    the frame at `segment.start` are timed from when the overlap first saw
+    them, so their durations are cut short to the time they spent in it.
+
+    :return: the people counted from `segment.start` on, or the error
+    """
+    args, network = _worker["args"], _worker["network"]
+    result = {
+        "video": segment.video,
+        "index": segment.index,
+        "start": segment.start,
+        "frames": 0,
+        "total_count": 0,
+        "durations": [],
+    }
+    start_time = time.perf_counter()
+    capture = cv2.VideoCapture(segment.video)
+    try:
+        if not capture.isOpened():
+            raise RuntimeError(f"Cannot open video source {segment.video!r}.")
+        width, height = int(capture.get(3)), int(capture.get(4))
+        if segment.first:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, segment.first)
+        pipeline = StreamPipeline.from_args(
+            args,
+            network,
+            width,
+            height,
+            scheduler=BatchScheduler(network, max_wait=float("inf")),
+        )
+        counter = pipeline.counter
+        # Frames still referenced by the requests in flight, or held behind
+        # them by the frame skipping, are not reused.
+        held = (network.num_requests + 1) * args.batch_size * args.detect_every
+        frames = [np.empty((height, width, 3), np.uint8) for _ in range(held + 1)]
+        # Counts when the segment starts, those before belong to the previous.
+        counted_before = None
+
+        index = segment.first
+        while segment.end is None or index < segment.end:
+            if index == segment.start:
+                pipeline.flush()
+                counted_before = (counter.total_count, len(counter.durations))
+            frame = frames[index % len(frames)]
+            grabbed, _ = capture.read(frame)
+            if not grabbed:
+                break
+            pipeline.process(frame, timestamp=index / segment.fps)
+            index += 1
+        pipeline.flush()
+
+        if counted_before is not None:
+            result["frames"] = index - segment.start
+            result["total_count"] = counter.total_count - counted_before[0]
+            result["durations"] = counter.durations[counted_before[1] :]
+    except Exception as err:
+        result["error"] = str(err)
+    finally:
+        capture.release()
+    result["end"] = segment.start + result["frames"]
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def merge_segments(videos: list, results: list) -> list:
+    """Add up the counts of the segments of every video, in order."""
+    merged = []
+    for video in videos:
+        segments = sorted(
+            (result for result in results if result["video"] == video),
+            key=lambda result: result["index"],
+        )
+        durations = [d for segment in segments for d in segment["durations"]]
+        errors = [segment["error"] for segment in segments if "error" in segment]
+        merged.append(
+            {
+                "video": video,
+                "segments": len(segments),
+                "frames": sum(segment["frames"] for segment in segments),
+                "total_count": sum(segment["total_count"] for segment in segments),
+                "durations": durations,
+                "mean_duration": float(np.mean(durations)) if durations else 0.0,
+                **({"errors": errors} if errors else {}),
+            }
+        )
+    return merged
+
+
+def main():
+    parser = build_batch_argparser()
+    args = parser.parse_args()
+    if not args.model or not args.input:
+        parser.error("-m/--model and -i/--input are required")
+    if args.sources or args.from_journal:
+        parser.error("batch counts the videos, directories and manifests of -i")
+    if args.journal:
+        parser.error("--journal is not supported by batch, segments overlap")
+    try:
+        args.model = resolve_model(
+            args.model, args.device, args.models_dir, args.model_precision
+        )
+    except ValueError as err:
+        parser.error(str(err))
+    videos = find_videos(args.input)
+    if not videos:
+        parser.error(f"No video found in {' '.join(args.input)}")
+
+    segments = []
+    for video in videos:
+        segments.extend(split_segments(video, args))
+    cpus = available_cpus()
+    cores_per_worker = args.cores_per_worker or (
+        max(len(cpus) // args.workers, 1) if args.workers else 1
+    )
+    workers = args.workers or max(len(cpus) // cores_per_worker, 1)
+    workers = min(workers, len(segments))
+    logger.info(
+        f"Counting {len(segments)} segments of {len(videos)} videos on {workers} "
+        f"workers of {cores_per_worker} cores..."
+    )
+
+    # OpenVINO does not survive a fork: workers start afresh.
+    context = multiprocessing.get_context("spawn")
+    cores_queue = context.Queue()
+    for cores in core_sets(workers, cores_per_worker, cpus):
+        cores_queue.put(cores)
+    results = []
+    start_time = time.perf_counter()
+    with context.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(args, cores_queue, cores_per_worker),
+    ) as pool:
+        # The longest segments first, for the workers to finish together;
+        # whole videos of unknown length before them.
+        ordered = sorted(
+            segments,
+            key=lambda segment: (
+                segment.end is not None,
+                segment.first - (segment.end or 0),
+            ),
+        )
+        for result in pool.imap_unordered(count_segment, ordered):
+            results.append(result)
+            where = f"{result['video']} [{result['start']}:{result['end']}]"
+            if "error" in result:
+                logger.error(f"{where}: {result['error']}")
+                continue
+            logger.info(
+                f"({len(results)}/{len(segments)}) {where}: "
+                f"{result['total_count']} people, "
+                f"{result['frames'] / result['seconds']:.1f} fps"
+            )
+    elapsed = time.perf_counter() - start_time
+
+    merged = merge_segments(videos, results)
+    frames = sum(video["frames"] for video in merged)
+    for video in merged:
+        logger.info(
+            f"{video['video']}: {video['total_count']} people in {video['frames']} "
+            f"frames, {video['mean_duration']:.1f}s on average"
+        )
+    logger.info(
+        f"Counted {frames} frames in {elapsed:.2f}s, {frames / elapsed:.1f} fps "
+        f"over {workers} workers."
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "config": {
+                        "model": args.model,
+                        "device": args.device,
+                        "workers": workers,
+                        "cores_per_worker": cores_per_worker,
+                        "segment_seconds": args.segment_seconds,
+                        "segment_overlap": args.segment_overlap,
+                        "prob_threshold": args.prob_threshold,
+                    },
+                    "seconds": elapsed,
+                    "fps": frames / elapsed,
+                    "videos": merged,
+                },
+                f,
+                indent=2,
+            )
+        logger.info(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,170 @@
+"""Dynamic batching of frames, across streams or consecutive frames of one."""
+
+import time
+
+import cv2
+import numpy as np
+
+from preprocess import Preprocessor
+
+
+def split_batch(result: np.ndarray, batch: int) -> list:
+    """Scatter a batched SSD output back to the images it came from.
+
+    The DetectionOutput layer stacks the detections of every image of the
+    batch in one 1x1xNx7 blob, with the image index in the first column.
+
+    :return: one Nx7 array of rows per image of the batch
+    """
+    boxes = np.asarray(result).reshape(-1, 7)
+    image_ids = boxes[:, 0]
+    return [boxes[image_ids == index] for index in range(batch)]
+
+
+class BatchScheduler:
+    """
+    Fill the infer requests of a `Network` with up to `batch_size` frames.
+
+    Frames are preprocessed straight into their slot of the next request's
+    input blob. When the network preprocesses on the device, frames are
+    submitted as they are instead: alone without any copy, or copied into a
+    batch of frames of the size of the first one.
+
+    A batch is submitted once it holds `batch_size` frames, or once its
+    oldest frame waited `max_wait` seconds (see `poll`). The network must
+    have been loaded with the same `batch_size`.
+
+    `add`, `collect` and `drain` return the results they completed as a list
+    of `(userdata, rows)`, in submission order, where `rows` are the output
+    rows of that frame only.
+    """
+
+    def __init__(self, network: object, max_wait: float = 0.01):
+        """
+        Params
+        ======
+        network: Network
+            A loaded network.
+        max_wait: float
+            Longest time, in seconds, a partial batch waits for more frames.
+        """
+        self.network = network
+        self.max_wait = max_wait
+        input_shape = network.get_input_shape()
+        self.batch_size = input_shape[0]
+        if network.device_preprocess:
+            self.preprocess = self._stack
+            # Batches of frames, per request, reallocated when the size changes.
+            self._batches = {}
+        else:
+            self.preprocess = Preprocessor(input_shape)
+            # Used when the Inference Engine does not expose the request blobs.
+            self._fallback_buffer = np.empty(input_shape, dtype=np.uint8)
+        self._buffer = None
+        # Whether the buffer must be given to `submit`, not being a request blob.
+        self._submit_buffer = False
+        self._userdata = []
+        self._deadline = None
+        # Seconds the last frame added took to preprocess.
+        self.preprocess_time = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        """Frames waiting in the current batch or in the infer requests."""
+        return len(self._userdata) + self.network.in_flight
+
+    def timeout(self):
+        """Seconds until the current partial batch is due, None if it is empty."""
+        if self._deadline is None:
+            return None
+        return max(self._deadline - time.time(), 0)
+
+    def add(self, frame: np.ndarray, userdata: object = None) -> list:
+        """Preprocess `frame` into the current batch, submitting it once full."""
+        results = []
+        if not self._userdata:
+            # Starting a batch claims the next request, so it must be free.
+            if self.network.is_full():
+                results = self.collect()
+            self._start_batch(frame)
+            self._deadline = time.time() + self.max_wait
+
+        slot = len(self._userdata)
+        start_preprocess = time.perf_counter()
+        if self.batch_size > 1 or not self.network.device_preprocess:
+            self.preprocess(frame, out=self._buffer[slot : slot + 1])
+        self.preprocess_time = time.perf_counter() - start_preprocess
+        self._userdata.append(userdata)
+        if len(self._userdata) == self.batch_size:
+            self.flush()
+        return results
+
+    def _start_batch(self, frame: np.ndarray):
+        """Pick the buffer the batch starting with `frame` is written to."""
+        self._submit_buffer = True
+        if not self.network.device_preprocess:
+            self._buffer = self.network.input_buffer()
+            if self._buffer is None:
+                self._buffer = self._fallback_buffer
+            else:
+                self._submit_buffer = False
+        elif self.batch_size == 1:
+            # The frame itself is the input, it stays untouched until collected.
+            self._buffer = frame[np.newaxis]
+        else:
+            request_id = self.network.next_request
+            shape = (self.batch_size,) + frame.shape
+            batch = self._batches.get(request_id)
+            if batch is None or batch.shape != shape:
+                batch = self._batches[request_id] = np.empty(shape, np.uint8)
+            self._buffer = batch
+
+    @staticmethod
+    def _stack(frame: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Copy `frame` into its slot of a batch of frames.
+
+        Frames of another size than the first of the batch (another stream)
+        are resized to it, the device resizes the batch to the input.
+        """
+        height, width = out.shape[1:3]
+        if frame.shape[:2] == (height, width):
+            np.copyto(out[0], frame)
+        else:
+            cv2.resize(frame, (width, height), dst=out[0])
+        return out
+
+    def flush(self) -> bool:
+        """Submit the current batch, even if it is not full.
+
+        :return: whether a batch was submitted
+        """
+        if not self._userdata:
+            return False
+        image = self._buffer if self._submit_buffer else None
+        self.network.submit(image, userdata=self._userdata)
+        self._userdata = []
+        self._deadline = None
+        return True
+
+    def poll(self) -> bool:
+        """Submit the current batch if it waited `max_wait`.
+
+        :return: whether a batch was submitted
+        """
+        if self._deadline is not None and time.time() >= self._deadline:
+            return self.flush()
+        return False
+
+    def collect(self) -> list:
+        """Wait for the oldest submitted batch and scatter its results."""
+        userdata, result = self.network.collect()
+        rows = split_batch(result, self.batch_size) if self.batch_size > 1 else [result]
+        return list(zip(userdata, rows))
+
+    def drain(self) -> list:
+        """Submit the partial batch and wait for every request in flight."""
+        self.flush()
+        results = []
+        while self.network.in_flight:
+            results.extend(self.collect())
+        return results
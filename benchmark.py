@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+"""Benchmark the people counter pipeline, stage by stage."""
+
+import copy
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from backends import save_recording
+from batching import BatchScheduler
+from counter import make_counter
+from detections import draw_detections, parse_detections
+from inference import Network
+from main import build_argparser, frame_size
+from model_registry import (
+    BASELINE,
+    find_variants,
+    resolve_model,
+    supported_variants,
+    toolkit_version,
+)
+from profiling import StageTimer, peak_rss_mb
+from profiles import host_key, performance_settings, save_tuned, tune_candidates
+from publisher import StatsPublisher
+from loguru import logger
+
+DEFAULT_VIDEO = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "resources",
+    "Pedestrian_Detect_2_1_1.mp4",
+)
+STAGES = ("decode", "preprocess", "infer", "postprocess", "publish", "encode", "total")
+
+
+def build_benchmark_argparser():
+    """Parse command line arguments: those of main.py, and of the benchmark.
+
+    :return: command line arguments
+    """
+    parser = build_argparser()
+    parser.description = __doc__
+    parser.set_defaults(input=[DEFAULT_VIDEO])
+    parser.add_argument(
+        "--synthetic",
+        type=frame_size,
+        default=None,
+        metavar="WxH",
+        help="Use generated frames of this size instead of --input, e.g. 1920x1080.",
+    )
+    parser.add_argument(
+        "-n",
+        "--frames",
+        type=int,
+        default=None,
+        help="Frames to process, the input is rewound as needed. The whole "
+        "input by default, 500 frames with --synthetic.",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Frames processed before measuring (10 by default)",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=float,
+        default=0.0,
+        help="Milliseconds each request takes with the replay backend (0 by default)",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Record the detector outputs of every frame to this .npz file, for "
+        "--replay.",
+    )
+    parser.add_argument(
+        "--encode",
+        type=str,
+        default="mp4v",
+        help="Codec to encode the annotated frames with, inline, or 'none' "
+        "(mp4v by default)",
+    )
+    parser.add_argument(
+        "--tune",
+        action="store_true",
+        help="Benchmark a range of --nstreams and --num-requests settings, on "
+        "--frames frames each, and save the fastest for --profile tuned.",
+    )
+    parser.add_argument(
+        "--variants",
+        action="store_true",
+        help="Benchmark every variant of the --model name the device runs, and "
+        "compare their counts with those of the FP32 one.",
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        help="Write the results to this JSON file.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="JSON results of a previous run to compare this one with.",
+    )
+    return parser
+
+
+class NullClient:
+    """MQTT client stand-in that accepts and discards every message."""
+
+    class _Info:
+        rc = 0
+
+    def publish(self, topic, payload):
+        return self._Info()
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def synthetic_frames(width: int, height: int, count: int = 30):
+    """Generate a loop of noisy frames with a few moving boxes.
+
+    The frames are generated once, "decoding" one is copying it.
+    """
+    rng = np.random.RandomState(0)
+    frames = []
+    for index in range(count):
+        frame = rng.randint(0, 64, (height, width, 3), dtype=np.uint8)
+        for box in range(3):
+            x = (index * 8 + box * width // 3) % width
+            y = height // 4 + box * height // 6
+            cv2.rectangle(
+                frame, (x, y), (x + width // 10, y + height // 3), (200, 180, 160), -1
+            )
+        frames.append(frame)
+    return frames
+
+
+def run_benchmark(args, settings: dict = None) -> dict:
+    """Run the pipeline on `args.frames` frames and measure every stage.
+
+    Stages run as in `main.infer_on_stream`, but decoding and encoding are
+    inline so that their cost is measured:
+
+    * decode: reading a frame from the video (copying a synthetic frame)
+    * preprocess: resize and layout change into the input blob (with
+      --preprocess device, only the copy of a frame into its batch)
+    * infer: from submitting a frame to having its result, batching included
+    * postprocess: parsing, tracking and counting, publishing included
+    * publish: handing the stats to the MQTT publisher
+    * encode: annotating and writing the frame to a video
+    * total: from decoding a frame to having encoded it
+
+    :param settings: performance settings, those of `args` by default
+    :return: results, as written to the JSON file
+    """
+    settings = settings or performance_settings(args)
+    network = Network(
+        args.backend,
+        replay=args.replay,
+        latency=args.replay_latency / 1000,
+        cache_dir=args.model_cache,
+    )
+    network.load_model(
+        model_xml=args.model,
+        device=args.device,
+        cpu_extension=args.cpu_extension,
+        num_requests=settings["num_requests"],
+        batch_size=args.batch_size,
+        config=settings,
+        device_preprocess=args.preprocess == "device",
+    )
+    timer = StageTimer()
+    scheduler = BatchScheduler(network, max_wait=float("inf"))
+    scheduler.preprocess = timer.timed("preprocess", scheduler.preprocess)
+
+    capture = None
+    if args.synthetic:
+        width, height = args.synthetic
+        generated = synthetic_frames(width, height)
+        total_frames = args.frames or 500
+    else:
+        capture = cv2.VideoCapture(args.input)
+        if not capture.isOpened():
+            raise RuntimeError(f"Cannot open video source {args.input!r}.")
+        width, height = int(capture.get(3)), int(capture.get(4))
+        total_frames = args.frames or int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    # Frames still referenced by the requests in flight are not reused.
+    frames = [
+        np.empty((height, width, 3), np.uint8)
+        for _ in range((network.num_requests + 1) * args.batch_size + 1)
+    ]
+
+    publisher = StatsPublisher(NullClient()).start()
+    publisher.update = timer.timed("publish", publisher.update)
+    publisher.publish = timer.timed("publish", publisher.publish)
+    counter = make_counter(args, publisher, width, height)
+    classes = tuple(args.classes)
+    # People counted in every frame, warm up included, to compare models.
+    counts = []
+
+    workdir = tempfile.TemporaryDirectory()
+    writer = None
+    if args.encode.lower() != "none":
+        writer = cv2.VideoWriter(
+            os.path.join(workdir.name, "benchmark.mp4"),
+            cv2.VideoWriter_fourcc(*args.encode),
+            30,
+            (width, height),
+        )
+
+    done = 0
+    start_time = time.perf_counter()
+    recorded = []
+
+    def handle_result(userdata, result):
+        nonlocal done, start_time
+        frame, decoded, submitted = userdata
+        timer.record("infer", time.perf_counter() - submitted)
+        if args.record:
+            recorded.append(result)
+        with timer.time("postprocess"):
+            detections = parse_detections(
+                result, args.prob_threshold, width, height, classes=classes
+            )
+            counts.append(counter.update(detections))
+        if writer is not None:
+            with timer.time("encode"):
+                draw_detections(frame, detections)
+                writer.write(frame)
+        timer.record("total", time.perf_counter() - decoded)
+        done += 1
+        if done == args.warmup and done:
+            timer.reset()
+            start_time = time.perf_counter()
+
+    for index in range(args.warmup + total_frames):
+        decoded = time.perf_counter()
+        with timer.time("decode"):
+            frame = frames[index % len(frames)]
+            if capture is None:
+                np.copyto(frame, generated[index % len(generated)])
+            else:
+                grabbed, _ = capture.read(frame)
+                if not grabbed:
+                    # Rewind, to run more frames than the video has.
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    grabbed, _ = capture.read(frame)
+                if not grabbed:
+                    raise RuntimeError(f"Cannot read from {args.input!r}.")
+        userdata = [frame, decoded, None]
+        results = scheduler.add(frame, userdata=userdata)
+        userdata[2] = time.perf_counter()
+        for result in results:
+            handle_result(*result)
+    for result in scheduler.drain():
+        handle_result(*result)
+    elapsed = time.perf_counter() - start_time
+
+    publisher.stop()
+    if args.record:
+        save_recording(args.record, network.get_input_shape(), recorded)
+        logger.info(f"Recorded the outputs of {len(recorded)} frames to {args.record}")
+    if writer is not None:
+        writer.release()
+    workdir.cleanup()
+    if capture is not None:
+        capture.release()
+
+    return {
+        "config": {
+            "model": args.model,
+            "model_size_mb": network._model_size,
+            "input": "x".join(map(str, args.synthetic or ())) or args.input,
+            "backend": network.backend.name,
+            "device": args.device,
+            "settings": settings,
+            "num_requests": network.num_requests,
+            "device_preprocess": network.device_preprocess,
+            "batch_size": args.batch_size,
+            "encode": args.encode,
+            "frames": total_frames,
+            "warmup": args.warmup,
+        },
+        "seconds": elapsed,
+        "fps": total_frames / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": timer.summary(),
+        "counts": counts,
+        "total_count": counter.total_count,
+    }
+
+
+def report(results: dict, baseline: dict = None):
+    """Log the results, with the change from `baseline` if given."""
+
+    def change(new, old):
+        if not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    baseline = baseline or {"stages": {}}
+    stages = results["stages"]
+    logger.info(f"{'stage':<12}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9} ms")
+    for stage in sorted(stages, key=STAGES.index):
+        stats = stages[stage]
+        logger.info(
+            f"{stage:<12}"
+            + "".join(
+                f"{stats[key]:9.2f}"
+                for key in ("mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms")
+            )
+            + change(
+                stats["p50_ms"], baseline["stages"].get(stage, {}).get("p50_ms")
+            )
+        )
+    fps = results["fps"]
+    logger.info(f"Throughput: {fps:.2f} fps{change(fps, baseline.get('fps'))}")
+    if results["peak_rss_mb"] is not None:
+        logger.info(f"Peak RSS: {results['peak_rss_mb']:.1f}MB")
+
+
+def tune(args) -> dict:
+    """Benchmark the candidate settings of this host and save the fastest.
+
+    :return: the fastest settings
+    """
+    results = []
+    for settings in tune_candidates():
+        logger.info(f"Trying {settings}")
+        try:
+            results.append((run_benchmark(args, settings)["fps"], settings))
+        except Exception as err:
+            # Not every device supports every setting.
+            logger.warning(f"Failed with {settings}: {err}")
+    if not results:
+        raise RuntimeError("No candidate settings could be benchmarked.")
+    for fps, settings in sorted(results, key=lambda result: result[0]):
+        logger.info(f"{fps:8.2f} fps: {settings}")
+    fps, best = max(results, key=lambda result: result[0])
+    key = host_key(args.device, args.model)
+    save_tuned(key, best, args.tuned_profiles)
+    logger.info(
+        f"Saved {best} ({fps:.2f} fps) for {key} to {args.tuned_profiles}, "
+        "use it with --profile tuned."
+    )
+    return best
+
+
+def count_agreement(counts: list, baseline: list) -> float:
+    """Fraction of the frames with as many people counted as in `baseline`."""
+    frames = min(len(counts), len(baseline))
+    if not frames:
+        return None
+    return float(np.mean(np.equal(counts[:frames], baseline[:frames])))
+
+
+def compare_variants(args) -> list:
+    """Benchmark the variants of the --model name and compare them.
+
+    Every variant runs over the same frames; its counts are compared with
+    those of the newest FP32 variant.
+
+    :return: one row per variant, as written to the JSON file
+    """
+    variants = supported_variants(
+        find_variants(args.model, args.models_dir), args.device, toolkit_version()
+    )
+    if not variants:
+        raise ValueError(
+            f"No variant of {args.model!r} in {args.models_dir} runs on {args.device}."
+        )
+    rows = []
+    for variant in variants:
+        logger.info(f"Benchmarking {variant.precision} {variant.xml}")
+        variant_args = copy.copy(args)
+        variant_args.model = variant.xml
+        try:
+            results = run_benchmark(variant_args)
+        except Exception as err:
+            logger.warning(f"Failed with {variant.xml}: {err}")
+            continue
+        rows.append({"variant": variant._asdict(), "results": results})
+
+    baseline = next(
+        (row["results"] for row in rows if row["variant"]["precision"] == BASELINE),
+        None,
+    )
+    if baseline is None:
+        logger.warning(f"No {BASELINE} variant to compare the counts with.")
+    logger.info(
+        f"{'precision':<11}{'version':<12}{'size':>8}{'infer p50':>11}{'total p50':>11}"
+        f"{'fps':>9}{'agreement':>11}{'total':>7}"
+    )
+    for row in rows:
+        variant, results = row["variant"], row["results"]
+        row["agreement"] = None
+        if baseline is not None:
+            row["agreement"] = count_agreement(results["counts"], baseline["counts"])
+        agreement = "" if row["agreement"] is None else f"{row['agreement']:.1%}"
+        logger.info(
+            f"{variant['precision']:<11}{variant['version'] or '?':<12}"
+            f"{results['config']['model_size_mb']:6.2f}MB"
+            f"{results['stages']['infer']['p50_ms']:9.2f}ms"
+            f"{results['stages']['total']['p50_ms']:9.2f}ms"
+            f"{results['fps']:9.2f}{agreement:>11}{results['total_count']:>7}"
+        )
+    return rows
+
+
+def main():
+    parser = build_benchmark_argparser()
+    args = parser.parse_args()
+    if not args.model:
+        parser.error("the following arguments are required: -m/--model")
+    if len(args.input) > 1 or args.sources:
+        parser.error("benchmark one video at a time")
+    args.input = args.input[0]
+    if args.variants:
+        rows = compare_variants(args)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(rows, f, indent=2)
+            logger.info(f"Results written to {args.json}")
+        return
+    try:
+        args.model = resolve_model(
+            args.model, args.device, args.models_dir, args.model_precision
+        )
+    except ValueError as err:
+        parser.error(str(err))
+    if args.tune:
+        tune(args)
+        return
+    results = run_benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+
+    main()
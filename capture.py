@@ -0,0 +1,158 @@
+"""Threaded frame decoding ahead of the inference loop."""
+
+import re
+import threading
+import time
+
+from collections import deque
+
+import numpy as np
+
+from loguru import logger
+
+# Sources that produce frames in real time: camera indices and network streams.
+_LIVE_SOURCE = re.compile(r"^(\d+|CAM|(rtsp|rtmp|http|https|udp|tcp)://.*)$", re.I)
+
+
+def is_live_source(source: str) -> bool:
+    """Whether `source` is a camera or network stream rather than a file."""
+    return bool(_LIVE_SOURCE.match(str(source)))
+
+
+def should_drop_oldest(policy: str, source: str) -> bool:
+    """Resolve a `--decode-policy` value ("auto", "block" or "drop") for `source`."""
+    if policy == "auto":
+        return is_live_source(source)
+    return policy == "drop"
+
+
+class FrameGrabber:
+    """
+    Decode frames from a `cv2.VideoCapture` on a background thread.
+
+    Frames are decoded into a pool of preallocated buffers and handed to the
+    consumer through a bounded queue. The consumer must give each frame back
+    with `release` once it is done with it, so its buffer can be reused.
+
+    When the queue is full the producer either blocks (file sources, no frame
+    is lost) or drops the oldest queued frame (live sources, latency stays
+    bounded).
+    """
+
+    def __init__(
+        self,
+        stream: object,
+        queue_size: int = 4,
+        drop_oldest: bool = False,
+        num_held: int = 1,
+    ):
+        """
+        Params
+        ======
+        stream: cv2.VideoCapture
+            An opened capture.
+        queue_size: int
+            Maximum number of decoded frames waiting for the consumer.
+        drop_oldest: bool
+            Drop the oldest queued frame instead of blocking when the queue is full.
+        num_held: int
+            Maximum number of frames the consumer holds at once, e.g. frames in
+            flight in the infer requests. Sizes the buffer pool.
+        """
+        if queue_size < 1:
+            raise ValueError(f"queue_size must be >= 1, got {queue_size}")
+        self.stream = stream
+        self.queue_size = queue_size
+        self.drop_oldest = drop_oldest
+        self.frames_dropped = 0
+        # `metrics.StreamMetrics` to observe the decode times with, if any.
+        self.metrics = None
+
+        width, height = int(stream.get(3)), int(stream.get(4))
+        self._free = deque(
+            np.empty((height, width, 3), dtype=np.uint8)
+            for _ in range(queue_size + num_held)
+        )
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._eos = False
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="frame-grabber", daemon=True
+        )
+
+    def start(self):
+        """Start decoding in the background."""
+        self._thread.start()
+        return self
+
+    def _next_buffer(self):
+        """Return a free buffer, or None once stopped. Must hold `_cond`."""
+        while not self._free and not self._stopped:
+            if self.drop_oldest and self._ready:
+                self._free.append(self._ready.popleft())
+                self.frames_dropped += 1
+            else:
+                self._cond.wait()
+        return None if self._stopped else self._free.popleft()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                buffer = self._next_buffer()
+            if buffer is None:
+                break
+            # Decode outside the lock, straight into the preallocated buffer.
+            start_decode = time.perf_counter()
+            grabbed, frame = self.stream.read(buffer)
+            if grabbed and self.metrics:
+                self.metrics.decode.observe(time.perf_counter() - start_decode)
+            with self._cond:
+                if not grabbed:
+                    self._eos = True
+                    self._cond.notify_all()
+                    break
+                self._ready.append(frame)
+                self._cond.notify_all()
+        if self.frames_dropped:
+            logger.warning(f"Dropped {self.frames_dropped} frames, consumer too slow.")
+
+    def read(self, timeout: float = None):
+        """Return the next decoded frame, blocking until one is available.
+
+        :param timeout: seconds to wait for a frame, None waits indefinitely.
+        :return: (grabbed, frame) as `cv2.VideoCapture.read`. (False, None) at
+            the end of the stream, or on timeout (see `finished`).
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._ready or self._eos or self._stopped, timeout
+            )
+            if not self._ready:
+                return False, None
+            return True, self._ready.popleft()
+
+    @property
+    def finished(self) -> bool:
+        """True once the stream ended and every decoded frame was read."""
+        with self._cond:
+            return (self._eos or self._stopped) and not self._ready
+
+    def release(self, frame: np.ndarray):
+        """Give a frame returned by `read` back to the buffer pool."""
+        with self._cond:
+            self._free.append(frame)
+            self._cond.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of decoded frames waiting for the consumer."""
+        return len(self._ready)
+
+    def stop(self):
+        """Stop the decode thread and wait for it to exit."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,140 @@
+"""Per-stream people counting state and its MQTT messages."""
+
+import time
+
+import numpy as np
+
+from detections import detection_boxes
+from tracker import Tracker, centroids
+from zones import ZoneCounter
+
+
+class PersonCounter:
+    """
+    Count people entering and leaving one stream from per-frame detections.
+
+    Detections are tracked across frames, so a person missed by the detector
+    for a few frames is neither counted twice nor cut short: entries, exits
+    and dwell times come from the lifetimes of the tracks.
+
+    Each stream owns one counter, so several streams can share a process (and
+    an MQTT client) without mixing their statistics.
+    """
+
+    def __init__(
+        self,
+        publisher: object = None,
+        topic: str = "person",
+        tracker: Tracker = None,
+        zones: object = None,
+    ):
+        """
+        Params
+        ======
+        publisher: StatsPublisher (optional)
+            Publisher of the stats, nothing is published if None.
+        topic: str
+            Base MQTT topic, durations go to `<topic>/duration`.
+        tracker: Tracker (optional)
+            Defaults to an IoU `Tracker` with default settings.
+        zones: ZoneCounter (optional)
+            Lines and polygons to count tracks through, their counts go to
+            `<topic>/line/<name>` and `<topic>/zone/<name>`.
+        """
+        self.publisher = publisher
+        self.topic = topic
+        self.tracker = tracker if tracker is not None else Tracker()
+        self.zones = zones
+        self.last_count = 0
+        self.total_count = 0
+        self.durations = []
+        # Whether people appeared or left on the latest detector frame.
+        self.active = False
+        # Whether people were counted in or out on the latest frame.
+        self.event = False
+
+    def publish(self, subtopic: str, payload: dict, event: bool = False):
+        """Publish `payload` under this counter's topic.
+
+        :param event: publish every message, rather than only the latest state
+        """
+        if self.publisher is not None:
+            topic = f"{self.topic}/{subtopic}" if subtopic else self.topic
+            if event:
+                self.publisher.publish(topic, payload)
+            else:
+                self.publisher.update(topic, payload)
+
+    def update(self, detections: np.ndarray, timestamp: float = None) -> int:
+        """Update the counts with the parsed detections of the latest frame.
+
+        :param detections: structured array from `parse_detections`
+        :param timestamp: time of the frame in seconds, defaults to now
+        :return: number of people currently in the frame
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        entered, exited = self.tracker.update(detection_boxes(detections), timestamp)
+
+        # Check when a person enters the video the first time.
+        if len(entered):
+            self.total_count += len(entered)
+            self.publish("", {"total": self.total_count})
+
+        for _, duration in exited:
+            self.durations.append(duration)
+            # Publish messages to the MQTT server
+            self.publish("duration", {"duration": int(duration)}, event=True)
+
+        self.event = bool(len(entered) or exited)
+        # Tracks not yet confirmed are people who may be appearing.
+        self.active = bool(len(entered) or exited or not self.tracker.confirmed.all())
+        return self._publish_count()
+
+    def predict(self) -> int:
+        """Update the counts on a frame the detector skipped.
+
+        Tracks are moved along their motion model, no track starts or ends.
+
+        :return: number of people currently in the frame
+        """
+        self.tracker.predict()
+        self.event = False
+        return self._publish_count()
+
+    def _publish_count(self) -> int:
+        """Count the tracks through the zones and publish the current count."""
+        if self.zones:
+            visible = self.tracker.visible
+            lines, zones = self.zones.update(
+                self.tracker.ids[visible],
+                centroids(self.tracker.boxes[visible]),
+                live_ids=self.tracker.ids,
+            )
+            for name in lines:
+                self.publish(f"line/{name}", self.zones.line_stats(name))
+            for name in zones:
+                self.publish(f"zone/{name}", self.zones.zone_stats(name))
+
+        # People missed for a few frames are still in the frame.
+        current_count = int(self.tracker.confirmed.sum())
+        self.publish("", {"count": current_count})
+        self.last_count = current_count
+        return current_count
+
+
+def make_counter(
+    args, publisher, width: int, height: int, topic: str = "person"
+) -> PersonCounter:
+    """A `PersonCounter` with the tracker and zones of the command line."""
+    return PersonCounter(
+        publisher,
+        topic=topic,
+        tracker=Tracker(
+            metric=args.track_metric,
+            max_age=args.track_max_age,
+            min_hits=args.track_min_hits,
+        ),
+        zones=(
+            ZoneCounter.from_config(args.zones, width, height) if args.zones else None
+        ),
+    )
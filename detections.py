@@ -0,0 +1,180 @@
+"""Post-processing of SSD detection outputs."""
+
+import cv2
+import numpy as np
+
+# https://github.com/opencv/opencv/blob/master/samples/data/dnn/object_detection_classes_coco.txt
+CATEGORIES = (
+    "null",
+    "person",
+    "bicycle",
+    "car",
+    "motorcycle",
+    "airplane",
+    "bus",
+    "train",
+    "truck",
+    "boat",
+    "traffic light",
+    "fire hydrant",
+    "street sign",
+    "stop sign",
+    "parking meter",
+    "bench",
+    "bird",
+    "cat",
+    "dog",
+    "horse",
+    "sheep",
+    "cow",
+    "elephant",
+    "bear",
+    "zebra",
+    "giraffe",
+    "hat",
+    "backpack",
+    "umbrella",
+    "shoe",
+    "eye glasses",
+    "handbag",
+    "tie",
+    "suitcase",
+    "frisbee",
+    "skis",
+    "snowboard",
+    "sports ball",
+    "kite",
+    "baseball bat",
+    "baseball glove",
+    "skateboard",
+    "surfboard",
+    "tennis racket",
+    "bottle",
+    "plate",
+    "wine glass",
+    "cup",
+    "fork",
+    "knife",
+    "spoon",
+    "bowl",
+    "banana",
+    "apple",
+    "sandwich",
+    "orange",
+    "broccoli",
+    "carrot",
+    "hot dog",
+    "pizza",
+    "donut",
+    "cake",
+    "chair",
+    "couch",
+    "potted plant",
+    "bed",
+    "mirror",
+    "dining table",
+    "window",
+    "desk",
+    "toilet",
+    "door",
+    "tv",
+    "laptop",
+    "mouse",
+    "remote",
+    "keyboard",
+    "cell phone",
+    "microwave",
+    "oven",
+    "toaster",
+    "sink",
+    "refrigerator",
+    "blender",
+    "book",
+    "clock",
+    "vase",
+    "scissors",
+    "teddy bear",
+    "hair drier",
+    "toothbrush",
+)
+
+PERSON = 1
+
+# One row per detection kept after filtering, in frame pixel coordinates.
+DETECTION_DTYPE = np.dtype(
+    [
+        ("label", np.int32),
+        ("conf", np.float32),
+        ("xmin", np.int32),
+        ("ymin", np.int32),
+        ("xmax", np.int32),
+        ("ymax", np.int32),
+    ]
+)
+
+
+def parse_detections(
+    result: np.ndarray,
+    prob_threshold: float,
+    width: int,
+    height: int,
+    classes: tuple = (PERSON,),
+) -> np.ndarray:
+    """Filter and scale raw SSD output in a few array operations.
+
+    As per: https://github.com/opencv/open_model_zoo/blob/7d235755e2d17f6186b11243a169966e4f05385a/models/public/ssd_mobilenet_v2_coco/ssd_mobilenet_v2_coco.md#converted-model-1
+    each row of the 1x1xNx7 output is
+    [image_id, label, conf, x_min, y_min, x_max, y_max] with normalised coordinates.
+
+    :param result: raw network output, any shape reshapeable to Nx7
+    :param prob_threshold: minimum confidence to keep a detection
+    :param width: frame width, in pixels
+    :param height: frame height, in pixels
+    :param classes: labels to keep, None keeps every label
+    :return: structured array of `DETECTION_DTYPE`
+    """
+    boxes = np.asarray(result, dtype=np.float32).reshape(-1, 7)
+    labels = boxes[:, 1].astype(np.int32)
+    # image_id is -1 on the padding rows after the last detection.
+    mask = (boxes[:, 2] >= prob_threshold) & (boxes[:, 0] >= 0)
+    if classes is not None:
+        mask &= np.isin(labels, classes)
+
+    kept = boxes[mask]
+    detections = np.empty(len(kept), dtype=DETECTION_DTYPE)
+    detections["label"] = labels[mask]
+    detections["conf"] = kept[:, 2]
+    scale = np.array([width, height, width, height], dtype=np.float32)
+    coords = (kept[:, 3:7] * scale).astype(np.int32)
+    detections["xmin"] = coords[:, 0]
+    detections["ymin"] = coords[:, 1]
+    detections["xmax"] = coords[:, 2]
+    detections["ymax"] = coords[:, 3]
+    return detections
+
+
+def detection_boxes(detections: np.ndarray) -> np.ndarray:
+    """Nx4 float array of [xmin, ymin, xmax, ymax] of parsed detections."""
+    return np.stack(
+        [detections[field] for field in ("xmin", "ymin", "xmax", "ymax")], axis=1
+    ).astype(np.float32)
+
+
+def draw_detections(frame: np.ndarray, detections: np.ndarray, loc: int = 10):
+    """Draw bounding boxes and labels of parsed detections onto the frame."""
+    for label, conf, xmin, ymin, xmax, ymax in detections.tolist():
+        name = CATEGORIES[label] if 0 <= label < len(CATEGORIES) else str(label)
+        _y = ymax - loc if ymax - loc > loc else ymax + loc
+
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 0, 255), 1)
+
+        cv2.putText(
+            frame,
+            f"{name.title()}: {conf *100:.2f}%",
+            (xmin, _y),
+            cv2.FONT_HERSHEY_COMPLEX,
+            fontScale=0.5,
+            color=(127, 255, 127),
+            thickness=1,
+        )
+    return frame
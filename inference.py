@@ -23,11 +23,12 @@
 """
 
 import os
-import sys
+
+from collections import deque
 
 import numpy as np
 
-from openvino.inference_engine import IENetwork, IECore
+from backends import Backend, create_backend
 
 
 class Network:
@@ -36,18 +37,34 @@ class Network:
     and performs synchronous and asynchronous modes for the specified infer requests.
     """
 
-    def __init__(self):
-        # Initialize the plugin
-        # https://docs.openvinotoolkit.org/latest/ie_python_api/classie__api_1_1IECore.html
-        self.ie_core = IECore()
-        self.network = None
-        self.exec_network = None
-        self._input_blob = None
-        self._output_blob = None
-        self.infer_request = None
+    def __init__(self, backend: object = "auto", **options):
+        """
+        Params
+        ======
+        backend: str or Backend
+            A `Backend`, or the name of one for `backends.create_backend`:
+            "auto", "ie", "openvino", "opencv" or "replay".
+        options:
+            Passed on to `backends.create_backend`.
+        """
+        if not isinstance(backend, Backend):
+            backend = create_backend(backend, **options)
+        self.backend = backend
+        self.num_requests = 1
+        self.device_preprocess = False
+        # Ring buffer of in-flight requests, oldest first: (request_id, userdata)
+        self._pending = deque()
+        self._next_request = 0
 
     def load_model(
-        self, model_xml: str, device: str = "CPU", cpu_extension=None
+        self,
+        model_xml: str,
+        device: str = "CPU",
+        cpu_extension=None,
+        num_requests: int = 1,
+        batch_size: int = None,
+        config: dict = None,
+        device_preprocess: bool = False,
     ) -> None:
         """Load the model given IR files.
 #
@@ -58,70 +75,129 @@ class Network:
         device: str
             Defaults to CPU as device for use in the workspace.
         cpu_extension: str (optional)
+        num_requests: int
+            Number of infer requests to create, i.e. how many frames can be in
+            flight at once. Defaults to 1, 0 creates the number optimal for the
+            device (see `num_requests` once loaded).
+        batch_size: int (optional)
+            Reshape the network to take this many images per request. Defaults
+            to the batch size of the IR.
+        config: dict (optional)
+            Performance settings, see `profiles.performance_settings`.
+        device_preprocess: bool
+            Have the plugin resize and transpose the input, where the backend
+            supports it: `submit` then takes uint8 BGR frames of any size,
+            [batch, height, width, channel], without a copy. See
+            `device_preprocess` once loaded.
         """
         ### TODO: Load the model ###
-        # https://docs.openvinotoolkit.org/latest/ie_python_api/classie__api_1_1IENetwork.html
         model_bin = os.path.splitext(model_xml)[0] + ".bin"
         assert os.path.isfile(model_bin) and os.path.isfile(model_xml)
         self._model_size = os.stat(model_bin).st_size / 1024. ** 2
 
-        # Add a CPU extension, if applicable
-        if cpu_extension and "CPU" in device:
-            self.ie_core.add_extension(cpu_extension, device)
-
-        try:
-            self.network = self.ie_core.read_network(model=model_xml, weights=model_bin)
-        except AttributeError:
-            self.network = IENetwork(model=model_xml, weights=model_bin)
-
-        # Load the IENetwork into the plugin
-        self.exec_network = self.ie_core.load_network(
-            network=self.network, device_name=device
+        if num_requests < 0:
+            raise ValueError(f"num_requests must be >= 0, got {num_requests}")
+        self.backend.load(
+            model_xml,
+            model_bin,
+            device=device,
+            cpu_extension=cpu_extension,
+            num_requests=num_requests,
+            batch_size=batch_size,
+            config=config,
+            device_preprocess=device_preprocess,
         )
-
-        ### TODO: Check for supported layers ###
-        supported_layers = self.ie_core.query_network(
-            network=self.network, device_name=device
-        )
-        # Check for any unsupported layers, and let the user know if anything is missing.
-        unsupported_layers = [
-            l for l in self.network.layers.keys() if l not in supported_layers
-        ]
-        if len(unsupported_layers) != 0:
-            msg = (
-                "Unsupported layers found: {}, Check whether extensions are available "
-                "to add to IECore.".format(unsupported_layers)
-            )
-            raise RuntimeError(msg)
-
-        ### TODO: Add any necessary extensions ###
-        # Add a CPU extension, if applicable
-        if cpu_extension and "CPU" in device:
-            self.ie_core.add_extension(cpu_extension, device)
-
-        # Get the input layer
-        self._input_blob = next(iter(self.network.inputs))
-        self._output_blob = next(iter(self.network.outputs))
+        self.num_requests = self.backend.num_requests
+        self.device_preprocess = self.backend.device_preprocess
 
     def get_input_shape(self) -> list:
         """Gets the input shape of the network."""
-        return self.network.inputs[self._input_blob].shape
+        return self.backend.input_shape
 
     def exec_net(
         self, image: object, request_id: int = 0,
     ):
-        """Makes an asynchronous inference request, given an input image."""
-        if not isinstance(image, np.ndarray):
+        """Makes an asynchronous inference request, given an input image.
+
+        Pass `image=None` when the request's input blob was already filled
+        through `input_buffer`.
+        """
+        if image is not None and not isinstance(image, np.ndarray):
             raise IOError("Image not parsed.")
-        self.exec_network.start_async(
-            request_id=request_id, inputs={self._input_blob: image}
-        )
+        self.backend.start(request_id, image)
 
     def wait(self, request_id: int = 0):
         """Checks the status of the inference request."""
-        status = self.exec_network.requests[request_id].wait(-1)
+        status = self.backend.wait(request_id)
         return status
 
     def get_output(self, request_id: int = 0):
         """Returns a list of the results for the output layer of the network."""
-        return self.exec_network.requests[request_id].outputs[self._output_blob]
+        return self.backend.get_output(request_id)
+
+    def set_callback(self, callback) -> bool:
+        """Call `callback(request_id, status)` from the device when a request
+        completes, see `Backend.set_callback`.
+
+        :return: False if the backend cannot call back, `wait` must be used
+        """
+        return self.backend.set_callback(callback)
+
+    def input_buffer(self, request_id: int = None):
+        """Returns the input blob memory of an infer request, to write into.
+
+        Defaults to the request the next `submit` will use. Returns None if the
+        backend does not expose the blob buffer.
+        """
+        if request_id is None:
+            request_id = self._next_request
+        return self.backend.input_buffer(request_id)
+
+    @property
+    def next_request(self) -> int:
+        """Id of the request the next `submit` will use."""
+        return self._next_request
+
+    @property
+    def in_flight(self) -> int:
+        """Number of submitted requests whose results have not been collected."""
+        return len(self._pending)
+
+    def is_full(self) -> bool:
+        """True when every infer request is busy and `collect` must be called."""
+        return len(self._pending) >= self.num_requests
+
+    def submit(self, image: object, userdata: object = None) -> int:
+        """Start inference on the next free request of the ring buffer.
+
+        `image=None` submits whatever was written into `input_buffer()`.
+        `userdata` (e.g. the original frame) is handed back by `collect` along
+        with the result, so callers do not need to track request ids.
+        """
+        if self.is_full():
+            raise RuntimeError(
+                "All infer requests are busy, collect a result before submitting."
+            )
+        request_id = self._next_request
+        self.exec_net(image, request_id=request_id)
+        self._pending.append((request_id, userdata))
+        self._next_request = (request_id + 1) % self.num_requests
+        return request_id
+
+    def collect(self):
+        """Wait for the oldest in-flight request and return its result.
+
+        Results are returned in submission order.
+
+        :return: (userdata, output) tuple
+        """
+        if not self._pending:
+            raise RuntimeError("No inference request in flight.")
+        request_id, userdata = self._pending.popleft()
+        status = self.wait(request_id)
+        if status != 0:
+            raise RuntimeError(
+                f"Inference request {request_id} failed with status {status}."
+            )
+        # The output blob is reused by the next submission on this request.
+        return userdata, np.array(self.get_output(request_id), copy=True)
@@ -0,0 +1,279 @@
+"""Append-only journal of the detections of every frame, and its replay."""
+
+import os
+import struct
+import time
+
+import numpy as np
+
+from counter import make_counter
+from detections import PERSON, parse_detections
+from loguru import logger
+from metrics import PipelineMetrics
+
+# magic, version, frame width, frame height, frames per second, lowest
+# confidence kept
+HEADER = struct.Struct("<8sIIIff4x")
+MAGIC = b"PCJOURNL"
+VERSION = 1
+
+# One detection, as the raw SSD output: label, confidence and coordinates
+# normalised to the frame. Frames without a detection have a single record
+# with a confidence of -1, so that every frame of the detector is kept.
+# Frames the detector skipped at the end of a run have a single record with
+# a confidence of `SKIPPED`, so that the length of the stream is kept too.
+RECORD = np.dtype(
+    [
+        ("frame", "<u8"),
+        ("timestamp", "<f8"),
+        ("label", "<f4"),
+        ("conf", "<f4"),
+        ("x_min", "<f4"),
+        ("y_min", "<f4"),
+        ("x_max", "<f4"),
+        ("y_max", "<f4"),
+    ]
+)
+SKIPPED = -2.0
+
+
+def _ssd_columns(records: np.ndarray) -> np.ndarray:
+    """The label to y_max fields of contiguous records, as an Nx6 float32 view."""
+    return records.view(np.float32).reshape(len(records), -1)[:, 4:]
+
+
+def journal_path(path: str, name: str) -> str:
+    """Journal of the stream `name` in multi-stream mode: `<stem>_<name><ext>`."""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_{name}{ext}"
+
+
+def _read_header(f) -> tuple:
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{f.name} is not a journal: too short.")
+    magic, version, width, height, fps, min_conf = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{f.name} is not a version {VERSION} journal.")
+    return width, height, fps, min_conf
+
+
+class JournalWriter:
+    """
+    Append the detections of every frame of a stream to a journal file.
+
+    Each frame the detector ran on is written as fixed-width `RECORD`s, with
+    the index of the frame in the stream and the time the counter was updated
+    with, so that a replay tracks and counts exactly as the live run did.
+    Frames the detector skipped only advance the frame index (see `skip`),
+    those at the end are marked on `close`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        fps: float = 0.0,
+        min_conf: float = 0.1,
+        max_rows: int = 256,
+    ):
+        """
+        Params
+        ======
+        path: str
+            Journal file, appended to if it exists (keeping its `min_conf`),
+            from the frame after its last one.
+        width, height: int
+            Frame size, to scale the normalised boxes to on replay.
+        fps: float
+            Frame rate of the stream, for information.
+        min_conf: float
+            Detections below this confidence are not kept. Replays can only
+            use a --prob_threshold above it.
+        max_rows: int
+            Most detections kept per frame, the most confident ones.
+        """
+        self.path = path
+        self.min_conf = min_conf
+        self.frames = 0
+        # Time of the latest frame skipped, for the mark of `close`.
+        self._skipped_timestamp = 0.0
+        if os.path.isfile(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                header = _read_header(f)
+            if header[:2] != (width, height):
+                raise ValueError(
+                    f"{path} is a journal of {header[0]}x{header[1]} frames, "
+                    f"not {width}x{height}."
+                )
+            self.min_conf = header[3]
+            # Frame indices carry on from the last frame of the journal. A
+            # record cut short by a crash is dropped.
+            count = (os.path.getsize(path) - HEADER.size) // RECORD.itemsize
+            self._file = open(path, "r+b")
+            self._file.truncate(HEADER.size + count * RECORD.itemsize)
+            if count:
+                self._file.seek(HEADER.size + (count - 1) * RECORD.itemsize)
+                last = np.frombuffer(self._file.read(RECORD.itemsize), RECORD)
+                self.frames = int(last["frame"][0]) + 1
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, "wb")
+            self._file.write(
+                HEADER.pack(MAGIC, VERSION, width, height, fps, min_conf)
+            )
+        # Frames of the stream with a record, those after were skipped.
+        self._written = self.frames
+        self._records = np.zeros(max_rows, RECORD)
+        self._values = _ssd_columns(self._records)
+
+    def write(self, result: np.ndarray, timestamp: float):
+        """Append the raw SSD output `result` of the next frame of the stream."""
+        rows = np.asarray(result, dtype=np.float32).reshape(-1, 7)
+        rows = rows[(rows[:, 0] >= 0) & (rows[:, 2] >= self.min_conf)]
+        if len(rows) > len(self._records):
+            rows = rows[np.argsort(-rows[:, 2])[: len(self._records)]]
+        count = max(len(rows), 1)
+        records = self._records[:count]
+        records["frame"] = self.frames
+        records["timestamp"] = timestamp
+        if len(rows):
+            self._values[:count] = rows[:, 1:7]
+        else:
+            self._values[0] = 0
+            records["conf"] = -1
+        self._file.write(records.tobytes())
+        self.frames += 1
+        self._written = self.frames
+
+    def skip(self, timestamp: float = 0.0):
+        """Advance past a frame the detector did not run on."""
+        self.frames += 1
+        self._skipped_timestamp = timestamp
+
+    def close(self):
+        if self.frames > self._written:
+            # Mark the last frame, so that replays count the skipped ones.
+            records = self._records[:1]
+            records["frame"] = self.frames - 1
+            records["timestamp"] = self._skipped_timestamp
+            self._values[0] = 0
+            records["conf"] = SKIPPED
+            self._file.write(records.tobytes())
+            self._written = self.frames
+        self._file.close()
+
+
+class Journal:
+    """
+    A journal written by `JournalWriter`, memory-mapped.
+
+    Iterating yields `(frame, timestamp, rows)` for every frame of the
+    detector, where `rows` are Nx7 SSD output rows for `parse_detections`.
+    `frames` is the length of the stream, the frames skipped at its end
+    included.
+    """
+
+    def __init__(self, path: str):
+        """
+        Params
+        ======
+        path: str
+            Journal file. A record cut short by a crash is ignored.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.width, self.height, self.fps, self.min_conf = _read_header(f)
+        count = (os.path.getsize(path) - HEADER.size) // RECORD.itemsize
+        if count:
+            self.records = np.memmap(
+                path, RECORD, "r", offset=HEADER.size, shape=(count,)
+            )
+        else:
+            self.records = np.zeros(0, RECORD)
+        self.frames = int(self.records["frame"][-1]) + 1 if count else 0
+        # Only keep the records of the detector. The marks of the skipped
+        # frames are usually last, which keeps the records a memory map.
+        marks = np.flatnonzero(self.records["conf"] == SKIPPED)
+        if len(marks) == 1 and marks[0] == count - 1:
+            self.records = self.records[:-1]
+        elif len(marks):
+            self.records = np.delete(self.records, marks)
+        count = len(self.records)
+        # Records of a frame are contiguous, a new frame starts a new run.
+        self._starts = np.zeros(min(count, 1), np.int64)
+        if count:
+            changes = np.flatnonzero(np.diff(self.records["frame"]) != 0) + 1
+            self._starts = np.concatenate((self._starts, changes))
+
+    def __len__(self) -> int:
+        """Number of frames the detector ran on."""
+        return len(self._starts)
+
+    def __iter__(self):
+        ends = np.append(self._starts[1:], len(self.records))
+        for start, end in zip(self._starts, ends):
+            records = self.records[start:end]
+            rows = np.zeros((len(records), 7), np.float32)
+            rows[:, 1:] = _ssd_columns(records)
+            yield int(records["frame"][0]), float(records["timestamp"][0]), rows
+
+
+def replay(journal: Journal, counter, prob_threshold: float, classes=(PERSON,)):
+    """Feed the detections of a journal to `counter`, frame by frame.
+
+    Frames the detector skipped in the live run are predicted as they were,
+    and the counter is updated with the recorded timestamps.
+
+    :return: generator of the number of people in every frame of the stream
+    """
+    next_frame = None
+    for frame, timestamp, rows in journal:
+        # The frames skipped by the detector before this one.
+        skipped = frame - next_frame if next_frame is not None else 0
+        for _ in range(max(skipped, 0)):
+            yield counter.predict()
+        detections = parse_detections(
+            rows, prob_threshold, journal.width, journal.height, classes=classes
+        )
+        yield counter.update(detections, timestamp)
+        next_frame = frame + 1
+    # The frames skipped after the last one of the detector.
+    for _ in range(journal.frames - (next_frame or 0)):
+        yield counter.predict()
+
+
+def replay_journal(args, publisher, metrics=None):
+    """
+    Track, count and publish the detections of a journal, without the video
+    or the network.
+
+    The counts only differ from the live run's where the options differ, e.g.
+    a higher --prob_threshold, other --classes, --zones or tracker settings.
+
+    :param args: Command line arguments parsed by `build_argparser()`
+    :param publisher: `StatsPublisher`, or None not to publish
+    :param metrics: `PipelineMetrics` to update, or None
+    :return: the `PersonCounter`, once every frame was replayed
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    journal = Journal(args.from_journal)
+    logger.info(
+        f"Replaying {len(journal)} frames of {args.from_journal} "
+        f"({journal.width}x{journal.height})..."
+    )
+    counter = make_counter(args, publisher, journal.width, journal.height)
+    stream_metrics = metrics.add_stream("cam0", counter)
+
+    start_time = time.perf_counter()
+    for _ in replay(journal, counter, args.prob_threshold, tuple(args.classes)):
+        stream_metrics.frames.inc()
+
+    logger.info(
+        f"Detected {counter.total_count} people in {len(journal)} journaled frames, "
+        f"replayed in {time.perf_counter() - start_time:.2f}s @ Probability "
+        f"{args.prob_threshold*100}% threshold."
+    )
+    return counter
@@ -20,20 +20,29 @@
  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
  WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-import json
 import os
 import socket
-import sys
 import time
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 import cv2
 import matplotlib.pyplot as plt
-import numpy as np
 import paho.mqtt.client as mqtt
 
+from async_streams import infer_on_streams_async
+from backends import BACKENDS
+from capture import FrameGrabber, should_drop_oldest
+from detections import PERSON
 from inference import Network
+from journal import replay_journal
+from metrics import PipelineMetrics
+from model_registry import PRECISIONS, resolve_model
+from pipeline import StreamPipeline
+from profiles import PROFILES, TUNED_PROFILES, nstreams, performance_settings
+from publisher import StatsPublisher
+from sinks import RawFrameSink, VideoRecorder
+from streams import infer_on_streams, load_sources
 from loguru import logger
 from tqdm import tqdm
 
@@ -44,15 +53,15 @@ MQTT_HOST = IPADDRESS
 MQTT_PORT = 3001
 MQTT_KEEPALIVE_INTERVAL = 60
 TIMEOUT = 60
+MQTT_MAX_RECONNECT_DELAY = 30
 
-# person detected counter.
-last_count = 0
-total_count = 0
-firstFrame = None
-textIn = 0
-textOut = 0
-
-average_infer_time = []
+def frame_size(text):
+    """Parse a WxH frame size argument into (width, height)."""
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise ArgumentTypeError(f"invalid frame size: {text!r}, expected WxH")
+    return width, height
 
 
 def build_argparser():
@@ -64,12 +73,51 @@ def build_argparser():
     parser.add_argument(
         "-m",
         "--model",
-        required=True,
         type=str,
-        help="Path to an xml file with a trained model.",
+        help="Path to an xml file with a trained model, or the name of a model in "
+        "--models-dir to use its fastest variant on the device.",
+    )
+    parser.add_argument(
+        "--models-dir",
+        type=str,
+        default="models",
+        help="Where model names are looked up (models by default)",
+    )
+    parser.add_argument(
+        "--model-precision",
+        type=str.upper,
+        default=None,
+        choices=PRECISIONS,
+        help="Use the variant of this precision of a model name, rather than "
+        "the fastest.",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        nargs="+",
+        help="Path to image or video file. Several sources run in multi-stream mode.",
+    )
+    parser.add_argument(
+        "--sources",
+        type=str,
+        default=None,
+        help="JSON config file of sources to serve in multi-stream mode, either "
+        '{"name": "source", ...} or [{"name": ..., "source": ...}, ...].',
     )
     parser.add_argument(
-        "-i", "--input", required=True, type=str, help="Path to image or video file"
+        "--runner",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Run the streams with a decode thread each, or as tasks of one asyncio "
+        "event loop, which scales to many cameras (threads by default).",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=8,
+        help="Threads decoding and preprocessing the frames of every stream with "
+        "--runner asyncio (8 by default).",
     )
     parser.add_argument(
         "-l",
@@ -81,6 +129,37 @@ def build_argparser():
         "Absolute path to a shared library with the"
         "kernels impl.",
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=["auto"] + list(BACKENDS),
+        help="Inference backend. 'auto' (default) uses the OpenVINO API installed, "
+        "or OpenCV DNN; 'replay' replays the outputs recorded in --replay.",
+    )
+    parser.add_argument(
+        "--preprocess",
+        choices=["device", "python"],
+        default="device",
+        help="Where frames are resized to the network input: 'device' (default) "
+        "has the plugin do it, taking the decoded frames without a copy, where "
+        "the backend supports it; 'python' resizes them with OpenCV first.",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Detector outputs recorded with benchmark.py --record, to run "
+        "without OpenVINO.",
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default=os.environ.get("MODEL_CACHE_DIR"),
+        metavar="DIR",
+        help="Cache compiled models in this directory to start faster, "
+        "$MODEL_CACHE_DIR by default.",
+    )
     parser.add_argument(
         "-d",
         "--device",
@@ -99,11 +178,252 @@ def build_argparser():
         help="Probability threshold for detections filtering" "(0.5 by default)",
     )
     parser.add_argument(
-        "--out", action="store_true", help="Write video to file.",
+        "--classes",
+        type=int,
+        nargs="+",
+        default=[PERSON],
+        help="Detection labels to count (person only by default)",
+    )
+    parser.add_argument(
+        "--track-metric",
+        choices=["iou", "centroid"],
+        default="iou",
+        help="How detections are matched to tracks across frames (iou by default)",
+    )
+    parser.add_argument(
+        "--track-max-age",
+        type=int,
+        default=10,
+        help="Frames a person may go undetected before they are counted as gone "
+        "(10 by default)",
+    )
+    parser.add_argument(
+        "--track-min-hits",
+        type=int,
+        default=3,
+        help="Frames a person must be detected in before they are counted "
+        "(3 by default)",
+    )
+    parser.add_argument(
+        "-nr",
+        "--num-requests",
+        type=int,
+        default=None,
+        help="Number of asynchronous infer requests kept in flight, frame k+N is "
+        "submitted while the result of frame k is collected (1 by default, or "
+        "that of --profile; 0 lets the device choose)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        choices=list(PROFILES) + ["tuned"],
+        help="Performance profile of the device: latency, throughput, low-power, "
+        "or tuned for the settings found by benchmark.py --tune on this hardware.",
+    )
+    parser.add_argument(
+        "--nstreams",
+        type=nstreams,
+        default=None,
+        help="Parallel inference streams of the device, a number or 'auto'.",
+    )
+    parser.add_argument(
+        "--nthreads", type=int, default=None, help="Inference threads (CPU).",
+    )
+    parser.add_argument(
+        "--pin",
+        type=str,
+        default=None,
+        choices=["YES", "NO", "NUMA", "HYBRID_AWARE"],
+        help="Pin inference threads to cores (CPU).",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default=None,
+        help="Inference precision where the device supports a choice, e.g. bf16.",
+    )
+    parser.add_argument(
+        "--tuned-profiles",
+        type=str,
+        default=TUNED_PROFILES,
+        help=f"Settings saved by benchmark.py --tune ({TUNED_PROFILES} by default)",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Reshape the network to this batch size and submit frames in batches, "
+        "across streams in multi-stream mode (1 by default)",
+    )
+    parser.add_argument(
+        "--batch-timeout",
+        type=float,
+        default=10,
+        help="Longest time in ms a partial batch waits for more frames before it "
+        "is submitted (10 by default)",
+    )
+    parser.add_argument(
+        "--decode-queue-size",
+        type=int,
+        default=4,
+        help="Number of decoded frames buffered ahead of inference (4 by default)",
+    )
+    parser.add_argument(
+        "--decode-policy",
+        choices=["auto", "block", "drop"],
+        default="auto",
+        help="What the decode thread does when the frame queue is full: block, or "
+        "drop the oldest frame. 'auto' drops for live sources and blocks for files.",
+    )
+    parser.add_argument(
+        "--detect-every",
+        type=int,
+        default=1,
+        help="Run the detector every K frames and move the tracked boxes along "
+        "their motion in between (1 by default, every frame)",
+    )
+    parser.add_argument(
+        "--adaptive-skip",
+        action="store_true",
+        help="Run the detector on every frame while people appear or leave, and "
+        "back off to every --detect-every frames on a quiet scene.",
+    )
+    parser.add_argument(
+        "--motion-gate",
+        action="store_true",
+        help="Skip inference while the scene is static and nobody is tracked.",
+    )
+    parser.add_argument(
+        "--motion-min-area",
+        type=float,
+        default=0.002,
+        help="Fraction of the frame that must change to count as motion "
+        "(0.002 by default)",
+    )
+    parser.add_argument(
+        "--zones",
+        type=str,
+        default=None,
+        help="JSON file of named counting lines and polygons, in normalised "
+        'coordinates: {"lines": {"door": [[x0, y0], [x1, y1]]}, '
+        '"zones": {"till": [[x, y], ...]}}',
+    )
+    parser.add_argument(
+        "--mqtt-interval",
+        type=float,
+        default=0.5,
+        help="Minimum seconds between two MQTT updates of the counts, which are "
+        "only sent when they change (0.5 by default, 0 sends every change)",
+    )
+    parser.add_argument(
+        "--mqtt-combine",
+        type=str,
+        default=None,
+        metavar="TOPIC",
+        help="Publish the counts of every stream together, as one JSON object "
+        "keyed by topic, on this topic.",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="Append the detections of every frame to this journal, to replay "
+        "them with --from-journal. In multi-stream mode, each stream has its "
+        "own journal, PATH with the stream name appended.",
+    )
+    parser.add_argument(
+        "--journal-min-conf",
+        type=float,
+        default=0.1,
+        help="Leave the detections below this confidence out of the journal "
+        "(0.1 by default). Replays can use any higher --prob_threshold.",
+    )
+    parser.add_argument(
+        "--from-journal",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="Track, count and publish the detections of a journal, instead of "
+        "running the model on a video.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics for Prometheus on http://HOST:PORT/metrics.",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="0.0.0.0",
+        help="Address to serve the metrics on (every interface by default)",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        nargs="?",
+        const="out.mp4",
+        default=None,
+        metavar="PATH",
+        help="Write video to file, out.mp4 if no path is given.",
+    )
+    parser.add_argument(
+        "--out-codec",
+        type=str,
+        default="mp4v",
+        help="Four character code of the --out video codec (mp4v by default)",
+    )
+    parser.add_argument(
+        "--out-fps",
+        type=float,
+        default=None,
+        help="Frame rate of the --out video, that of the input by default.",
+    )
+    parser.add_argument(
+        "--out-size",
+        type=frame_size,
+        default=None,
+        metavar="WxH",
+        help="Resize the frames of the --out video, e.g. 1280x720.",
+    )
+    parser.add_argument(
+        "--out-clips",
+        action="store_true",
+        help="Only record clips around people entering or leaving, one file each "
+        "next to the --out path.",
+    )
+    parser.add_argument(
+        "--clip-before",
+        type=float,
+        default=2.0,
+        help="Seconds recorded before the first event of a clip (2 by default)",
+    )
+    parser.add_argument(
+        "--clip-after",
+        type=float,
+        default=3.0,
+        help="Seconds recorded after the last event of a clip (3 by default)",
     )
     parser.add_argument(
         "--ffmpeg", action="store_true", help="Flush video to FFMPEG.",
     )
+    parser.add_argument(
+        "--ffmpeg-output",
+        type=str,
+        default="-",
+        help="Where --ffmpeg writes raw BGR frames: '-' for stdout (default), the "
+        "path of a named pipe, or 'shm:<name>' for a shared memory ring.",
+    )
+    parser.add_argument(
+        "--ffmpeg-size",
+        type=frame_size,
+        default=None,
+        metavar="WxH",
+        help="Downscale the frames sent with --ffmpeg, e.g. 768x432.",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Show output on screen [debugging].",
     )
@@ -112,118 +432,26 @@ def build_argparser():
 
 
 def connect_mqtt():
+    """Connect to the MQTT server, locally or in its docker container.
+
+    The client runs its network loop on its own thread, which reconnects with
+    backoff if the connection drops.
+
+    :return: connected client, or None if no server could be reached
+    """
     client = mqtt.Client()
-    try:
-        client.connect(MQTT_HOST, MQTT_PORT, TIMEOUT)
-    except Exception as err:
-        MQTT_HOST = "mosca-server"
+    for host in (MQTT_HOST, "mosca-server"):
         try:
-            logger.warn(
-                f"Failed to connect to {MQTT_HOST}:{MQTT_PORT}, trying docker container"
-                f" MQTT server on {MQTT_HOST}:{MQTT_PORT}")
-            client.connect(MQTT_HOST, MQTT_PORT, TIMEOUT)
+            client.connect(host, MQTT_PORT, TIMEOUT)
         except Exception as err:
-            logger.error(f"Failed to connect to {MQTT_HOST}:{MQTT_PORT}")
-            return
-
-    logger.info(f"Connected to MQTT server on {MQTT_HOST}:{MQTT_PORT}")
-    return client
-
-def categories_list():
-    # https://github.com/opencv/opencv/blob/master/samples/data/dnn/object_detection_classes_coco.txt
-    return [
-        "null",
-        "person",
-        "bicycle",
-        "car",
-        "motorcycle",
-        "airplane",
-        "bus",
-        "train",
-        "truck",
-        "boat",
-        "traffic light",
-        "fire hydrant",
-        "street sign",
-        "stop sign",
-        "parking meter",
-        "bench",
-        "bird",
-        "cat",
-        "dog",
-        "horse",
-        "sheep",
-        "cow",
-        "elephant",
-        "bear",
-        "zebra",
-        "giraffe",
-        "hat",
-        "backpack",
-        "umbrella",
-        "shoe",
-        "eye glasses",
-        "handbag",
-        "tie",
-        "suitcase",
-        "frisbee",
-        "skis",
-        "snowboard",
-        "sports ball",
-        "kite",
-        "baseball bat",
-        "baseball glove",
-        "skateboard",
-        "surfboard",
-        "tennis racket",
-        "bottle",
-        "plate",
-        "wine glass",
-        "cup",
-        "fork",
-        "knife",
-        "spoon",
-        "bowl",
-        "banana",
-        "apple",
-        "sandwich",
-        "orange",
-        "broccoli",
-        "carrot",
-        "hot dog",
-        "pizza",
-        "donut",
-        "cake",
-        "chair",
-        "couch",
-        "potted plant",
-        "bed",
-        "mirror",
-        "dining table",
-        "window",
-        "desk",
-        "toilet",
-        "door",
-        "tv",
-        "laptop",
-        "mouse",
-        "remote",
-        "keyboard",
-        "cell phone",
-        "microwave",
-        "oven",
-        "toaster",
-        "sink",
-        "refrigerator",
-        "blender",
-        "book",
-        "clock",
-        "vase",
-        "scissors",
-        "teddy bear",
-        "hair drier",
-        "toothbrush",
-    ]
+            logger.warning(f"Failed to connect to {host}:{MQTT_PORT}: {err}")
+            continue
+        logger.info(f"Connected to MQTT server on {host}:{MQTT_PORT}")
+        client.reconnect_delay_set(min_delay=1, max_delay=MQTT_MAX_RECONNECT_DELAY)
+        client.loop_start()
+        return client
+
+    logger.error("Failed to connect to an MQTT server, stats are not published.")
 
 
 def plot_frame(frame):
@@ -234,121 +462,38 @@ def plot_frame(frame):
     plt.show()
 
 
-def draw_boxes(frame, result, prob_threshold, width, height):
-    """Draw bounding boxes onto the frame."""
-    loc = 10
-    count = 0
-    # As per: https://github.com/opencv/open_model_zoo/blob/7d235755e2d17f6186b11243a169966e4f05385a/models/public/ssd_mobilenet_v2_coco/ssd_mobilenet_v2_coco.md#converted-model-1
-    for box in result[0][0]:  # Output shape is 1x1x100x7
-        label = categories_list()[int(box[1])]
-        conf = box[2]
-        if conf >= prob_threshold:
-            xmin = int(box[3] * width)
-            ymin = int(box[4] * height)
-            xmax = int(box[5] * width)
-            ymax = int(box[6] * height)
-            _y = ymax - loc if ymax - loc > loc else ymax + loc
-
-            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 0, 255), 1)
-
-            cv2.putText(
-                frame,
-                f"{label.title()}: {conf *100:.2f}%",
-                (xmin, _y),
-                cv2.FONT_HERSHEY_COMPLEX,
-                fontScale=0.5,
-                color=(127, 255, 127),
-                thickness=1,
-            )
-            count += 1
-    return frame, count
-
-
-def process_frame(frame, height, width, data_layout=(2, 0, 1)):
-    """Helper function for processing frame"""
-    p_frame = cv2.resize(frame, (width, height))
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (5, 5), 0)
-
-    # Change data layout from HWC to CHW
-    p_frame = p_frame.transpose(data_layout)
-    p_frame = p_frame.reshape(1, *p_frame.shape)
-    return p_frame, gray
-
-
-def testIntersectionIn(x, y):
-    pass
-
-
-def testIntersectionOut(x, y):
-    pass
-
-
-def find_intersections(
-    contours, frame, x0, y0, x1, y1,
-):
-    global textIn, textOut
-
-    if contours:
-        for cnt in contours:
-            # if the contour is too small, ignore it
-            if cv2.contourArea(cnt) < 12000:
-                continue
-            cv2.line(
-                frame, x0, y0, (250, 0, 1), 2,
-            )  # blue line
-            cv2.line(
-                frame, x1, y1, (0, 0, 255), 2,
-            )  # red line
-
-            # compute the bounding box for the contour, draw it on the frame,
-            # and update the text
-            (xmin, ymin, xmax, ymax) = cv2.boundingRect(cnt)
-
-            cv2.rectangle(
-                frame, (xmin, ymin), (xmin + xmax, ymin + ymax), (0, 255, 0), 2
-            )
-
-            rectagleCenterPont = ((2 * xmin + xmax) // 2, (2 * ymin + ymax) // 2)
-
-            cv2.circle(frame, rectagleCenterPont, 1, (0, 0, 255), 1)
-
-            if testIntersectionIn(xmin, ymax):
-                textIn += 1
-
-            if testIntersectionOut(xmin, ymax):
-                textOut += 1
-
-    return textIn, textOut
-
-
-def infer_on_stream(args, client):
+def infer_on_stream(args, publisher, metrics=None):
     """
     Initialize the inference network, stream video to network,
     and output stats and video.
 
     :param args: Command line arguments parsed by `build_argparser()`
-    :param client: MQTT client
-    :return: None
+    :param publisher: `StatsPublisher`, or None not to publish
+    :param metrics: `PipelineMetrics` to update, or None
+    :return: the `StreamPipeline` of the stream, once it ended
     """
-    global firstFrame, last_count, total_count, average_infer_time
+    if metrics is None:
+        metrics = PipelineMetrics()
     # Initialise the class
-    infer_network = Network()
-    # Set Probability threshold for detections
-    prob_threshold = args.prob_threshold
-
+    infer_network = Network(
+        args.backend, replay=args.replay, cache_dir=args.model_cache
+    )
     ### TODO: Load the model through `infer_network` ###
+    settings = performance_settings(args)
     try:
         infer_network.load_model(
         model_xml=args.model,
         device=args.device,
         cpu_extension=args.cpu_extension if args.cpu_extension else None,
+        num_requests=settings["num_requests"],
+        batch_size=args.batch_size,
+        config=settings,
+        device_preprocess=args.preprocess == "device",
         )
     except Exception:
         logger.exception("Failed to load the model")
         raise
-    video_file = args.input
-    writer = None
+    video_file = args.input[0]
     logger.info(f"Processing video: {video_file}...")
     stream = cv2.VideoCapture(video_file)
     stream.open(video_file)
@@ -357,22 +502,25 @@ def infer_on_stream(args, client):
     orig_width = int(stream.get(3))
     orig_height = int(stream.get(4))
 
-    # Regions of Interest
-    blue_line_start = orig_width + 150, orig_height - 50
-    blue_line_end = 0, 100
-    red_line_start = orig_width, orig_height - 100
-    red_line_end = 200, 0
-
+    recorder = None
     if args.out:
-        # Create a video writer for the output video
-        # The second argument should be `cv2.VideoWriter_fourcc('M','J','P','G')`
-        # on Mac, and `0x00000021` on Linux
+        # Encode the output video on a background thread.
         logger.debug("Enabled writing output video to file.")
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        out = cv2.VideoWriter("out.mp4", fourcc, 30, (orig_width, orig_height))
-        length = stream.get(cv2.CAP_PROP_FRAME_COUNT)
-        fps = stream.get(cv2.CAP_PROP_FPS)
-        pbar = tqdm(total=int(length - fps + 1))
+        fps = stream.get(cv2.CAP_PROP_FPS) or 30
+        pbar = None
+        if not args.out_clips:
+            length = stream.get(cv2.CAP_PROP_FRAME_COUNT)
+            pbar = tqdm(total=int(length - fps + 1))
+        recorder = VideoRecorder(
+            args.out,
+            fourcc=args.out_codec,
+            fps=args.out_fps or fps,
+            size=args.out_size,
+            clips=args.out_clips,
+            clip_before=args.clip_before,
+            clip_after=args.clip_after,
+            progress=pbar.update if pbar else None,
+        ).start()
 
     # Example: for 'ssd_mobilenet_v2_coco.xml'
     # Image, shape - 1,300,300,3, format is B,H,W,C where:
@@ -387,125 +535,107 @@ def infer_on_stream(args, client):
         logger.error(msg)
         raise RuntimeError(msg)
 
-    while stream.isOpened():
-        ### TODO: Read from the video capture ###
-        # Grab the next stream.
-        (grabbed, frame) = stream.read()
-        # If the frame was not grabbed, then we might have reached end of steam,
-        # then break
-        if not grabbed:
-            break
-
-        p_frame, gray = process_frame(frame, input_height, input_width)
-
-        # if the first frame is None, initialize it
-        if firstFrame is None:
-            firstFrame = gray
-            continue
-
-        # compute the absolute difference between the current frame and
-        # first frame
-        frameDelta = cv2.absdiff(firstFrame, gray)
-        _, thresh = cv2.threshold(frameDelta, 50, 255, cv2.THRESH_BINARY)
-        # dilate the threshold image to fill in holes, then find contours
-        # on threshold image
-        # Taking a matrix of size 10 as the kernel
-        kernel = np.ones((5, 5), np.uint8)
-
-        thresh = cv2.dilate(thresh, kernel, iterations=3)
-        contours, _ = cv2.findContours(
-            thresh.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-        )
-        start_infer = time.time()
-        infer_network.exec_net(p_frame)
-        if infer_network.wait() == 0:
-            result = infer_network.get_output()
-            end_infer = time.time() - start_infer
-            average_infer_time.append(end_infer)
-            message = f"Inference time: {end_infer*1000:.2f}ms"
-            cv2.putText(
-                frame, message, (20, 20), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0, 0, 0), 1
-            )
-            # Display contour: Useful for debugging.
-            # cv2.drawContours(frame, contours, -1, (0, 0, 0), 2)
-
-            # TODO: Fix the logic of counting people going in/out of ROI
-            # Possible solution:
-            # Assuming that people enter from left and exit on right.
-            # Create the equation for line y=mx+c where m is slope.
-            # We assume y direction is going up (you'll need to inverse the sign).
-            # Substitute x_person into equation to calculate y_line.
-            # If y_person > y_line, then it is above the line.
-            # I think a better way is to use a box around the polling station and
-            # check if the person is within the box.
-
-            # textIn, textOut = find_intersections(
-            #     contours,
-            #     frame,
-            #     blue_line_start,
-            #     blue_line_end,
-            #     red_line_start,
-            #     red_line_end,
-            # )
-
-            # Draw the boxes onto the input
-            out_frame, current_count = draw_boxes(
-                frame, result, prob_threshold, orig_width, orig_height
-            )
-
-            # Check when a person enters the video the first time.
-            if current_count > last_count:
-                start_time = time.time()
-                total_count += current_count - last_count
-                if hasattr(client, "publish"):
-                    client.publish("person", json.dumps({"total": total_count}))
-
-            if current_count < last_count:
-                duration = int(time.time() - start_time)
-                # Publish messages to the MQTT server
-                if hasattr(client, "publish"):
-                    client.publish("person/duration", json.dumps({"duration": duration}))
-
-            if hasattr(client, "publish"):
-                client.publish("person", json.dumps({"count": current_count}))
-            last_count = current_count
+    pipeline = StreamPipeline.from_args(
+        args,
+        infer_network,
+        orig_width,
+        orig_height,
+        publisher,
+        journal=args.journal,
+        fps=stream.get(cv2.CAP_PROP_FPS) or 0.0,
+        # Only annotate frames when someone is going to look at them.
+        annotate=bool(args.out or args.debug or args.ffmpeg),
+    )
+    counter = pipeline.counter
 
-            if args.out:
-                pbar.update(1)
-                out.write(frame)
+    def emit(result):
+        """Output a counted frame and give its buffer back to the decoder."""
+        start_output = time.perf_counter()
+        frame = result.frame
+        if recorder:
+            recorder.write(frame, event=counter.event)
 
         if args.debug:
-            # cv2.imshow("Gray Frame", gray)
-            # cv2.imshow("Contour Frame", thresh)
             cv2.imshow("Frame", frame)
 
-        # Send frame to the ffmpeg server
-        if args.ffmpeg:
-            # ffserver color correction.
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            sys.stdout.buffer.write(frame)
-            sys.stdout.flush()
-
-        key = cv2.waitKey(1) & 0xFF
+        # Send frame to the ffmpeg server, dropped if ffmpeg is behind.
+        if sink:
+            sink.write(frame)
+
+        grabber.release(frame)
+        stream_metrics.output.observe(time.perf_counter() - start_output)
+        stream_metrics.frames.inc()
+
+    sink = None
+    if args.ffmpeg:
+        sink = RawFrameSink(args.ffmpeg_output, size=args.ffmpeg_size).start()
+
+    # Decode on a background thread, while frames are preprocessed and inferred.
+    grabber = FrameGrabber(
+        stream,
+        queue_size=args.decode_queue_size,
+        drop_oldest=should_drop_oldest(args.decode_policy, video_file),
+        num_held=(infer_network.num_requests + 1)
+        * args.batch_size
+        * args.detect_every,
+    )
+    stream_metrics = metrics.add_stream("cam0", counter, grabber, sink, recorder)
+    pipeline.metrics = grabber.metrics = stream_metrics
+    grabber.start()
+    metrics.add_network(infer_network)
 
-        # # if the `q` key was pressed, break from the loop
-        if key == ord("q"):
-            break
+    try:
+        while True:
+            ### TODO: Read from the video capture ###
+            # Grab the next stream.
+            (grabbed, frame) = grabber.read(timeout=pipeline.timeout())
+            # If the frame was not grabbed, then we might have reached end of
+            # steam, then break
+            if not grabbed:
+                if grabber.finished:
+                    break
+                # No frame before the deadline of the partial batch.
+                results = pipeline.poll()
+            else:
+                results = pipeline.process(frame)
+            for result in results:
+                emit(result)
+
+            # # if the `q` key was pressed, break from the loop
+            if args.debug and cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+
+        # Drain the requests still in flight.
+        for result in pipeline.flush():
+            emit(result)
+    finally:
+        # Stop the threads and release the out writer, capture, and destroy
+        # any OpenCV windows, also when the loop failed.
+        grabber.stop()
+        if sink:
+            sink.close()
+        pipeline.close()
+        if recorder:
+            recorder.close()
+            if pbar:
+                pbar.close()
+        stream.release()
+        if args.debug:
+            cv2.destroyAllWindows()
 
-    # Release the out writer, capture, and destroy any OpenCV windows
-    if client:
-        client.disconnect()
-    if args.out:
-        pbar.close()
-        out.release()
-    stream.release()
-    cv2.destroyAllWindows()
+    if recorder and args.out_clips:
+        logger.info(f"Recorded {recorder.clips_recorded} clips to {args.out}.")
+    if pipeline.motion_gate is not None:
+        logger.info(
+            f"Motion gate skipped {pipeline.motion_gate.frames_gated} static frames."
+        )
     logger.info(
-        f"Detected {total_count} people with an average inference time: "
-        f"{np.mean(average_infer_time)*1000:.3f}ms using the model: "
+        f"Detected {counter.total_count} people with an average inference time: "
+        f"{pipeline.mean_infer_time*1000:.3f}ms using the model: "
         f"{args.model} {infer_network._model_size:.2f}MB @ "
-        f"Probability {prob_threshold*100}% threshold."
+        f"Probability {args.prob_threshold*100}% threshold."
     )
+    return pipeline
 
 
 def main():
@@ -515,12 +645,50 @@ def main():
     :return: None
     """
     # Grab command line args
-    args = build_argparser().parse_args()
+    parser = build_argparser()
+    args = parser.parse_args()
+    if not args.from_journal:
+        if not args.model:
+            parser.error("the following arguments are required: -m/--model")
+        if not args.input and not args.sources:
+            parser.error("one of the arguments -i/--input or --sources is required")
+        if args.runner == "asyncio" and args.batch_size > 1:
+            parser.error("--runner asyncio infers one frame per request, not batches")
+        try:
+            args.model = resolve_model(
+                args.model, args.device, args.models_dir, args.model_precision
+            )
+        except ValueError as err:
+            parser.error(str(err))
     # Connect to the MQTT server
     client = connect_mqtt()
+    publisher = None
+    if client:
+        publisher = StatsPublisher(
+            client, interval=args.mqtt_interval, combine_topic=args.mqtt_combine
+        ).start()
+    metrics = PipelineMetrics()
+    if publisher:
+        metrics.add_publisher(publisher)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, args.metrics_host)
     # Perform inference on the input stream
     start_time = time.time()
-    infer_on_stream(args, client)
+    try:
+        if args.from_journal:
+            replay_journal(args, publisher, metrics)
+        elif args.runner == "asyncio":
+            sources = load_sources(args.input, args.sources)
+            infer_on_streams_async(args, publisher, sources, metrics)
+        elif args.sources or len(args.input) > 1:
+            sources = load_sources(args.input, args.sources)
+            infer_on_streams(args, publisher, sources, metrics)
+        else:
+            infer_on_stream(args, publisher, metrics)
+    finally:
+        metrics.stop()
+        if publisher:
+            publisher.stop()
     end_time = time.time() - start_time
     logger.info(f"It took {end_time:.2f}s to complete the inference and stream.")
 
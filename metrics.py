@@ -0,0 +1,310 @@
+"""Live pipeline metrics, served over HTTP in the Prometheus text format."""
+
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from loguru import logger
+
+# Seconds, from a fast inference to a stalled pipeline.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """`http.server.ThreadingHTTPServer`, which is only in Python 3.7+."""
+
+    daemon_threads = True
+
+
+class _Value:
+    """A counter or gauge value, or a function read when the metrics are served."""
+
+    __slots__ = ("value", "function", "_lock")
+
+    def __init__(self, function=None):
+        self.value = 0.0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self, name: str, labels: str) -> list:
+        value = self.function() if self.function else self.value
+        return [f"{name}{labels} {float(value)!r}"]
+
+
+class _Histogram:
+    """Counts of observations per bucket, allocated once."""
+
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # The last count is of the observations above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: str) -> list:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        # Buckets are cumulative: `le` is "less than or equal".
+        separator = labels[:-1] + "," if labels else "{"
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            samples.append(f'{name}_bucket{separator}le="{le}"}} {cumulative}')
+        samples.append(f"{name}_sum{labels} {total!r}")
+        samples.append(f"{name}_count{labels} {cumulative}")
+        return samples
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.
+
+    Values are created by `labels` the first time a combination is used;
+    keep the returned value to update it without looking it up again.
+    """
+
+    def __init__(
+        self, name: str, description: str, kind: str, labels=(), buckets=None
+    ):
+        """
+        Params
+        ======
+        name: str
+            Metric name, e.g. "people_counter_frames_total".
+        description: str
+            Help text of the metric.
+        kind: str
+            "counter", "gauge" or "histogram".
+        labels: tuple
+            Names of the labels.
+        buckets: tuple (optional)
+            Upper bounds of the histogram buckets, `LATENCY_BUCKETS` by default.
+        """
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets or LATENCY_BUCKETS))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, function=None):
+        """The value of these label values, created if needed.
+
+        :param function: called for the value when the metrics are served,
+            for counters and gauges kept elsewhere (e.g. a queue length)
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {self.label_names}")
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            value = self._values.get(values)
+            if value is None or function is not None:
+                if self.kind == "histogram":
+                    value = _Histogram(self.buckets)
+                else:
+                    value = _Value(function)
+                self._values[values] = value
+            return value
+
+    def samples(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            labels = ""
+            if label_values:
+                pairs = zip(self.label_names, label_values)
+                labels = "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+            try:
+                lines.extend(value.samples(self.name, labels))
+            except Exception as err:
+                logger.debug(f"Cannot read {self.name}{labels}: {err}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """A set of metrics, served with `serve`."""
+
+    def __init__(self):
+        self.metrics = []
+        self._server = None
+
+    def _add(self, *args, **kwargs) -> Metric:
+        metric = Metric(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, labels=()) -> Metric:
+        return self._add(name, description, "counter", labels)
+
+    def gauge(self, name: str, description: str, labels=()) -> Metric:
+        return self._add(name, description, "gauge", labels)
+
+    def histogram(
+        self, name: str, description: str, labels=(), buckets=None
+    ) -> Metric:
+        return self._add(name, description, "histogram", labels, buckets)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = ""):
+        """Serve the metrics on http://host:port/metrics from a thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on http://{host or '0.0.0.0'}:{port}/metrics")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class StreamMetrics:
+    """The per-frame metrics of one stream, looked up once."""
+
+    def __init__(self, metrics: "PipelineMetrics", name: str):
+        self.frames = metrics.frames.labels(name)
+        self.decode = metrics.stage_seconds.labels(name, "decode")
+        self.preprocess = metrics.stage_seconds.labels(name, "preprocess")
+        self.infer = metrics.stage_seconds.labels(name, "infer")
+        self.postprocess = metrics.stage_seconds.labels(name, "postprocess")
+        self.output = metrics.stage_seconds.labels(name, "output")
+
+
+class PipelineMetrics(Metrics):
+    """
+    Metrics of the people counter.
+
+    Values updated on every frame cost a lock and a bisection of the
+    histogram buckets; the others (drops, queue depths, counts, MQTT failures)
+    are read from their objects only when the metrics are served.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.frames = self.counter(
+            "people_counter_frames_total", "Frames counted.", ("stream",)
+        )
+        self.frames_dropped = self.counter(
+            "people_counter_frames_dropped_total",
+            "Frames dropped by a queue that was full.",
+            ("stream", "queue"),
+        )
+        self.stage_seconds = self.histogram(
+            "people_counter_stage_seconds",
+            "Time per frame of each stage; infer is from submitting a frame to "
+            "having its result, preprocess is 0 for frames resized on the device.",
+            ("stream", "stage"),
+        )
+        self.queue_depth = self.gauge(
+            "people_counter_queue_depth",
+            "Frames waiting in each queue, or infer requests in flight.",
+            ("stream", "queue"),
+        )
+        self.people = self.gauge(
+            "people_counter_people", "People in the frame.", ("stream",)
+        )
+        self.people_total = self.counter(
+            "people_counter_people_total", "People counted so far.", ("stream",)
+        )
+        self.mqtt_failures = self.counter(
+            "people_counter_mqtt_publish_failures_total",
+            "MQTT messages that could not be published.",
+        )
+        self.mqtt_dropped = self.counter(
+            "people_counter_mqtt_events_dropped_total",
+            "MQTT events dropped while the publisher was behind.",
+        )
+
+    def add_stream(
+        self, name: str, counter, grabber=None, sink=None, recorder=None
+    ) -> StreamMetrics:
+        """Serve the metrics of a stream, and return those updated per frame.
+
+        :param counter: the `PersonCounter` of the stream
+        :param grabber: its `FrameGrabber`
+        :param sink: its `RawFrameSink`
+        :param recorder: its `VideoRecorder`
+        """
+        self.people.labels(name, function=lambda: counter.last_count)
+        self.people_total.labels(name, function=lambda: counter.total_count)
+        for queue, source in (
+            ("decode", grabber),
+            ("ffmpeg", sink),
+            ("recorder", recorder),
+        ):
+            if source is None:
+                continue
+            self.queue_depth.labels(
+                name, queue, function=lambda source=source: source.queue_depth
+            )
+            if hasattr(source, "frames_dropped"):
+                self.frames_dropped.labels(
+                    name, queue, function=lambda source=source: source.frames_dropped
+                )
+        return StreamMetrics(self, name)
+
+    def add_network(self, network, name: str = "all"):
+        """Serve the number of infer requests in flight of a `Network`.
+
+        :param name: stream label, "all" for a network shared by the streams
+        """
+        self.queue_depth.labels(name, "infer", function=lambda: network.in_flight)
+
+    def add_publisher(self, publisher):
+        """Serve the failures of a `StatsPublisher`."""
+        self.mqtt_failures.labels(function=lambda: publisher.publish_failures)
+        self.mqtt_dropped.labels(function=lambda: publisher.events_dropped)
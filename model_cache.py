@@ -0,0 +1,63 @@
+"""On-disk cache of compiled models, to skip compiling them on every start."""
+
+import hashlib
+import json
+import os
+
+from loguru import logger
+
+
+class ModelCache:
+    """
+    Compiled (exported) executable networks, one file per key.
+
+    The key is a hash of the IR files and of every setting that changes the
+    compiled network (device, batch size, plugin config, toolkit version), so
+    a stale entry is never used: a change just compiles, and stores, a new one.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Params
+        ======
+        directory: str
+            Where the compiled models are stored, created if missing.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, model_xml: str, model_bin: str, **settings) -> str:
+        """Key of a model compiled with `settings` (JSON serialisable)."""
+        digest = hashlib.sha256()
+        for path in (model_xml, model_bin):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b""):
+                    digest.update(chunk)
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.blob")
+
+    def get(self, key: str) -> str:
+        """Path of the cached model, None if it is not cached."""
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def store(self, key: str, export):
+        """Store a model with `export(path)`, which writes it to `path`.
+
+        Failures are logged, not raised: not every plugin can export.
+        """
+        path = self.path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            export(temporary)
+            # Readers never see a partly written file.
+            os.replace(temporary, path)
+        except Exception as err:
+            logger.warning(f"Cannot cache the compiled model: {err}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        logger.info(f"Cached the compiled model to {path}")
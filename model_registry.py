@@ -0,0 +1,167 @@
+"""Find the precisions and toolkit versions of a model, and pick one per device."""
+
+import os
+import re
+
+from collections import namedtuple
+
+from loguru import logger
+
+# A model IR: the model name, its precision, the toolkit version that
+# converted it (None if unknown) and the path of its xml file.
+ModelVariant = namedtuple("ModelVariant", "name precision version xml")
+
+PRECISIONS = ("FP32", "FP16", "FP32-INT8", "FP16-INT8", "INT8")
+# Counts of the other variants are compared with this one.
+BASELINE = "FP32"
+# Precisions each device runs, fastest first.
+DEVICE_PRECISIONS = {
+    "CPU": ("FP32-INT8", "FP16-INT8", "INT8", "FP32", "FP16"),
+    "GPU": ("FP16-INT8", "FP16", "FP32-INT8", "INT8", "FP32"),
+    "MYRIAD": ("FP16",),
+    "HDDL": ("FP16",),
+}
+_DEFAULT_PRECISIONS = ("FP16", "FP32")
+
+# e.g. person-detection-retail-0013_openvino_2020.2.120
+_FILE_VERSION = re.compile(r"_openvino_(\d{4}(?:\.[A-Za-z0-9]+)*)", re.I)
+# e.g. a 2021.4 directory
+_DIR_VERSION = re.compile(r"^\d{4}(\.[A-Za-z0-9]+)+$")
+_FILE_PRECISION = re.compile(
+    r"[_-]({})$".format("|".join(re.escape(p) for p in PRECISIONS)), re.I
+)
+
+
+def version_key(version: str) -> tuple:
+    """Sortable key of a toolkit version, e.g. (2019, 3) for "2019.R3"."""
+    if not version:
+        return ()
+    return tuple(int(number) for number in re.findall(r"\d+", version))
+
+
+def toolkit_version() -> tuple:
+    """(year, release) of the installed OpenVINO, None without one."""
+    try:
+        from openvino.runtime import get_version
+    except ImportError:
+        try:
+            from openvino.inference_engine import get_version
+        except ImportError:
+            return None
+    # e.g. "2022.3.0-9052-9752fafe8eb-releases/2022/3", or with an API
+    # version first: "2.1.2021.4.0-3839-cd81789d294-releases/2021/4"
+    match = re.search(r"(20\d\d)\.(\d+)", get_version())
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def parse_variant(path: str, root: str) -> ModelVariant:
+    """Variant of the IR at `path`, relative to the models directory `root`.
+
+    Both the Open Model Zoo layout (`intel/<name>/<precision>/<name>.xml`) and
+    flat files (`<name>[_openvino_<version>][_<precision>].xml`) are
+    understood. Files without a precision are taken as FP32.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    directories = os.path.relpath(os.path.dirname(path), root).split(os.sep)
+
+    precision = next(
+        (part.upper() for part in reversed(directories) if part.upper() in PRECISIONS),
+        None,
+    )
+    match = _FILE_PRECISION.search(stem)
+    if match:
+        precision = precision or match.group(1).upper()
+        stem = stem[: match.start()]
+
+    version = next(
+        (part for part in reversed(directories) if _DIR_VERSION.match(part)), None
+    )
+    match = _FILE_VERSION.search(stem)
+    if match:
+        version = match.group(1)
+        stem = stem[: match.start()] + stem[match.end() :]
+    return ModelVariant(stem, precision or BASELINE, version, path)
+
+
+def find_variants(name: str, root: str = "models") -> list:
+    """Every IR of the model `name` under `root`, newest version first."""
+    variants = []
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            if filename.endswith(".xml"):
+                variant = parse_variant(os.path.join(directory, filename), root)
+                if variant.name == name:
+                    variants.append(variant)
+    variants.sort(key=lambda variant: version_key(variant.version), reverse=True)
+    return variants
+
+
+def device_precisions(device: str) -> tuple:
+    """Precisions `device` runs, fastest first.
+
+    The first device of MULTI and HETERO devices decides, e.g. CPU for
+    "HETERO:CPU,GPU".
+    """
+    device = device.split(":")[-1].split(",")[0].split(".")[0].upper()
+    return DEVICE_PRECISIONS.get(device, _DEFAULT_PRECISIONS)
+
+
+def supported_variants(variants: list, device: str, toolkit: tuple = None) -> list:
+    """The `variants` that `device` and the `toolkit` version can run.
+
+    IRs of a toolkit newer than the installed one are left out: older
+    toolkits cannot read newer IR versions.
+    """
+    precisions = device_precisions(device)
+    supported = [variant for variant in variants if variant.precision in precisions]
+    if toolkit is not None:
+        readable = [
+            variant
+            for variant in supported
+            if version_key(variant.version)[:2] <= toolkit
+        ]
+        supported = readable or supported
+    return supported
+
+
+def select_variant(
+    variants: list, device: str, precision: str = None, toolkit: tuple = None
+) -> ModelVariant:
+    """The fastest of `variants` (as sorted by `find_variants`) on `device`:
+    the fastest precision, then the newest toolkit version.
+
+    :param precision: only consider this precision, e.g. "FP16"
+    :param toolkit: installed toolkit version, see `toolkit_version`
+    """
+    candidates = supported_variants(variants, device, toolkit)
+    if precision is not None:
+        candidates = [v for v in candidates if v.precision == precision.upper()]
+    if not candidates:
+        raise ValueError(
+            f"No {precision + ' ' if precision else ''}variant for {device} among: "
+            + (", ".join(variant.xml for variant in variants) or "none")
+        )
+    precisions = device_precisions(device)
+    # Variants are sorted newest first, which `min` keeps among equals.
+    return min(candidates, key=lambda variant: precisions.index(variant.precision))
+
+
+def resolve_model(
+    model: str, device: str = "CPU", root: str = "models", precision: str = None
+) -> str:
+    """Path of the IR to load for `--model`.
+
+    :param model: path of an xml file, returned as is, or a model name
+    :return: the xml of the fastest variant of the model on `device`
+    """
+    if model.endswith(".xml") or os.path.isfile(model):
+        return model
+    variants = find_variants(model, root)
+    if not variants:
+        raise ValueError(f"No IR of the model {model!r} found in {root}.")
+    variant = select_variant(variants, device, precision, toolkit_version())
+    logger.info(
+        f"Using {variant.precision} {variant.name} "
+        f"(OpenVINO {variant.version or 'unknown version'}): {variant.xml}"
+    )
+    return variant.xml
@@ -0,0 +1,86 @@
+"""Skip inference on static scenes with a cheap background model."""
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Detect motion against a running-average background on a downscaled frame.
+
+    The background adapts to slow changes (lighting, moved furniture) instead
+    of being frozen to the first frame. The whole test runs on a frame of
+    `width` pixels wide, in buffers allocated once.
+    """
+
+    def __init__(
+        self,
+        width: int = 160,
+        alpha: float = 0.05,
+        threshold: int = 25,
+        min_area: float = 0.002,
+        max_idle: int = 150,
+    ):
+        """
+        Params
+        ======
+        width: int
+            Width the frames are downscaled to, the aspect ratio is kept.
+        alpha: float
+            Weight of each new frame in the running-average background.
+        threshold: int
+            Grey-level difference from the background that counts as motion.
+        min_area: float
+            Fraction of the frame that must move to report motion.
+        max_idle: int
+            Report motion after this many static frames in a row anyway, so
+            people standing still since start-up are eventually detected.
+        """
+        self.width = width
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_idle = max_idle
+        # Static frames that skipped the detector, counted by the caller: live
+        # tracks send static frames through it anyway.
+        self.frames_gated = 0
+        self._idle = 0
+        self._size = None
+        self._background = None
+
+    def _allocate(self, frame: np.ndarray):
+        height, width = frame.shape[:2]
+        self._size = (self.width, max(1, round(height * self.width / width)))
+        shape = self._size[::-1]
+        self._small = np.empty(shape + (3,), dtype=np.uint8)
+        self._gray = np.empty(shape, dtype=np.uint8)
+        self._blurred = np.empty(shape, dtype=np.uint8)
+        self._background_u8 = np.empty(shape, dtype=np.uint8)
+        self._delta = np.empty(shape, dtype=np.uint8)
+        self._min_pixels = self.min_area * shape[0] * shape[1]
+
+    def __call__(self, frame: np.ndarray) -> bool:
+        """Update the background with `frame` and report whether it moved."""
+        if self._background is None:
+            self._allocate(frame)
+        cv2.resize(frame, self._size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._blurred)
+
+        if self._background is None:
+            self._background = self._blurred.astype(np.float32)
+            return True
+
+        cv2.convertScaleAbs(self._background, dst=self._background_u8)
+        cv2.absdiff(self._blurred, self._background_u8, dst=self._delta)
+        cv2.threshold(
+            self._delta, self.threshold, 255, cv2.THRESH_BINARY, dst=self._delta
+        )
+        moving = cv2.countNonZero(self._delta) >= self._min_pixels
+        cv2.accumulateWeighted(self._blurred, self._background, self.alpha)
+
+        if moving or self._idle >= self.max_idle:
+            self._idle = 0
+            return True
+        self._idle += 1
+        return False
@@ -0,0 +1,345 @@
+"""Count the people of one stream frame by frame, with all of its state."""
+
+import time
+
+from collections import namedtuple
+
+import cv2
+
+from batching import BatchScheduler
+from counter import make_counter
+from detections import PERSON, draw_detections, parse_detections
+from journal import JournalWriter
+from motion import MotionGate
+from skipping import FrameSkipper
+from tracker import draw_tracks
+
+# A counted frame: its index in the stream, the time the counter was updated
+# with, the people in the frame and counted so far, and the detections and
+# inference time of the frame, None on frames the detector skipped.
+FrameResult = namedtuple(
+    "FrameResult", "frame index timestamp count total_count detections infer_time"
+)
+
+
+def video_frames(source: str):
+    """Generator of the frames of a video file or camera, for `StreamPipeline.run`."""
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise RuntimeError(f"Cannot open video source {source!r}.")
+    try:
+        while True:
+            grabbed, frame = capture.read()
+            if not grabbed:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+class StreamPipeline:
+    """
+    Detect, track and count the people of one stream.
+
+    Frames are pushed with `process`, which returns the frames counted since,
+    oldest first: inference is asynchronous, so a frame is usually returned by
+    a later call, and `flush` returns the last ones. `run` wraps both into a
+    generator of one result per frame.
+
+    Every piece of state of the stream (counts, tracks, frame skipping, motion
+    gate, journal, inference times) belongs to the pipeline, so pipelines can
+    run side by side: several in one thread over a shared `BatchScheduler`,
+    or one per thread with a `Network` each.
+
+    Callers that run inference themselves push frames with `admit` instead,
+    and hand them back in order to `handle_result` or `handle_skipped`.
+    """
+
+    def __init__(
+        self,
+        network: object,
+        counter: object,
+        width: int,
+        height: int,
+        prob_threshold: float = 0.5,
+        classes: tuple = (PERSON,),
+        scheduler: BatchScheduler = None,
+        skipper: FrameSkipper = None,
+        motion_gate: MotionGate = None,
+        journal: JournalWriter = None,
+        annotate: bool = False,
+        metrics: object = None,
+    ):
+        """
+        Params
+        ======
+        network: Network
+            Loaded network, not shared with another thread. None when the
+            caller runs inference itself, see `admit`.
+        counter: PersonCounter
+            Counting state of the stream.
+        width, height: int
+            Frame size, to scale the detections to.
+        prob_threshold: float
+            Lowest confidence of a detection.
+        classes: tuple
+            Labels of the detections to count.
+        scheduler: BatchScheduler (optional)
+            Batches of the network, shared by the pipelines of the network.
+            One is created by default.
+        skipper: FrameSkipper (optional)
+            Frames to run the detector on, every frame by default.
+        motion_gate: MotionGate (optional)
+            Skip the detector on static frames with nobody tracked.
+        journal: JournalWriter (optional)
+            Journal to append the detections of every frame to.
+        annotate: bool
+            Draw the detections, or tracks, and zones onto the frames.
+        metrics: StreamMetrics (optional)
+            Metrics to observe the preprocess, infer and postprocess times with.
+        """
+        self.network = network
+        self.counter = counter
+        self.width = width
+        self.height = height
+        self.prob_threshold = prob_threshold
+        self.classes = tuple(classes)
+        if scheduler is None and network is not None:
+            scheduler = BatchScheduler(network)
+        self.scheduler = scheduler
+        self.skipper = skipper or FrameSkipper()
+        self.motion_gate = motion_gate
+        self.journal = journal
+        self.annotate = annotate
+        self.metrics = metrics
+        self.frames = 0
+        self.infer_seconds = 0.0
+        self.inferred = 0
+        # Userdata of the latest frame submitted:
+        # [pipeline, frame, index, timestamp, start time, skipped frames]
+        self._last_submitted = None
+        self._ready = []
+
+    @classmethod
+    def from_args(
+        cls,
+        args,
+        network: object,
+        width: int,
+        height: int,
+        publisher: object = None,
+        topic: str = "person",
+        scheduler: BatchScheduler = None,
+        journal: str = None,
+        fps: float = 0.0,
+        annotate: bool = False,
+    ):
+        """A pipeline with the options of the command line.
+
+        :param args: Command line arguments parsed by `main.build_argparser()`
+        :param publisher: `StatsPublisher`, or None not to publish
+        :param topic: base MQTT topic of the counts
+        :param scheduler: see `StreamPipeline`, by default one with the
+            --batch-timeout of `args`
+        :param journal: path of the journal to write, None not to write one
+        :param fps: frame rate of the stream, for the journal
+        """
+        return cls(
+            network,
+            make_counter(args, publisher, width, height, topic),
+            width,
+            height,
+            prob_threshold=args.prob_threshold,
+            classes=args.classes,
+            scheduler=scheduler
+            or (
+                BatchScheduler(network, max_wait=args.batch_timeout / 1000)
+                if network is not None
+                else None
+            ),
+            skipper=FrameSkipper(args.detect_every, adaptive=args.adaptive_skip),
+            motion_gate=(
+                MotionGate(min_area=args.motion_min_area) if args.motion_gate else None
+            ),
+            journal=(
+                JournalWriter(
+                    journal, width, height, fps=fps, min_conf=args.journal_min_conf
+                )
+                if journal
+                else None
+            ),
+            annotate=annotate,
+        )
+
+    @property
+    def mean_infer_time(self) -> float:
+        """Average seconds from submitting a frame to having its result."""
+        return self.infer_seconds / self.inferred if self.inferred else 0.0
+
+    def process(self, frame, timestamp: float = None) -> list:
+        """Count the next frame of the stream.
+
+        :param frame: BGR frame, not to be reused until it is returned
+        :param timestamp: time of the frame in seconds, the time its result
+            comes back by default
+        :return: `FrameResult`s of the frames counted since the last call,
+            oldest first
+        """
+        index = self.frames
+        self.frames += 1
+        last = self._last_submitted
+        if self._gated(frame):
+            # Gated frames can go on for long, so do not hold them behind
+            # requests in flight (their buffers would run out).
+            if last is not None and last[5] is not None:
+                self.dispatch(self.scheduler.drain())
+            self.handle_skipped(frame, index, timestamp)
+        elif not self.skipper.should_detect():
+            # Counted in order, right after the detector frame before it.
+            if last is not None and last[5] is not None:
+                last[5].append((frame, index, timestamp))
+            else:
+                self.handle_skipped(frame, index, timestamp)
+        else:
+            # Keep up to `num_requests` batches in flight: the oldest result is
+            # only collected once the ring is full and its request is needed again.
+            self._last_submitted = [self, frame, index, timestamp, time.time(), []]
+            results = self.scheduler.add(frame, userdata=self._last_submitted)
+            if self.metrics:
+                self.metrics.preprocess.observe(self.scheduler.preprocess_time)
+            self.dispatch(results)
+        return self.results()
+
+    def admit(self, frame) -> tuple:
+        """Number the next frame of the stream and decide whether to run the
+        detector on it, for callers running inference themselves.
+
+        The frame must then be handed, in stream order, to `handle_result`
+        with the output of the network, or to `handle_skipped`. The decision
+        depends on the frames handled so far, so keep few frames in between.
+
+        :return: (index of the frame, whether to run the detector)
+        """
+        index = self.frames
+        self.frames += 1
+        return index, not self._gated(frame) and self.skipper.should_detect()
+
+    def _gated(self, frame) -> bool:
+        """Whether the motion gate keeps `frame` from the detector."""
+        moving = self.motion_gate is None or self.motion_gate(frame)
+        if moving or self.counter.tracker.ids.size:
+            return False
+        # Static scene and nobody tracked: no need for the detector.
+        self.motion_gate.frames_gated += 1
+        return True
+
+    def timeout(self):
+        """Seconds until the current partial batch is due, None if it is empty."""
+        return self.scheduler.timeout()
+
+    def poll(self) -> list:
+        """Submit the partial batch if it is due, see `process`."""
+        self.scheduler.poll()
+        return self.results()
+
+    def collect(self) -> list:
+        """Wait for the oldest batch in flight, see `process`."""
+        self.dispatch(self.scheduler.collect())
+        return self.results()
+
+    def flush(self) -> list:
+        """Wait for every frame in flight, see `process`."""
+        self.dispatch(self.scheduler.drain())
+        return self.results()
+
+    def results(self) -> list:
+        """The frames counted and not returned yet, oldest first."""
+        ready, self._ready = self._ready, []
+        return ready
+
+    def run(self, frames):
+        """Count every frame of `frames`, e.g. `video_frames(source)`.
+
+        :return: generator of a `FrameResult` per frame, in order
+        """
+        for frame in frames:
+            yield from self.process(frame)
+        yield from self.flush()
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+    @staticmethod
+    def dispatch(results: list):
+        """Hand the results of a shared `BatchScheduler` to their pipelines."""
+        for userdata, output in results:
+            pipeline, frame, index, timestamp, start_infer, skipped = userdata
+            infer_time = time.time() - start_infer
+            pipeline.handle_result(output, frame, index, infer_time, timestamp)
+            # The frames skipped by the detector after this one can now be counted.
+            userdata[5] = None
+            for skipped_frame in skipped:
+                pipeline.handle_skipped(*skipped_frame)
+
+    def handle_result(
+        self, output, frame, index: int, infer_time: float, timestamp: float = None
+    ):
+        """Count a frame the detector ran on.
+
+        :param output: raw output of the network on `frame`
+        :param index: index of the frame in the stream
+        :param infer_time: seconds from submitting the frame to having `output`
+        :param timestamp: see `process`
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        self.infer_seconds += infer_time
+        self.inferred += 1
+        if self.metrics:
+            self.metrics.infer.observe(infer_time)
+        if self.journal:
+            self.journal.write(output, timestamp)
+        start_postprocess = time.perf_counter()
+        detections = parse_detections(
+            output, self.prob_threshold, self.width, self.height, classes=self.classes
+        )
+        count = self.counter.update(detections, timestamp)
+        self.skipper.feedback(self.counter.active)
+        if self.metrics:
+            self.metrics.postprocess.observe(time.perf_counter() - start_postprocess)
+
+        if self.annotate:
+            message = f"Inference time: {infer_time*1000:.2f}ms"
+            cv2.putText(
+                frame, message, (20, 20), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0, 0, 0), 1
+            )
+            draw_detections(frame, detections)
+            if self.counter.zones:
+                self.counter.zones.draw(frame)
+        self._ready.append(
+            FrameResult(
+                frame,
+                index,
+                timestamp,
+                count,
+                self.counter.total_count,
+                detections,
+                infer_time,
+            )
+        )
+
+    def handle_skipped(self, frame, index: int, timestamp: float = None):
+        """Count a frame the detector did not run on, see `handle_result`."""
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.journal:
+            self.journal.skip(timestamp)
+        count = self.counter.predict()
+        if self.annotate:
+            draw_tracks(frame, self.counter.tracker)
+            if self.counter.zones:
+                self.counter.zones.draw(frame)
+        self._ready.append(
+            FrameResult(
+                frame, index, timestamp, count, self.counter.total_count, None, None
+            )
+        )
@@ -0,0 +1,39 @@
+"""Allocation-free frame preprocessing for the inference network."""
+
+import cv2
+import numpy as np
+
+
+class Preprocessor:
+    """
+    Resize frames and change their layout from HWC to NCHW, reusing buffers.
+
+    Every intermediate image is allocated once, so steady-state preprocessing
+    does not allocate. The NCHW result is written either into the
+    preprocessor's own input buffer or into a caller supplied one, such as the
+    input blob of an infer request.
+    """
+
+    def __init__(self, input_shape: list):
+        """
+        Params
+        ======
+        input_shape: list
+            Network input shape, [batch, channel, height, width].
+        """
+        _, channel, height, width = input_shape
+        self.size = (width, height)
+        self._resized = np.empty((height, width, channel), dtype=np.uint8)
+        self.input_buffer = np.empty((1, channel, height, width), dtype=np.uint8)
+
+    def __call__(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Preprocess `frame` into `out`, or into `input_buffer` if None.
+
+        :return: the filled NCHW buffer
+        """
+        out = self.input_buffer if out is None else out
+        cv2.resize(frame, self.size, dst=self._resized)
+        # A single strided copy does the HWC -> CHW transpose (and any dtype
+        # conversion required by the blob).
+        np.copyto(out.reshape(out.shape[-3:]), self._resized.transpose(2, 0, 1))
+        return out
@@ -0,0 +1,119 @@
+"""Performance profiles: plugin settings and number of infer requests."""
+
+import json
+import os
+
+from loguru import logger
+
+# Settings understood by the backends, None leaves the plugin default:
+#   nstreams: int or "auto", parallel inference streams of the device
+#   nthreads: int, inference threads (CPU)
+#   pin: "YES", "NO", "NUMA" or "HYBRID_AWARE", thread pinning (CPU)
+#   hint: "LATENCY" or "THROUGHPUT", OpenVINO 2022+ performance hint
+#   precision: e.g. "bf16" or "f32", inference precision where supported
+#   num_requests: int, infer requests, 0 for the device's optimal number
+SETTINGS = ("nstreams", "nthreads", "pin", "hint", "precision", "num_requests")
+
+PROFILES = {
+    # One stream and one request: the shortest time per frame.
+    "latency": {"hint": "LATENCY", "nstreams": 1, "pin": "YES", "num_requests": 1},
+    # As many streams as the device can run, each kept busy by its own request.
+    "throughput": {"hint": "THROUGHPUT", "nstreams": "auto", "num_requests": 0},
+    # A couple of unpinned threads, the other cores stay idle.
+    "low-power": {"nstreams": 1, "nthreads": 2, "pin": "NO", "num_requests": 1},
+}
+
+TUNED_PROFILES = os.path.join(
+    os.path.expanduser("~"), ".config", "people-counter", "tuned.json"
+)
+
+
+def nstreams(text: str):
+    """Parse an --nstreams argument, a number or "auto"."""
+    return text.lower() if text.lower() == "auto" else int(text)
+
+
+def host_key(device: str, model_xml: str) -> str:
+    """Identify the hardware, device and model a tuned profile applies to.
+
+    The CPU model and core count are used rather than the host name, which
+    changes with every container.
+    """
+    cpu = "unknown CPU"
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next(
+                line.split(":", 1)[1].strip()
+                for line in f
+                if line.startswith("model name")
+            )
+    except (OSError, StopIteration):
+        pass
+    return f"{cpu} x{os.cpu_count()}/{device}/{os.path.basename(model_xml)}"
+
+
+def load_tuned(key: str, path: str = TUNED_PROFILES) -> dict:
+    """Settings saved by `save_tuned` for `key`, None if there are none."""
+    try:
+        with open(path) as f:
+            return json.load(f).get(key)
+    except FileNotFoundError:
+        return None
+
+
+def save_tuned(key: str, settings: dict, path: str = TUNED_PROFILES):
+    """Save the best settings found for `key`, keeping those of other keys."""
+    tuned = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            tuned = json.load(f)
+    tuned[key] = settings
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(tuned, f, indent=2, sort_keys=True)
+
+
+def tune_candidates(cpus: int = None) -> list:
+    """Settings worth trying on a host with `cpus` cores."""
+    cpus = cpus or os.cpu_count() or 1
+    candidates = [PROFILES["latency"]]
+    for streams in sorted({2, 4, cpus // 4, cpus // 2}):
+        if 1 < streams <= cpus:
+            for requests in (streams, 2 * streams):
+                candidates.append(
+                    {"nstreams": streams, "pin": "YES", "num_requests": requests}
+                )
+    candidates.append(PROFILES["throughput"])
+    return candidates
+
+
+def performance_settings(args) -> dict:
+    """Resolve the settings of the --profile and the explicit options.
+
+    Explicit options (--nstreams, --nthreads, --pin, --precision,
+    --num-requests) override the profile. Without either, plugin defaults
+    and one infer request are used.
+
+    :param args: Command line arguments
+    :return: settings, see `SETTINGS`
+    """
+    settings = dict.fromkeys(SETTINGS)
+    if args.profile == "tuned":
+        key = host_key(args.device, args.model)
+        tuned = load_tuned(key, args.tuned_profiles)
+        if tuned is None:
+            logger.warning(
+                f"No tuned profile for {key} in {args.tuned_profiles}, "
+                "run benchmark.py --tune first. Using the defaults."
+            )
+        settings.update(tuned or {})
+    elif args.profile:
+        settings.update(PROFILES[args.profile])
+
+    for name in SETTINGS:
+        value = getattr(args, name, None)
+        if value is not None:
+            settings[name] = value
+    if settings["num_requests"] is None:
+        settings["num_requests"] = 1
+    return settings
@@ -0,0 +1,74 @@
+"""Per-stage latency statistics and process resource usage."""
+
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    Collect the durations of the pipeline stages, for percentiles at the end.
+
+    Durations are kept in seconds, per stage name, in the order the stages
+    were first recorded.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    def record(self, stage: str, seconds: float):
+        """Add one duration of `stage`."""
+        self.durations.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the body of a `with` block as one run of `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, func):
+        """Wrap `func` so each of its calls is recorded as a run of `stage`."""
+
+        def wrapper(*args, **kwargs):
+            with self.time(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def reset(self):
+        """Forget every duration, e.g. after warming up."""
+        self.durations = {}
+
+    def summary(self, percentiles=(50, 90, 99)) -> dict:
+        """Statistics of every stage, in milliseconds.
+
+        :return: {stage: {"count", "mean_ms", "p50_ms", ..., "max_ms"}}
+        """
+        summary = {}
+        for stage, durations in self.durations.items():
+            milliseconds = np.array(durations) * 1000
+            stats = {"count": len(durations), "mean_ms": float(milliseconds.mean())}
+            for percentile, value in zip(
+                percentiles, np.percentile(milliseconds, percentiles)
+            ):
+                stats[f"p{percentile}_ms"] = float(value)
+            stats["max_ms"] = float(milliseconds.max())
+            summary[stage] = stats
+        return summary
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows.
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
@@ -0,0 +1,168 @@
+"""Coalescing, non-blocking MQTT publishing of the counting stats."""
+
+import json
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+
+class StatsPublisher:
+    """
+    Publish stats from a background thread so the frame loop never waits on I/O.
+
+    Two kinds of messages are handled:
+
+    * state (`update`), such as the current count: only the latest value of
+      each topic is kept, and a topic is sent when its value changed, at most
+      once every `interval` seconds.
+    * events (`publish`), such as the duration of a visit: every one is sent,
+      in order, as soon as possible.
+
+    The frame loop only touches a dict and a deque under a lock; JSON encoding
+    and the client calls happen on the publisher thread. The client is expected
+    to run its own network loop (`loop_start`), which reconnects with backoff;
+    state that fails to send is retried on the next flush.
+    """
+
+    # Seconds between attempts to send state while the client is disconnected.
+    RETRY_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        client: object,
+        interval: float = 0.5,
+        combine_topic: str = None,
+        max_events: int = 1024,
+    ):
+        """
+        Params
+        ======
+        client: paho.mqtt.client.Client
+            Connected client, with its network loop started.
+        interval: float
+            Minimum time between two sends of the state, in seconds. 0 sends
+            every change.
+        combine_topic: str (optional)
+            Send all the changed state, from every stream, as one JSON object
+            {topic: state} on this topic instead of one message per topic.
+        max_events: int
+            Events kept while the publisher is behind, the oldest are dropped.
+        """
+        self.client = client
+        self.interval = interval
+        self.combine_topic = combine_topic
+        self.events_dropped = 0
+        self.publish_failures = 0
+        self._state = {}
+        self._sent = {}
+        # Topics whose state changed since the last flush, in insertion order.
+        self._dirty = {}
+        self._events = deque(maxlen=max_events)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the publisher thread."""
+        self._thread.start()
+        return self
+
+    def update(self, topic: str, payload: dict):
+        """Set the latest state of `topic`, merged with its previous keys."""
+        with self._cond:
+            state = self._state.setdefault(topic, {})
+            if all(state.get(key) == value for key, value in payload.items()):
+                return
+            state.update(payload)
+            if topic not in self._dirty:
+                self._dirty[topic] = None
+                self._cond.notify()
+
+    def publish(self, topic: str, payload: dict):
+        """Queue an event to be sent as soon as possible."""
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.events_dropped += 1
+            self._events.append((topic, payload))
+            self._cond.notify()
+
+    def stop(self):
+        """Flush everything pending, then stop the thread and the client."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        if self.events_dropped:
+            logger.warning(f"Dropped {self.events_dropped} MQTT events.")
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while True:
+            with self._cond:
+                # Sleep until there is an event, or changed state to flush.
+                while not (self._stopped or self._events):
+                    if self._dirty:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                events = list(self._events)
+                self._events.clear()
+                states = {}
+                if self._stopped or time.monotonic() >= deadline:
+                    states = {topic: dict(self._state[topic]) for topic in self._dirty}
+                    self._dirty.clear()
+                    deadline = time.monotonic() + self.interval
+                stopped = self._stopped
+
+            for topic, payload in events:
+                self._send(topic, payload)
+            if not self._send_states(states) and not stopped:
+                deadline = max(deadline, time.monotonic() + self.RETRY_INTERVAL)
+            if stopped:
+                return
+
+    def _send_states(self, states: dict) -> bool:
+        """Send the state that changed since it was last sent.
+
+        :return: False if some of it could not be sent
+        """
+        states = {
+            topic: state
+            for topic, state in states.items()
+            if self._sent.get(topic) != state
+        }
+        if not states:
+            return True
+        if self.combine_topic:
+            failed = [] if self._send(self.combine_topic, states) else list(states)
+        else:
+            failed = [
+                topic for topic, state in states.items() if not self._send(topic, state)
+            ]
+        for topic, state in states.items():
+            if topic not in failed:
+                self._sent[topic] = state
+        if failed:
+            # Not connected: send the latest state again on a later flush.
+            with self._cond:
+                for topic in failed:
+                    self._dirty[topic] = None
+        return not failed
+
+    def _send(self, topic: str, payload: dict) -> bool:
+        try:
+            info = self.client.publish(topic, json.dumps(payload))
+        except Exception as err:
+            logger.debug(f"Failed to publish to {topic}: {err}")
+            self.publish_failures += 1
+            return False
+        if info.rc != 0:
+            self.publish_failures += 1
+        return info.rc == 0
@@ -0,0 +1,355 @@
+"""Video outputs written from background threads: ffmpeg server and recordings."""
+
+import os
+import struct
+import sys
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+from loguru import logger
+
+SHM_PREFIX = "shm:"
+
+
+class SharedMemoryRing:
+    """
+    Ring of raw frames in shared memory, for readers on the same host.
+
+    The block starts with a header of little-endian fields::
+
+        uint64 frames written, uint32 slots, uint32 height, uint32 width,
+        uint32 channels
+
+    followed by `slots` frames of height x width x channels bytes. Frame `n`
+    is in slot `n % slots`; it is complete once the frame counter is past `n`.
+    """
+
+    HEADER = struct.Struct("<QIIII")
+
+    def __init__(self, name: str, shape: tuple, slots: int = 8):
+        # Only in Python 3.8+, imported here so the other outputs do not need it.
+        from multiprocessing import shared_memory
+
+        self.frame_size = int(np.prod(shape))
+        self.slots = slots
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=True, size=self.HEADER.size + slots * self.frame_size
+        )
+        self._frames = np.ndarray(
+            (slots,) + tuple(shape), np.uint8, self._shm.buf, self.HEADER.size
+        )
+        self._count = 0
+        self.HEADER.pack_into(self._shm.buf, 0, 0, slots, *shape)
+
+    def write(self, frame: np.ndarray):
+        np.copyto(self._frames[self._count % self.slots], frame)
+        self._count += 1
+        struct.pack_into("<Q", self._shm.buf, 0, self._count)
+
+    def close(self):
+        del self._frames
+        self._shm.close()
+        self._shm.unlink()
+
+
+class RawFrameSink:
+    """
+    Write raw BGR frames from a dedicated thread, dropping them under backpressure.
+
+    `write` copies (or downscales) the frame into one of `queue_size`
+    preallocated buffers and returns at once, so the caller can reuse its
+    frame. When every buffer is still waiting to be written, because the
+    reader (e.g. ffmpeg) is slower than the video, the frame is dropped rather
+    than stalling the caller.
+
+    Frames stay BGR: pass `-pixel_format bgr24` to ffmpeg instead of
+    converting them here.
+    """
+
+    def __init__(self, target: str = "-", size: tuple = None, queue_size: int = 4):
+        """
+        Params
+        ======
+        target: str
+            "-" for stdout, "shm:<name>" for a `SharedMemoryRing`, otherwise
+            the path of a file or named pipe (see `mkfifo`).
+        size: tuple (optional)
+            (width, height) to downscale the frames to, the input size if None.
+        queue_size: int
+            Frames waiting to be written before new ones are dropped.
+        """
+        self.target = target
+        self.size = size
+        self.queue_size = queue_size
+        self.frames_dropped = 0
+        self._shape = None
+        self._free = deque()
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._broken = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread.start()
+        return self
+
+    def write(self, frame: np.ndarray) -> bool:
+        """Queue a frame, without blocking.
+
+        :return: False if the frame was dropped
+        """
+        with self._cond:
+            if self._shape is None:
+                # First frame, its shape sizes the buffers.
+                width, height = self.size or frame.shape[1::-1]
+                self._shape = (height, width) + frame.shape[2:]
+                self._free.extend(
+                    np.empty(self._shape, np.uint8) for _ in range(self.queue_size)
+                )
+            if not self._free or self._broken:
+                self.frames_dropped += 1
+                return False
+            buffer = self._free.popleft()
+
+        size = buffer.shape[1::-1]
+        if size != frame.shape[1::-1]:
+            cv2.resize(frame, size, dst=buffer, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(buffer, frame)
+
+        with self._cond:
+            self._ready.append(buffer)
+            self._cond.notify()
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of frames waiting to be written."""
+        return len(self._ready)
+
+    def close(self):
+        """Write the frames still queued, then stop the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        if self.frames_dropped:
+            logger.info(f"Dropped {self.frames_dropped} frames of the video output.")
+
+    def _open(self, shape: tuple):
+        if self.target == "-":
+            return os.fdopen(sys.stdout.fileno(), "wb", buffering=0, closefd=False)
+        if self.target.startswith(SHM_PREFIX):
+            return SharedMemoryRing(self.target[len(SHM_PREFIX) :], shape)
+        # Opening a named pipe blocks until it has a reader.
+        return open(self.target, "wb", buffering=0)
+
+    def _run(self):
+        output = None
+        try:
+            while True:
+                with self._cond:
+                    while not self._ready and not self._stopped:
+                        self._cond.wait()
+                    if not self._ready:
+                        return
+                    buffer = self._ready.popleft()
+
+                if output is None:
+                    output = self._open(buffer.shape)
+                if isinstance(output, SharedMemoryRing):
+                    output.write(buffer)
+                else:
+                    view = memoryview(buffer).cast("B")
+                    while view:
+                        view = view[output.write(view) :]
+
+                with self._cond:
+                    self._free.append(buffer)
+        except OSError as err:
+            logger.error(f"Video output to {self.target!r} failed: {err}")
+            with self._cond:
+                self._broken = True
+        finally:
+            if output is not None:
+                output.close()
+
+
+class VideoRecorder:
+    """
+    Encode the output video on a background thread.
+
+    `write` copies (or resizes to `size`) each frame into a bounded pool of
+    buffers, and a thread that owns the `cv2.VideoWriter` encodes them, so
+    encoding overlaps with inference. When the encoder falls behind, `write`
+    waits for a buffer rather than leaving frames out of the recording.
+
+    With `clips`, only the frames around events (people entering or leaving)
+    are recorded, each clip to its own numbered file: the last `clip_before`
+    seconds of frames are held in the pool, and a clip ends `clip_after`
+    seconds after its last event.
+    """
+
+    def __init__(
+        self,
+        path: str = "out.mp4",
+        fourcc: str = "mp4v",
+        fps: float = 30.0,
+        size: tuple = None,
+        queue_size: int = 8,
+        clips: bool = False,
+        clip_before: float = 2.0,
+        clip_after: float = 3.0,
+        progress: object = None,
+    ):
+        """
+        Params
+        ======
+        path: str
+            Output video, clips are written to `<path stem>_<n><ext>`.
+        fourcc: str
+            Four character code of the codec, e.g. "mp4v" or "MJPG".
+        fps: float
+            Frame rate of the output video.
+        size: tuple (optional)
+            (width, height) to resize the frames to, the input size if None.
+        queue_size: int
+            Frames waiting to be encoded before `write` blocks.
+        clips: bool
+            Only record clips around the frames written with `event=True`.
+        clip_before, clip_after: float
+            Seconds recorded before the first and after the last event of a clip.
+        progress: callable (optional)
+            Called with 1 by the writer thread for every frame encoded.
+        """
+        self.path = path
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.fps = fps
+        self.size = size
+        self.queue_size = queue_size
+        self.clips = clips
+        self.progress = progress
+        self.clips_recorded = 0
+        self._before = round(clip_before * fps) if clips else 0
+        self._after = round(clip_after * fps)
+        self._remaining = 0
+        self._recording = not clips
+        self._shape = None
+        self._free = deque()
+        self._preroll = deque()
+        # Buffers to encode, None closes the current clip.
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread.start()
+        return self
+
+    def write(self, frame: np.ndarray, event: bool = False):
+        """Queue a frame, blocking while every buffer is waiting to be encoded.
+
+        :param event: something happened on this frame, starts or extends a clip
+        """
+        if not (self._recording or event or self._before):
+            return
+        buffer = self._buffer(frame)
+        size = buffer.shape[1::-1]
+        if size != frame.shape[1::-1]:
+            cv2.resize(frame, size, dst=buffer, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(buffer, frame)
+
+        with self._cond:
+            if self.clips:
+                if event:
+                    if not self._recording:
+                        self._recording = True
+                        self.clips_recorded += 1
+                        self._queue.extend(self._preroll)
+                        self._preroll.clear()
+                    self._remaining = self._after
+                elif self._recording:
+                    self._remaining -= 1
+                else:
+                    self._preroll.append(buffer)
+                    return
+            self._queue.append(buffer)
+            if self.clips and self._remaining <= 0:
+                self._recording = False
+                self._queue.append(None)
+            self._cond.notify_all()
+
+    def _buffer(self, frame: np.ndarray) -> np.ndarray:
+        """Take a free buffer, or the oldest frame held before a clip."""
+        with self._cond:
+            if self._shape is None:
+                width, height = self.size or frame.shape[1::-1]
+                self._shape = (height, width) + frame.shape[2:]
+                self._free.extend(
+                    np.empty(self._shape, np.uint8)
+                    for _ in range(self.queue_size + self._before)
+                )
+            if self._preroll and len(self._preroll) >= self._before:
+                return self._preroll.popleft()
+            while not self._free:
+                self._cond.wait()
+            return self._free.popleft()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of frames waiting to be encoded."""
+        return len(self._queue)
+
+    def close(self):
+        """Encode the frames still queued, then stop the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _open(self, index: int) -> cv2.VideoWriter:
+        path = self.path
+        if self.clips:
+            root, ext = os.path.splitext(self.path)
+            path = f"{root}_{index:04d}{ext}"
+        writer = cv2.VideoWriter(path, self.fourcc, self.fps, self._shape[1::-1])
+        if writer.isOpened():
+            logger.debug(f"Recording to {path}.")
+        else:
+            logger.error(f"Cannot open {path} for writing, frames are discarded.")
+        return writer
+
+    def _run(self):
+        writer = None
+        opened = 0
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                buffer = self._queue.popleft()
+
+            if buffer is None:
+                writer.release()
+                writer = None
+                continue
+            if writer is None:
+                opened += 1
+                writer = self._open(opened)
+            writer.write(buffer)
+            if self.progress is not None:
+                self.progress(1)
+
+            with self._cond:
+                self._free.append(buffer)
+                self._cond.notify_all()
+        if writer is not None:
+            writer.release()
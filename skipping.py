@@ -0,0 +1,47 @@
+"""Run the detector on a subset of frames."""
+
+
+class FrameSkipper:
+    """
+    Decide which frames go through the detector.
+
+    With a fixed interval the detector runs on every `interval`-th frame and
+    the tracker's motion model covers the frames in between. In adaptive mode
+    the interval starts at 1, grows by one after every detection on a quiet
+    scene up to `interval`, and falls back to 1 as soon as there is activity.
+    """
+
+    def __init__(self, interval: int = 1, adaptive: bool = False):
+        """
+        Params
+        ======
+        interval: int
+            Run the detector every `interval` frames, the maximum interval in
+            adaptive mode.
+        adaptive: bool
+            Adapt the interval to the scene activity reported by `feedback`.
+        """
+        if interval < 1:
+            raise ValueError(f"interval must be >= 1, got {interval}")
+        self.max_interval = interval
+        self.adaptive = adaptive
+        self.interval = 1 if adaptive else interval
+        self._countdown = 0
+
+    def should_detect(self) -> bool:
+        """Whether the next frame should run through the detector."""
+        if self._countdown <= 0:
+            self._countdown = self.interval - 1
+            return True
+        self._countdown -= 1
+        return False
+
+    def feedback(self, active: bool):
+        """Report whether the latest detector frame showed scene activity."""
+        if not self.adaptive:
+            return
+        if active:
+            self.interval = 1
+            self._countdown = 0
+        else:
+            self.interval = min(self.interval + 1, self.max_interval)
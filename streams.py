@@ -0,0 +1,214 @@
+"""Serve many camera streams from one process over a shared `Network`."""
+
+import json
+import time
+
+import cv2
+
+from batching import BatchScheduler
+from capture import FrameGrabber, should_drop_oldest
+from inference import Network
+from journal import journal_path
+from metrics import PipelineMetrics
+from loguru import logger
+from pipeline import StreamPipeline
+from profiles import performance_settings
+
+
+def load_sources(inputs: list = None, config: str = None) -> list:
+    """Collect the (name, source) pairs of the streams to serve.
+
+    The config file is JSON, either a mapping of stream name to source or a
+    list whose items are sources or `{"name": ..., "source": ...}` objects.
+    Streams given without a name are called `cam<index>`.
+
+    :param inputs: sources given on the command line
+    :param config: path to a JSON config file of sources
+    :return: list of (name, source) tuples
+    """
+    entries = list(inputs or [])
+    if config:
+        with open(config) as f:
+            data = json.load(f)
+        entries.extend(data.items() if isinstance(data, dict) else data)
+
+    sources = []
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict):
+            entry = entry.get("name", f"cam{index}"), entry["source"]
+        elif isinstance(entry, str):
+            entry = f"cam{index}", entry
+        name, source = entry
+        sources.append((str(name), str(source)))
+
+    names = [name for name, _ in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stream names must be unique, got {names}")
+    return sources
+
+
+class CameraStream:
+    """One input stream: its decode thread and its own `StreamPipeline`."""
+
+    def __init__(
+        self,
+        name: str,
+        source: str,
+        publisher: object,
+        args: object,
+        network: object,
+        scheduler: BatchScheduler,
+        num_requests: int = 1,
+    ):
+        self.name = name
+        self.source = source
+        # Camera indices are passed to OpenCV as integers.
+        self.capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Cannot open video source {source!r} of {name}.")
+        self.width = int(self.capture.get(3))
+        self.height = int(self.capture.get(4))
+        self.grabber = FrameGrabber(
+            self.capture,
+            queue_size=args.decode_queue_size,
+            drop_oldest=should_drop_oldest(args.decode_policy, source),
+            num_held=(num_requests + 1) * args.batch_size * args.detect_every,
+        )
+        self.pipeline = StreamPipeline.from_args(
+            args,
+            network,
+            self.width,
+            self.height,
+            publisher,
+            topic=f"{name}/person",
+            scheduler=scheduler,
+            journal=journal_path(args.journal, name) if args.journal else None,
+            fps=self.capture.get(cv2.CAP_PROP_FPS) or 0.0,
+            annotate=args.debug,
+        )
+        self.counter = self.pipeline.counter
+        # `metrics.StreamMetrics`, once the stream is served.
+        self.metrics = None
+
+    def close(self):
+        self.grabber.stop()
+        self.capture.release()
+        self.pipeline.close()
+
+
+def infer_on_streams(args, publisher, sources: list, metrics=None):
+    """
+    Load the model once and run every stream through the same executable
+    network, round-robin, with the infer requests of the performance settings
+    per stream, of `args.batch_size` frames each.
+
+    Each stream keeps its own counts and publishes them under
+    `<name>/person` and `<name>/person/duration`.
+
+    :param args: Command line arguments parsed by `build_argparser()`
+    :param publisher: `StatsPublisher`, or None not to publish
+    :param sources: (name, source) pairs, see `load_sources`
+    :param metrics: `PipelineMetrics` to update, or None
+    :return: the `CameraStream`s, once they ended
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    if args.out or args.ffmpeg:
+        logger.warning("--out and --ffmpeg are ignored in multi-stream mode.")
+
+    infer_network = Network(
+        args.backend, replay=args.replay, cache_dir=args.model_cache
+    )
+    settings = performance_settings(args)
+    try:
+        infer_network.load_model(
+            model_xml=args.model,
+            device=args.device,
+            cpu_extension=args.cpu_extension if args.cpu_extension else None,
+            # 0 stays 0: the device picks the number of requests of all streams.
+            num_requests=settings["num_requests"] * len(sources),
+            batch_size=args.batch_size,
+            config=settings,
+            device_preprocess=args.preprocess == "device",
+        )
+    except Exception:
+        logger.exception("Failed to load the model")
+        raise
+
+    # Batches are filled with frames from whichever streams have one ready.
+    scheduler = BatchScheduler(infer_network, max_wait=args.batch_timeout / 1000)
+    # Frames a stream can have in flight, rounded up.
+    per_stream = -(-infer_network.num_requests // len(sources))
+    streams = []
+    try:
+        for name, source in sources:
+            logger.info(f"Processing {name}: {source}...")
+            streams.append(
+                CameraStream(
+                    name, source, publisher, args, infer_network, scheduler, per_stream
+                )
+            )
+    except Exception:
+        for stream in streams:
+            stream.close()
+        raise
+    for stream in streams:
+        stream.metrics = metrics.add_stream(stream.name, stream.counter, stream.grabber)
+        stream.pipeline.metrics = stream.grabber.metrics = stream.metrics
+        stream.grabber.start()
+    metrics.add_network(infer_network)
+
+    def emit(stream, results):
+        for result in results:
+            if args.debug:
+                cv2.imshow(stream.name, result.frame)
+            stream.grabber.release(result.frame)
+            stream.metrics.frames.inc()
+
+    def emit_all():
+        # A shared batch returns the frames of other streams too.
+        for stream in streams:
+            emit(stream, stream.pipeline.results())
+
+    try:
+        active = list(streams)
+        while active:
+            idle = True
+            # One frame per stream and pass, so a busy stream cannot starve the others.
+            for stream in list(active):
+                grabbed, frame = stream.grabber.read(timeout=0)
+                if not grabbed:
+                    if stream.grabber.finished:
+                        active.remove(stream)
+                    continue
+                idle = False
+                emit(stream, stream.pipeline.process(frame))
+                emit_all()
+
+            if idle and not scheduler.poll():
+                if infer_network.in_flight:
+                    StreamPipeline.dispatch(scheduler.collect())
+                    emit_all()
+                else:
+                    # Every live stream is between frames.
+                    time.sleep(0.001)
+
+            if args.debug and cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+
+        StreamPipeline.dispatch(scheduler.drain())
+        emit_all()
+    finally:
+        # Release the grabbers, captures and journals, also when the loop failed.
+        for stream in streams:
+            stream.close()
+        if args.debug:
+            cv2.destroyAllWindows()
+
+    for stream in streams:
+        logger.info(
+            f"{stream.name}: detected {stream.counter.total_count} people with an "
+            "average inference time: "
+            f"{stream.pipeline.mean_infer_time*1000:.3f}ms."
+        )
+    return streams
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""Sweep --prob_threshold over the detections of a single inference pass."""
+
+import csv
+import json
+import os
+import tempfile
+
+from argparse import ArgumentTypeError
+
+import numpy as np
+
+from counter import make_counter
+from journal import Journal, replay
+from loguru import logger
+from main import build_argparser, infer_on_stream
+from model_registry import resolve_model
+
+
+def threshold_range(text: str) -> list:
+    """Parse a --thresholds argument: "0.3,0.5,0.7", or "start:stop:step" with
+    the stop included."""
+    try:
+        if ":" in text:
+            start, stop, step = (float(value) for value in text.split(":"))
+            values = np.arange(start, stop + step / 2, step)
+        else:
+            values = [float(value) for value in text.split(",")]
+    except ValueError:
+        raise ArgumentTypeError(f"expected 0.3,0.5,0.7 or 0.3:0.9:0.05, got {text!r}")
+    if not len(values) or not all(0 <= value <= 1 for value in values):
+        raise ArgumentTypeError(f"thresholds must be between 0 and 1, got {text!r}")
+    return sorted(round(float(value), 6) for value in values)
+
+
+def build_sweep_argparser():
+    """Parse command line arguments: those of main.py, and of the sweep.
+
+    :return: command line arguments
+    """
+    parser = build_argparser()
+    parser.description = __doc__
+    parser.add_argument(
+        "--thresholds",
+        type=threshold_range,
+        default=threshold_range("0.2:0.9:0.05"),
+        help="Thresholds to count with, a list (0.3,0.5,0.7) or a range "
+        "(start:stop:step, 0.2:0.9:0.05 by default)",
+    )
+    parser.add_argument(
+        "--ground-truth",
+        type=str,
+        default=None,
+        help="CSV file of frame,count rows: the people in some frames of the "
+        "video, to compare the counts of every threshold with.",
+    )
+    parser.add_argument(
+        "--true-total",
+        type=int,
+        default=None,
+        help="Number of people who really went through the video.",
+    )
+    parser.add_argument(
+        "--curves",
+        type=str,
+        default=None,
+        help="Write the number of people in every frame, per threshold, to this "
+        "CSV file.",
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        help="Write the results of every threshold to this JSON file.",
+    )
+    return parser
+
+
+def load_ground_truth(path: str) -> dict:
+    """Read a CSV file of frame,count rows, a header row is skipped.
+
+    :return: {frame index: number of people}
+    """
+    truth = {}
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            try:
+                truth[int(row[0])] = int(row[1])
+            except (ValueError, IndexError):
+                # Header or blank line.
+                continue
+    return truth
+
+
+def detection_curves(journal: Journal, thresholds: list, classes: tuple):
+    """Detections above every threshold in every journaled frame, untracked.
+
+    :return: (frames, curves) where curves is a frames x thresholds array
+    """
+    records = journal.records
+    frames, frame_rows = np.unique(records["frame"], return_inverse=True)
+    confs = np.where(
+        np.isin(records["label"].astype(np.int32), classes), records["conf"], -1
+    )
+    curves = np.empty((len(frames), len(thresholds)), np.int32)
+    for column, threshold in enumerate(thresholds):
+        curves[:, column] = np.bincount(
+            frame_rows[confs >= threshold], minlength=len(frames)
+        )
+    return frames, curves
+
+
+def sweep(args, path: str) -> tuple:
+    """Count the people of the journal at `path` with every threshold.
+
+    :return: (results, counts) where results has one dict per threshold, and
+        counts is a frames x thresholds array of the people in every frame
+    """
+    journal = Journal(path)
+    thresholds = args.thresholds
+    if thresholds[0] < journal.min_conf:
+        logger.warning(
+            f"{path} has no detection below {journal.min_conf:g}, thresholds under "
+            "it count as if they were equal to it."
+        )
+    classes = tuple(args.classes)
+    truth = load_ground_truth(args.ground_truth) if args.ground_truth else {}
+    _, detections = detection_curves(journal, thresholds, classes)
+    # Ground truth of the frames of the journal.
+    frames = np.array(sorted(truth), int)
+    frames = frames[frames < journal.frames]
+    expected = np.array([truth[frame] for frame in frames], int)
+
+    results = []
+    columns = []
+    for column, threshold in enumerate(thresholds):
+        counter = make_counter(args, None, journal.width, journal.height)
+        counts = np.fromiter(
+            replay(journal, counter, threshold, classes), dtype=np.int32
+        )
+        columns.append(counts)
+        result = {
+            "threshold": threshold,
+            "total_count": counter.total_count,
+            # Tracked people per frame, and raw detections per journaled frame.
+            "mean_count": float(np.mean(counts)) if len(counts) else 0.0,
+            "mean_detections": float(np.mean(detections[:, column]))
+            if len(detections)
+            else 0.0,
+        }
+        if len(frames):
+            result["agreement"] = float(np.mean(counts[frames] == expected))
+            result["mean_abs_error"] = float(np.mean(np.abs(counts[frames] - expected)))
+        if args.true_total is not None:
+            result["total_error"] = counter.total_count - args.true_total
+        results.append(result)
+    return results, np.stack(columns, axis=1)
+
+
+def report(results: list):
+    """Log the results of every threshold, and the best one."""
+    logger.info(
+        f"{'threshold':>9}{'total':>7}{'people':>8}{'detections':>12}"
+        f"{'agreement':>11}{'abs error':>11}{'total error':>13}"
+    )
+    for result in results:
+        agreement = result.get("agreement")
+        error = result.get("mean_abs_error")
+        line = (
+            f"{result['threshold']:9.2f}{result['total_count']:7d}"
+            f"{result['mean_count']:8.2f}{result['mean_detections']:12.2f}"
+            + (f"{agreement:11.1%}{error:11.3f}" if agreement is not None else " " * 22)
+            + (f"{result['total_error']:+13d}" if "total_error" in result else "")
+        )
+        logger.info(line.rstrip())
+    if "agreement" in results[0]:
+        best = max(results, key=lambda result: result["agreement"])
+        logger.info(f"Best agreement with the ground truth at {best['threshold']}.")
+    elif "total_error" in results[0]:
+        best = min(results, key=lambda result: abs(result["total_error"]))
+        logger.info(f"Closest total count at {best['threshold']}.")
+
+
+def main():
+    parser = build_sweep_argparser()
+    args = parser.parse_args()
+    workdir = None
+    path = args.from_journal
+    if path is None:
+        # One inference pass, keeping every detection any threshold can use.
+        if not args.model or not args.input:
+            parser.error("-m/--model and -i/--input are required, or --from-journal")
+        if len(args.input) > 1 or args.sources:
+            parser.error("sweep one video at a time")
+        try:
+            args.model = resolve_model(
+                args.model, args.device, args.models_dir, args.model_precision
+            )
+        except ValueError as err:
+            parser.error(str(err))
+        if args.journal is None:
+            workdir = tempfile.TemporaryDirectory()
+            args.journal = os.path.join(workdir.name, "sweep.pcj")
+        elif os.path.exists(args.journal):
+            parser.error(f"{args.journal} exists, replay it with --from-journal")
+        args.journal_min_conf = min(args.journal_min_conf, args.thresholds[0])
+        infer_on_stream(args, None)
+        path = args.journal
+
+    results, counts = sweep(args, path)
+    report(results)
+    if args.curves:
+        with open(args.curves, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame"] + [f"{t:g}" for t in args.thresholds])
+            for frame, row in enumerate(counts):
+                writer.writerow([frame] + row.tolist())
+        logger.info(f"Counts per frame written to {args.curves}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.json}")
+    if workdir is not None:
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+
+    main()
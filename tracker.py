@@ -0,0 +1,226 @@
+"""Multi-object tracking of detections across frames."""
+
+import cv2
+import numpy as np
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Pairwise intersection over union of two Nx4 and Mx4 box arrays.
+
+    Boxes are [xmin, ymin, xmax, ymax].
+
+    :return: NxM array
+    """
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    top_left = np.maximum(a[..., :2], b[..., :2])
+    bottom_right = np.minimum(a[..., 2:], b[..., 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def centroids(boxes: np.ndarray) -> np.ndarray:
+    """Centre points of an Nx4 box array, as Nx2 [x, y]."""
+    return np.stack(
+        [(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1
+    )
+
+
+def centroid_similarity(boxes_a: np.ndarray, boxes_b: np.ndarray, max_distance: float):
+    """Pairwise similarity in [0, 1] decreasing with the centroid distance.
+
+    Pairs further apart than `max_distance` pixels get 0.
+
+    :return: NxM array
+    """
+    delta = centroids(boxes_a)[:, None, :] - centroids(boxes_b)[None, :, :]
+    distance = np.sqrt((delta ** 2).sum(axis=-1))
+    return np.clip(1 - distance / max_distance, 0, None)
+
+
+def greedy_assignment(similarity: np.ndarray, threshold: float):
+    """Match rows to columns by decreasing similarity.
+
+    Each step takes the best pair left with one vectorised `argmax`, then
+    rules out its row and column: at most min(N, M) steps over the NxM
+    matrix. Ties go to the first pair in row-major order.
+
+    :return: (rows, cols) integer arrays of the matched pairs
+    """
+    scores = np.where(
+        (similarity >= threshold) & (similarity >= 0), similarity, -np.inf
+    ).astype(np.float64)
+    rows, cols = [], []
+    for _ in range(min(scores.shape)):
+        row, col = np.unravel_index(np.argmax(scores), scores.shape)
+        if scores[row, col] == -np.inf:
+            break
+        rows.append(row)
+        cols.append(col)
+        scores[row, :] = -np.inf
+        scores[:, col] = -np.inf
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+
+class Tracker:
+    """
+    Assign persistent IDs to detections across frames.
+
+    Track state is kept in parallel NumPy arrays, so each update costs one
+    vectorised NxM similarity matrix (tracks x detections). A track is
+    confirmed, and counted as an entry, once it was matched `min_hits` times;
+    it ends, and is counted as an exit, after `max_age` detector frames
+    without a match.
+
+    Each track also has a constant-velocity motion model, so `predict` can
+    move the boxes along on frames the detector skipped.
+    """
+
+    def __init__(
+        self,
+        metric: str = "iou",
+        threshold: float = 0.3,
+        max_distance: float = 100.0,
+        max_age: int = 10,
+        min_hits: int = 3,
+        smoothing: float = 0.5,
+    ):
+        """
+        Params
+        ======
+        metric: str
+            "iou" or "centroid", how detections are matched to tracks.
+        threshold: float
+            Minimum similarity to match a detection to a track, IoU for "iou".
+        max_distance: float
+            Centroid distance in pixels at which the "centroid" similarity is 0.
+        max_age: int
+            Frames a track survives without a matching detection.
+        min_hits: int
+            Matches needed before a track is confirmed.
+        smoothing: float
+            Weight of the latest measurement in the velocity estimate, in (0, 1].
+        """
+        if metric not in ("iou", "centroid"):
+            raise ValueError(f"Unknown tracking metric: {metric}")
+        self.metric = metric
+        self.threshold = threshold
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.smoothing = smoothing
+        self._next_id = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.first_seen = np.empty(0, dtype=np.float64)
+        self.last_seen = np.empty(0, dtype=np.float64)
+        self.hits = np.empty(0, dtype=np.int32)
+        self.misses = np.empty(0, dtype=np.int32)
+        # Motion model: per-frame box velocity, and the last detected box.
+        self.velocity = np.empty((0, 4), dtype=np.float32)
+        self._detected = np.empty((0, 4), dtype=np.float32)
+        self._since_detected = np.empty(0, dtype=np.int32)
+
+    @property
+    def confirmed(self) -> np.ndarray:
+        """Mask of the live tracks that are confirmed."""
+        return self.hits >= self.min_hits
+
+    @property
+    def visible(self) -> np.ndarray:
+        """Mask of the confirmed tracks matched in the latest frame."""
+        return self.confirmed & (self.misses == 0)
+
+    def _similarity(self, boxes: np.ndarray) -> np.ndarray:
+        if self.metric == "iou":
+            return iou_matrix(self.boxes, boxes)
+        return centroid_similarity(self.boxes, boxes, self.max_distance)
+
+    def predict(self):
+        """Move every track one frame along its velocity, without detections."""
+        self.boxes += self.velocity
+        self._since_detected += 1
+
+    def update(self, boxes: np.ndarray, timestamp: float):
+        """Match the detections of a new frame to the live tracks.
+
+        :param boxes: Mx4 [xmin, ymin, xmax, ymax] detections of the frame
+        :param timestamp: time of the frame, in seconds
+        :return: (entered, exited) where `entered` is an array of the IDs
+            confirmed on this frame and `exited` a list of (id, dwell seconds)
+            of the confirmed tracks that ended
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        was_confirmed = self.confirmed
+        # Match against where the tracks are expected to be on this frame.
+        self.predict()
+
+        rows, cols = greedy_assignment(self._similarity(boxes), self.threshold)
+        elapsed = self._since_detected[rows, None]
+        measured = (boxes[cols] - self._detected[rows]) / elapsed
+        self.velocity[rows] += self.smoothing * (measured - self.velocity[rows])
+        self._detected[rows] = boxes[cols]
+        self._since_detected[rows] = 0
+        self.boxes[rows] = boxes[cols]
+        self.last_seen[rows] = timestamp
+        self.hits[rows] += 1
+        self.misses += 1
+        self.misses[rows] = 0
+
+        entered = self.ids[self.confirmed & ~was_confirmed]
+
+        expired = self.misses > self.max_age
+        ended = expired & self.confirmed
+        exited = list(
+            zip(
+                self.ids[ended].tolist(),
+                (self.last_seen[ended] - self.first_seen[ended]).tolist(),
+            )
+        )
+        keep = ~expired
+
+        new = np.ones(len(boxes), dtype=bool)
+        new[cols] = False
+        count = int(new.sum())
+        new_ids = np.arange(self._next_id, self._next_id + count)
+        self._next_id += count
+
+        now = np.full(count, timestamp)
+        self.ids = np.concatenate([self.ids[keep], new_ids])
+        self.boxes = np.concatenate([self.boxes[keep], boxes[new]])
+        self.first_seen = np.concatenate([self.first_seen[keep], now])
+        self.last_seen = np.concatenate([self.last_seen[keep], now])
+        self.hits = np.concatenate([self.hits[keep], np.ones(count, np.int32)])
+        self.misses = np.concatenate([self.misses[keep], np.zeros(count, np.int32)])
+        self.velocity = np.concatenate(
+            [self.velocity[keep], np.zeros((count, 4), np.float32)]
+        )
+        self._detected = np.concatenate([self._detected[keep], boxes[new]])
+        self._since_detected = np.concatenate(
+            [self._since_detected[keep], np.zeros(count, np.int32)]
+        )
+
+        if self.min_hits <= 1 and count:
+            entered = np.concatenate([entered, new_ids])
+        return entered, exited
+
+
+def draw_tracks(frame: np.ndarray, tracker: Tracker):
+    """Draw the confirmed tracks, with their IDs, onto the frame."""
+    confirmed = tracker.confirmed
+    boxes = tracker.boxes[confirmed].astype(np.int32).tolist()
+    for track_id, (xmin, ymin, xmax, ymax) in zip(tracker.ids[confirmed], boxes):
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 0, 255), 1)
+        cv2.putText(
+            frame,
+            f"#{track_id}",
+            (xmin, max(ymin - 10, 10)),
+            cv2.FONT_HERSHEY_COMPLEX,
+            fontScale=0.5,
+            color=(127, 255, 127),
+            thickness=1,
+        )
+    return frame
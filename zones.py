@@ -0,0 +1,220 @@
+"""Directional line-crossing and region-of-interest counting on tracks."""
+
+import json
+
+import cv2
+import numpy as np
+
+
+def _side_of_lines(points: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    """Side of every directed line each point lies on.
+
+    In image coordinates (y pointing down), +1 is on the right-hand side when
+    looking from the start of the line towards its end.
+
+    :return: NxL int8 array of +1, -1, or 0 on the line
+    """
+    direction = ends - starts  # Lx2
+    offset = points[:, None, :] - starts[None, :, :]  # NxLx2
+    cross = direction[:, 0] * offset[..., 1] - direction[:, 1] * offset[..., 0]
+    return np.sign(cross).astype(np.int8)
+
+
+def _within_segments(points: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    """Whether each point projects onto the extent of each segment.
+
+    :return: NxL bool array
+    """
+    direction = ends - starts
+    offset = points[:, None, :] - starts[None, :, :]
+    t = (offset * direction[None]).sum(axis=-1) / (direction ** 2).sum(axis=-1)
+    return (t >= 0) & (t <= 1)
+
+
+def _inside_polygons(points: np.ndarray, polygons: list):
+    """Even-odd rule point-in-polygon test, vectorised over points and edges.
+
+    :return: NxZ bool array
+    """
+    inside = np.zeros((len(points), len(polygons)), dtype=bool)
+    x, y = points[:, 0:1], points[:, 1:2]
+    for index, polygon in enumerate(polygons):
+        x0, y0 = polygon[:, 0], polygon[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        straddles = (y0 > y) != (y1 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside[:, index] = (straddles & (x < x_cross)).sum(axis=1) % 2 == 1
+    return inside
+
+
+class ZoneCounter:
+    """
+    Count tracked people crossing lines and entering or leaving polygons.
+
+    Lines and polygons are configured in normalised [0, 1] frame coordinates.
+    A line is directed from its first to its second point: looking along it on
+    screen, crossing it from left to right counts as "in", the other way as
+    "out". A polygon counts "in" when a track's centroid moves inside it and
+    "out" when it leaves, and reports its current occupancy.
+
+    Every test is a vectorised array operation over tracks x lines (or
+    tracks x polygon edges); only the previous side/inside state of each live
+    track is kept between frames.
+    """
+
+    def __init__(self, lines: dict = None, zones: dict = None, width=1, height=1):
+        """
+        Params
+        ======
+        lines: dict
+            Line name -> [[x0, y0], [x1, y1]], normalised.
+        zones: dict
+            Polygon name -> [[x, y], ...], normalised.
+        width, height: int
+            Frame size in pixels, the scale of the points passed to `update`.
+        """
+        self.width = width
+        self.height = height
+        scale = np.array([width, height], dtype=np.float32)
+        lines = lines or {}
+        zones = zones or {}
+
+        self.line_names = list(lines)
+        points = np.array([lines[name] for name in self.line_names], np.float32)
+        points = points.reshape(-1, 2, 2) * scale
+        self._starts, self._ends = points[:, 0], points[:, 1]
+
+        self.zone_names = list(zones)
+        self._polygons = [
+            np.array(zones[name], dtype=np.float32).reshape(-1, 2) * scale
+            for name in self.zone_names
+        ]
+
+        self.line_counts = np.zeros((len(self.line_names), 2), dtype=np.int64)
+        self.zone_counts = np.zeros((len(self.zone_names), 2), dtype=np.int64)
+        self.occupancy = np.zeros(len(self.zone_names), dtype=np.int64)
+
+        # Previous state of each track seen so far, row-aligned with `_ids`.
+        self._ids = np.empty(0, dtype=np.int64)
+        self._sides = np.empty((0, len(self.line_names)), dtype=np.int8)
+        self._inside = np.empty((0, len(self.zone_names)), dtype=bool)
+
+    @classmethod
+    def from_config(cls, path: str, width: int, height: int):
+        """Load lines and zones from a JSON file.
+
+        The file looks like::
+
+            {
+                "lines": {"door": [[0.1, 0.9], [0.6, 0.2]]},
+                "zones": {"till": [[0.5, 0.5], [0.9, 0.5], [0.9, 0.9], [0.5, 0.9]]}
+            }
+        """
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get("lines"), config.get("zones"), width, height)
+
+    def __bool__(self):
+        return bool(self.line_names or self.zone_names)
+
+    def update(self, ids: np.ndarray, points: np.ndarray, live_ids=None):
+        """Update the counts with the latest positions of tracked people.
+
+        :param ids: IDs of the tracks positioned in this frame
+        :param points: Nx2 [x, y] pixel positions (e.g. centroids) of `ids`
+        :param live_ids: IDs of every live track, state of the others is
+            dropped. Defaults to `ids`.
+        :return: (lines, zones) names of the lines and zones whose counts
+            changed on this frame
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        sides = _side_of_lines(points, self._starts, self._ends)
+        within = _within_segments(points, self._starts, self._ends)
+        inside = _inside_polygons(points, self._polygons)
+
+        # Previous state of the tracks already known.
+        _, known, previous = np.intersect1d(ids, self._ids, return_indices=True)
+        prev_sides = self._sides[previous]
+        cur_sides = sides[known]
+        crossed = (prev_sides != 0) & (cur_sides != 0) & (prev_sides != cur_sides)
+        crossed &= within[known]
+        crossed_in = crossed & (cur_sides > 0)
+        self.line_counts[:, 0] += crossed_in.sum(axis=0)
+        self.line_counts[:, 1] += (crossed & ~crossed_in).sum(axis=0)
+
+        prev_inside = np.zeros_like(inside)
+        prev_inside[known] = self._inside[previous]
+        entered = inside & ~prev_inside
+        left = ~inside & prev_inside
+        self.zone_counts[:, 0] += entered.sum(axis=0)
+        self.zone_counts[:, 1] += left.sum(axis=0)
+
+        # Merge the new state, keep the state of live tracks not seen this frame.
+        live_ids = ids if live_ids is None else np.asarray(live_ids, dtype=np.int64)
+        unseen = ~np.isin(self._ids, ids)
+        stale = unseen & np.isin(self._ids, live_ids)
+        # Tracks that ended while inside a zone have left it.
+        gone_out = self._inside[unseen & ~stale].sum(axis=0)
+        self.zone_counts[:, 1] += gone_out
+        self._ids = np.concatenate([self._ids[stale], ids])
+        # A point exactly on a line keeps the side it came from.
+        keep_side = np.zeros_like(sides)
+        keep_side[known] = prev_sides
+        sides = np.where(sides == 0, keep_side, sides)
+        self._sides = np.concatenate([self._sides[stale], sides])
+        self._inside = np.concatenate([self._inside[stale], inside])
+        self.occupancy = self._inside.sum(axis=0)
+
+        changed_zones = entered.any(axis=0) | left.any(axis=0) | (gone_out > 0)
+        return (
+            [name for name, hit in zip(self.line_names, crossed.any(axis=0)) if hit],
+            [name for name, hit in zip(self.zone_names, changed_zones) if hit],
+        )
+
+    def line_stats(self, name: str) -> dict:
+        """In/out counts of a line."""
+        index = self.line_names.index(name)
+        return {
+            "in": int(self.line_counts[index, 0]),
+            "out": int(self.line_counts[index, 1]),
+        }
+
+    def zone_stats(self, name: str) -> dict:
+        """In/out counts and current occupancy of a polygon."""
+        index = self.zone_names.index(name)
+        return {
+            "in": int(self.zone_counts[index, 0]),
+            "out": int(self.zone_counts[index, 1]),
+            "occupancy": int(self.occupancy[index]),
+        }
+
+    def draw(self, frame: np.ndarray):
+        """Draw the lines, polygons and their counts onto the frame."""
+        for name, start, end in zip(self.line_names, self._starts, self._ends):
+            start, end = tuple(map(int, start)), tuple(map(int, end))
+            cv2.line(frame, start, end, (250, 0, 1), 2)
+            stats = self.line_stats(name)
+            cv2.putText(
+                frame,
+                f"{name}: in {stats['in']} out {stats['out']}",
+                start,
+                cv2.FONT_HERSHEY_COMPLEX,
+                0.5,
+                (250, 0, 1),
+                1,
+            )
+        for name, polygon in zip(self.zone_names, self._polygons):
+            cv2.polylines(frame, [polygon.astype(np.int32)], True, (0, 255, 0), 2)
+            stats = self.zone_stats(name)
+            cv2.putText(
+                frame,
+                f"{name}: {stats['occupancy']}",
+                tuple(map(int, polygon[0])),
+                cv2.FONT_HERSHEY_COMPLEX,
+                0.5,
+                (0, 255, 0),
+                1,
+            )
+        return frame